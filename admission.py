@@ -0,0 +1,84 @@
+# admission.py
+# Kiểm tra ảnh tải lên chỉ bằng header (định dạng, kích thước, số pixel, số khung hình)
+# trước khi giải mã toàn bộ, để một ảnh quá lớn hay "bom giải nén" không làm treo worker.
+
+import io
+import time
+import warnings
+from collections import namedtuple
+
+from PIL import Image
+
+from config import (UPLOAD_MAX_BYTES, UPLOAD_ALLOWED_FORMATS, UPLOAD_MAX_DIMENSION, UPLOAD_MAX_PIXELS,
+                    UPLOAD_MAX_FRAMES, UPLOAD_DOWNSCALE_LONG_SIDE)
+from metrics import metrics
+
+AdmissionResult = namedtuple('AdmissionResult', ['ok', 'reason', 'image_bytes', 'format', 'size', 'frames'])
+
+# Thông báo hiển thị cho người dùng theo lý do từ chối
+REJECTION_MESSAGES = {
+    'too_many_bytes': "File ảnh quá lớn.",
+    'unreadable': "Không đọc được file ảnh này.",
+    'format': "Định dạng ảnh không được hỗ trợ.",
+    'decompression_bomb': "Ảnh có số điểm ảnh bất thường, có thể gây quá tải.",
+    'pixels': "Ảnh có độ phân giải quá lớn.",
+    'dimensions': "Ảnh có kích thước (chiều dài/rộng) quá lớn.",
+    'frames': "Ảnh động có quá nhiều khung hình.",
+}
+
+
+def _reject(reason, started, **info):
+    metrics.incr('admission.rejected')
+    metrics.incr(f'admission.rejected.{reason}')
+    metrics.observe('admission.check_ms', (time.perf_counter() - started) * 1000.0)
+    print(f"ADMISSION: Rejected upload ({reason}) {info}")
+    return AdmissionResult(False, reason, None, info.get('format'), info.get('size'), info.get('frames'))
+
+
+def _downscale_jpeg(img, long_side):
+    """Thu nhỏ JPEG bằng draft (giải mã ở 1/2..1/8 kích thước), không bung ảnh gốc."""
+    img.draft('RGB', (long_side, long_side))
+    img = img.convert('RGB')
+    img.thumbnail((long_side, long_side), Image.Resampling.BICUBIC)
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=90, exif=img.info.get('exif', b''))
+    return out.getvalue()
+
+
+def check_upload(image_bytes):
+    """Kiểm tra ảnh tải lên; trả về AdmissionResult (ảnh JPEG quá to được thu nhỏ sớm thay vì từ chối)."""
+    started = time.perf_counter()
+    if len(image_bytes) > UPLOAD_MAX_BYTES:
+        return _reject('too_many_bytes', started, bytes=len(image_bytes))
+    try:
+        # Số pixel được kiểm tra ngay dưới đây theo UPLOAD_MAX_PIXELS nên bỏ cảnh báo "bom giải nén"
+        # của Pillow cho lần mở này (không đổi thiết lập chung của Pillow trong tiến trình)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            img = Image.open(io.BytesIO(image_bytes)) # Chỉ đọc header, chưa giải mã điểm ảnh
+    except Image.DecompressionBombError:
+        return _reject('decompression_bomb', started)
+    except Exception:
+        return _reject('unreadable', started)
+
+    fmt, size = img.format, img.size
+    if fmt not in UPLOAD_ALLOWED_FORMATS:
+        return _reject('format', started, format=fmt, size=size)
+    if size[0] * size[1] > UPLOAD_MAX_PIXELS:
+        return _reject('pixels', started, format=fmt, size=size)
+    # n_frames của GIF chỉ duyệt cấu trúc block, không giải mã khung hình
+    frames = getattr(img, 'n_frames', 1)
+    if frames > UPLOAD_MAX_FRAMES:
+        return _reject('frames', started, format=fmt, size=size, frames=frames)
+
+    long_side = max(size)
+    if long_side > UPLOAD_MAX_DIMENSION and fmt != 'JPEG':
+        return _reject('dimensions', started, format=fmt, size=size, frames=frames)
+    if long_side > UPLOAD_DOWNSCALE_LONG_SIDE and fmt == 'JPEG':
+        image_bytes = _downscale_jpeg(img, UPLOAD_DOWNSCALE_LONG_SIDE)
+        metrics.incr('admission.downscaled')
+        print(f"ADMISSION: Downscaled JPEG {size} to long side {UPLOAD_DOWNSCALE_LONG_SIDE}")
+
+    metrics.incr('admission.accepted')
+    metrics.observe('admission.check_ms', (time.perf_counter() - started) * 1000.0)
+    return AdmissionResult(True, None, image_bytes, fmt, size, frames)
@@ -0,0 +1,219 @@
+# api_server.py
+# Dịch vụ HTTP phân loại ảnh không qua Streamlit (cho app di động và các job hàng loạt).
+# Dùng chung đường tải model, giải mã ảnh, kiểm tra upload và bộ gom lô với app: các yêu cầu
+# đồng thời được gom thành lô suy luận chung.
+#
+#   POST /predict   multipart/form-data (một hoặc nhiều file) hoặc bytes ảnh thô (image/*, application/octet-stream)
+#   GET  /readyz    200 khi model đã tải xong, 503 nếu chưa (hoặc tải lỗi)
+#   GET  /healthz   tiến trình còn sống
+#   GET  /metrics   số liệu hiệu năng (JSON)
+#
+# Chạy:  python api_server.py --port 8080
+# Thử:   curl -F image=@la.jpg http://localhost:8080/predict
+#        curl --data-binary @la.jpg -H 'Content-Type: image/jpeg' http://localhost:8080/predict
+
+import argparse
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from admission import check_upload, REJECTION_MESSAGES
+from config import (CLASS_NAMES, CLASS_TO_SCIENTIFIC, MODEL_PATH, UPLOAD_MAX_BYTES, API_HOST, API_PORT, API_WORKERS,
+                    API_MAX_PENDING, API_MAX_IMAGES, API_KEEPALIVE_TIMEOUT)
+from inference import BackgroundLoader
+from metrics import metrics
+from utils import build_classifier, decode_image, load_model_for_backend
+
+
+def parse_images(content_type, body):
+    """[(tên file, bytes)] từ thân yêu cầu: mọi phần có file của multipart, hoặc cả thân nếu là ảnh thô."""
+    if content_type.lower().startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+        if not message.is_multipart():
+            raise ValueError("malformed multipart body")
+        images = []
+        for part in message.iter_parts():
+            payload = part.get_payload(decode=True)
+            if part.get_filename() is not None or part.get_param('name', header='content-disposition') in ('image', 'images'):
+                images.append((part.get_filename(), payload or b''))
+        return images
+    return [(None, body)] if body else []
+
+
+def classify(classifier, images):
+    """Kiểm tra + giải mã từng ảnh, chạy một lần suy luận cho các ảnh hợp lệ, trả kết quả theo thứ tự gửi lên."""
+    results = [None] * len(images)
+    decoded, positions = [], []
+    for position, (filename, image_bytes) in enumerate(images):
+        admission = check_upload(image_bytes)
+        if not admission.ok:
+            results[position] = {'filename': filename, 'error': admission.reason,
+                                 'message': REJECTION_MESSAGES.get(admission.reason)}
+            continue
+        try:
+            decoded.append(decode_image(admission.image_bytes))
+            positions.append(position)
+        except Exception as e:
+            results[position] = {'filename': filename, 'error': 'decode', 'message': str(e)}
+    if decoded:
+        probabilities = classifier.predict(np.concatenate(decoded, axis=0))
+        for position, row in zip(positions, probabilities):
+            index = int(np.argmax(row))
+            results[position] = {
+                'filename': images[position][0],
+                'class': CLASS_NAMES[index],
+                'scientific_name': CLASS_TO_SCIENTIFIC.get(CLASS_NAMES[index]),
+                'confidence': float(row[index]) * 100.0,
+                'probabilities': {name: float(p) for name, p in zip(CLASS_NAMES, row)},
+            }
+    return results
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Giữ kết nối (keep-alive) giữa các yêu cầu
+    timeout = API_KEEPALIVE_TIMEOUT # Kết nối rảnh quá lâu thì đóng (giải phóng luồng của nó)
+    # Header và thân trả lời là hai lần ghi nhỏ: với Nagle, lần ghi thứ hai chờ ACK trễ (~40 ms) của client
+    disable_nagle_algorithm = True
+    server_version = 'PlantClassifier/1.0'
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        loader = self.server.loader
+        if self.path == '/healthz':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/readyz':
+            status = 200 if loader.ready else 503
+            self._send_json(status, {'ready': loader.ready, 'failed': loader.failed,
+                                     'error': str(loader.error) if loader.error else None,
+                                     'load_ms': loader.load_ms})
+        elif self.path == '/metrics':
+            self._send_json(200, metrics.snapshot())
+        else:
+            self._send_json(404, {'error': 'not_found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': 'not_found'})
+            return
+        started = time.perf_counter()
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.close_connection = True # Không biết thân yêu cầu dài bao nhiêu nên không đọc tiếp được
+            self._send_json(411, {'error': 'length_required'})
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self._send_json(400, {'error': 'bad_request', 'message': 'invalid Content-Length'})
+            return
+        if length > UPLOAD_MAX_BYTES * API_MAX_IMAGES:
+            self.close_connection = True
+            self._send_json(413, {'error': 'too_large'})
+            return
+        body = self.rfile.read(length) # Luôn đọc hết thân để dùng lại được kết nối
+        loader = self.server.loader
+        if not loader.ready:
+            self._send_json(503, {'error': 'model_not_ready'}, {'Retry-After': '5'})
+            return
+        try:
+            images = parse_images(self.headers.get('Content-Type', 'application/octet-stream'), body)
+        except ValueError as e:
+            self._send_json(400, {'error': 'bad_request', 'message': str(e)})
+            return
+        if not images:
+            self._send_json(400, {'error': 'no_images'})
+            return
+        if len(images) > API_MAX_IMAGES:
+            self._send_json(413, {'error': 'too_many_images', 'max_images': API_MAX_IMAGES})
+            return
+        try:
+            results = self.server.run_limited(classify, loader.result, images)
+        except ServerBusy:
+            metrics.incr('api.rejected_busy')
+            self._send_json(503, {'error': 'busy'}, {'Retry-After': '1'})
+            return
+        except Exception as e:
+            print(f"API: Prediction failed: {e}")
+            self._send_json(500, {'error': 'prediction_failed', 'message': str(e)})
+            return
+        latency_ms = (time.perf_counter() - started) * 1000.0
+        metrics.incr('api.requests')
+        metrics.incr('api.images', len(images))
+        metrics.observe('api.request_ms', latency_ms)
+        self._send_json(200, {'results': results, 'latency_ms': latency_ms})
+
+    def log_message(self, format, *args):
+        pass # Mỗi yêu cầu đã được ghi vào metrics; không in từng dòng truy cập
+
+
+class ServerBusy(Exception):
+    """Đã có `workers + max_pending` yêu cầu đang suy luận hoặc chờ suy luận."""
+
+
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """Mỗi kết nối một luồng (kết nối keep-alive đang rảnh không chặn ai), nhưng giới hạn phần suy luận.
+
+    Tối đa `workers` yêu cầu giải mã + suy luận cùng lúc, `max_pending` yêu cầu chờ lượt;
+    vượt quá thì yêu cầu nhận 503 ngay.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, handler, loader, workers=API_WORKERS, max_pending=API_MAX_PENDING):
+        super().__init__(address, handler)
+        self.loader = loader
+        self._admitted = threading.BoundedSemaphore(workers + max_pending)
+        self._running = threading.BoundedSemaphore(workers)
+
+    def run_limited(self, fn, *args):
+        """Chạy `fn(*args)` khi có lượt suy luận; ném ServerBusy nếu hàng chờ đã đầy."""
+        if not self._admitted.acquire(blocking=False):
+            raise ServerBusy()
+        try:
+            with self._running:
+                return fn(*args)
+        finally:
+            self._admitted.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP inference endpoint for the plant classifier")
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--workers', type=int, default=API_WORKERS)
+    parser.add_argument('--max-pending', type=int, default=API_MAX_PENDING)
+    args = parser.parse_args()
+
+    # Model tải trên luồng nền: /healthz trả lời ngay, /readyz báo 200 khi suy luận được
+    loader = BackgroundLoader(lambda: build_classifier(load_model_for_backend(args.model)), name='model').start()
+    server = BoundedThreadingHTTPServer((args.host, args.port), PredictionHandler, loader,
+                                        workers=args.workers, max_pending=args.max_pending)
+    print(f"API: Listening on http://{args.host}:{args.port} ({args.workers} workers)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 # app.py
 
+import time
+_APP_STARTED = time.perf_counter()
+
 import streamlit as st
 import numpy as np
 import os
@@ -14,19 +17,33 @@ st.set_page_config(
 )
 
 # Import các hàm và hằng số
-from config import MODEL_PATH, CLASS_NAMES, CONFIDENCE_THRESHOLD, COLLECTED_DATA_DIR, CLASS_TO_SCIENTIFIC
-from utils import (load_keras_model, preprocess_image, search_taxa_autocomplete,
-                   get_inat_image_urls, save_feedback_image)
+from config import (MODEL_PATH, CLASS_NAMES, CONFIDENCE_THRESHOLD, COLLECTED_DATA_DIR, CLASS_TO_SCIENTIFIC, SHOW_METRICS,
+                    BACKGROUND_MODEL_LOADING, MODEL_LOADING_POLL_SECONDS, UPLOAD_DISPLAY_SIZE)
+from utils import (get_inference_scheduler, load_keras_model, start_model_loading, record_first_prediction,
+                   get_prediction_cache, preprocess_image, search_taxa_autocomplete, get_inat_image_urls,
+                   get_reference_thumbnails, prefetch_reference_data, cancel_prefetch, save_feedback_image,
+                   suggest_similar_species, get_upload_spool, begin_run, end_run, measured, note_media_bytes,
+                   rerun_fragment)
+from upload_spool import display_thumbnail
+from metrics import metrics
+from admission import check_upload, REJECTION_MESSAGES
+
+metrics.set_gauge('startup.app_import_ms', (time.perf_counter() - _APP_STARTED) * 1000.0)
+# Đo thời gian chạy script và số byte media hiển thị của mỗi lần chạy cả trang (xem SHOW_METRICS)
+begin_run('script')
 
 
 # --- Khởi tạo Session State ---
 default_states = {
     'file_identifier': None,
     'widget_key_prefix': None,
-    'image_data': None,
+    'upload_hash': None, # Khóa của ảnh trong spool dùng chung (phiên không giữ bytes ảnh gốc)
+    'display_image': None, # Thumbnail JPEG nhỏ để hiển thị
+    'upload_error': None,
     'prediction_done': False,
     'predicted_class': None,
     'confidence': 0.0,
+    'embedding': None, # Embedding lớp áp chót của ảnh (tra ảnh tương tự, lưu kèm phản hồi)
     'user_feedback': None,
     'inat_search_term': "",
     'inat_suggestions': [],
@@ -41,8 +58,321 @@ for key, default_value in default_states.items():
     if key not in st.session_state:
         st.session_state[key] = default_value
 
+def current_prediction():
+    """Dự đoán của model cho ảnh hiện tại, lưu kèm ảnh phản hồi."""
+    if not st.session_state.prediction_done:
+        return None
+    return {'class': st.session_state.predicted_class, 'confidence': round(float(st.session_state.confidence), 2)}
+
+def prediction_status():
+    """(lớp dự đoán, độ chắc chắn %, có chắc chắn không, có thuộc CLASS_NAMES không) của ảnh hiện tại."""
+    pred_class = st.session_state.predicted_class
+    pred_conf = st.session_state.confidence
+    is_confident_prediction = pred_conf >= CONFIDENCE_THRESHOLD and pred_class in CLASS_NAMES
+    is_known_class_prediction = pred_class in CLASS_NAMES
+    return pred_class, pred_conf, is_confident_prediction, is_known_class_prediction
+
+# --- Các phần giao diện sau khi phân loại ---
+# Mỗi phần là một fragment: tương tác bên trong (gõ tìm kiếm, chọn gợi ý...) chỉ chạy lại phần đó,
+# không chạy lại cả script hay gửi lại ảnh. Khi thay đổi ảnh hưởng phần khác thì gọi st.rerun() cho cả trang.
+@st.fragment
+@measured('result')
+def result_section():
+    pred_class, pred_conf, is_confident_prediction, is_known_class_prediction = prediction_status()
+
+    # Hiển thị kết quả dự đoán
+    if is_confident_prediction:
+        st.success(f"**Kết quả: Có vẻ là cây {pred_class}!** (Độ chắc chắn: {pred_conf:.1f}%)")
+    elif is_known_class_prediction:
+         st.warning(f"**Hmm, không chắc chắn lắm.** Dự đoán gần nhất: **{pred_class}** (Độ chắc chắn: {pred_conf:.1f}%)")
+    else:
+        st.error("**Không thể nhận diện chắc chắn.**")
+
+@st.fragment
+@measured('feedback')
+def feedback_section(key_prefix):
+    pred_class, pred_conf, is_confident_prediction, is_known_class_prediction = prediction_status()
+
+    # --- Logic Hỏi Feedback Mới ---
+    st.markdown("---") # Phân cách trước câu hỏi feedback
+    if is_confident_prediction:
+        st.write(f"**Hệ thống dự đoán là {pred_class}. Thông tin này có chính xác không?**")
+        feedback_cols = st.columns(2)
+        with feedback_cols[0]:
+            if st.button("✅ Đúng rồi", key=f"feedback_correct_{key_prefix}"):
+                st.session_state.user_feedback = 'Correct_Confident'
+                scientific_label_to_save = CLASS_TO_SCIENTIFIC.get(pred_class)
+
+                if scientific_label_to_save:
+                    # Gọi hàm lưu ảnh ngay lập tức
+                    print(f"APP: Saving correctly identified image as {scientific_label_to_save}") # DEBUG
+                    saved_ok, saved_label_dir = save_feedback_image(
+                        get_upload_spool().read(st.session_state.upload_hash),
+                        st.session_state.original_filename,
+                        scientific_label_to_save, # <<< Dùng tên khoa học
+                        COLLECTED_DATA_DIR,
+                        prediction=current_prediction(),
+                        embedding=st.session_state.embedding,
+                        classifier=scheduler
+                    )
+                    if saved_ok:
+                        # Không cần rerun ngay, chỉ cần cập nhật state và hiển thị thông báo
+                        st.session_state.image_saved = True
+                        cancel_prefetch(key_prefix) # Đã lưu phản hồi: không cần dữ liệu tham khảo tải trước nữa
+                        # st.rerun() # Có thể không cần rerun ở đây nữa
+                    # else: lỗi đã được hiển thị trong save_feedback_image
+                else:
+                    print(f"APP: Could not find scientific name mapping for {pred_class}")
+                    st.error(f"Lỗi: Không tìm thấy tên khoa học tương ứng cho '{pred_class}' để lưu.")
+
+                st.rerun()
+        with feedback_cols[1]:
+             if st.button("❌ Sai rồi", key=f"feedback_incorrect_{key_prefix}"):
+                st.session_state.user_feedback = 'Incorrect_Confident'
+                # Reset tìm kiếm khi bấm sai
+                st.session_state.inat_search_term = ""
+                st.session_state.selected_inat_suggestion = None
+                st.session_state.inat_image_urls = []
+                st.rerun()
+    else: # Trường hợp không chắc chắn hoặc lớp lạ
+        st.write(f"**Hệ thống không chắc chắn về ảnh này. Bạn có thể giúp xác định không?**")
+        feedback_cols = st.columns(2)
+        with feedback_cols[0]:
+            if is_known_class_prediction: # Chỉ hiện nút này nếu biết lớp dự đoán gần nhất
+                if st.button(f"✅ Đúng, đó là {pred_class}", key=f"feedback_confirm_unsure_{key_prefix}"):
+                    st.session_state.user_feedback = 'Confirmed_Unsure'
+                    st.session_state.final_label_confirmed = pred_class # Xác nhận nhãn dự đoán ban đầu là đúng
+                    st.rerun()
+            # else: Cột này trống nếu không biết lớp
+        with feedback_cols[1]:
+             if st.button("🔍 Tìm loại cây khác", key=f"feedback_search_unsure_{key_prefix}"):
+                st.session_state.user_feedback = 'Search_Unsure'
+                # Reset tìm kiếm
+                st.session_state.inat_search_term = ""
+                st.session_state.selected_inat_suggestion = None
+                st.session_state.inat_image_urls = []
+                st.rerun()
+
+        # Gợi ý từ ảnh tương tự người dùng đã xác nhận (tra cục bộ, không gọi iNaturalist)
+        similar_species = suggest_similar_species(st.session_state.embedding)
+        if similar_species and not st.session_state.user_feedback:
+            st.write("**Ảnh tương tự đã được người dùng khác xác nhận là:**")
+            similar_cols = st.columns(min(len(similar_species), 3))
+            for col, species in zip(similar_cols, similar_species[:3]):
+                species_name = species['label'].replace('_', ' ')
+                if col.button(f"🌱 {species_name} ({species['count']} ảnh)", key=f"similar_{species['label']}_{key_prefix}",
+                              help=f"Độ giống cao nhất: {species['best']:.2f}"):
+                    # Chuyển sang giao diện tìm kiếm với tên loài đã điền sẵn
+                    st.session_state.user_feedback = 'Search_Unsure'
+                    st.session_state.inat_search_term = species_name
+                    st.session_state.selected_inat_suggestion = None
+                    st.session_state.inat_image_urls = []
+                    st.rerun()
+
+    # --- Xử lý dựa trên Feedback ---
+    # Chỉ hiển thị các phần này nếu user_feedback đã được đặt
+    if st.session_state.user_feedback == 'Correct_Confident':
+        if not st.session_state.image_saved:
+         st.success("🎉 Cảm ơn bạn đã xác nhận!")
+
+    elif st.session_state.user_feedback == 'Confirmed_Unsure':
+        confirmed_short_label = st.session_state.final_label_confirmed
+        st.success(f"🎉 Cảm ơn bạn đã xác nhận là **{st.session_state.final_label_confirmed}**!")
+
+        if not st.session_state.image_saved:
+            scientific_label_to_save = CLASS_TO_SCIENTIFIC.get(confirmed_short_label)
+            if scientific_label_to_save:
+                print(f"APP: Saving unsure but confirmed image as {scientific_label_to_save}") # DEBUG
+                saved_ok, saved_label_dir = save_feedback_image(
+                    get_upload_spool().read(st.session_state.upload_hash), # Dữ liệu ảnh (đọc từ spool)
+                    st.session_state.original_filename,    # Tên file gốc
+                    scientific_label_to_save, # <<< Dùng tên khoa học đã tra cứu
+                    COLLECTED_DATA_DIR,
+                    prediction=current_prediction(),
+                    embedding=st.session_state.embedding,
+                    classifier=scheduler
+                )
+                if saved_ok:
+                        st.info(f"Đã lưu ảnh vào thư mục '{saved_label_dir}'.")
+                        st.session_state.image_saved = True
+                        cancel_prefetch(key_prefix)
+                        st.rerun() # Rerun để hiển thị trạng thái đã lưu
+            else:
+                # Trường hợp không tìm thấy mapping (không nên xảy ra nếu config đúng)
+                print(f"APP: Could not find scientific name mapping for confirmed label '{confirmed_short_label}'")
+                st.error(f"Lỗi: Không tìm thấy tên khoa học tương ứng cho '{confirmed_short_label}' để lưu.")
+                # Có thể vẫn rerun để xóa các nút bấm
+                st.rerun()
+
+        # # Lưu ảnh với nhãn đã xác nhận
+        # if not st.session_state.image_saved: # Chỉ lưu 1 lần
+        #      scientific_label_to_save = CLASS_TO_SCIENTIFIC.get(confirmed_short_label)
+        #      # Sử dụng image_data từ session state để lưu
+        #      saved_ok, saved_label_dir = save_feedback_image(
+        #          st.session_state.image_data,             # Dữ liệu ảnh
+        #          st.session_state.original_filename,    # Tên file gốc
+        #          st.session_state.final_label_confirmed, # Nhãn đã xác nhận
+        #          COLLECTED_DATA_DIR
+        #      )
+        #      if saved_ok:
+        #          st.info(f"Đã lưu ảnh vào thư mục '{saved_label_dir}' để cải thiện độ chắc chắn cho model sau này.")
+        #          st.session_state.image_saved = True
+        #          st.rerun() # Rerun để hiển thị trạng thái đã lưu
+
+@st.fragment
+@measured('search')
+def search_section(key_prefix):
+    # Hiển thị giao diện tìm kiếm
+    st.markdown("---")
+    st.subheader("Tìm và xác nhận loài cây:")
+    st.write("Hãy thử tìm tên cây bạn nghĩ đến:")
+
+    # Ô tìm kiếm
+    search_term = st.text_input(
+        "Nhập tên cây (tên khoa học bằng tiếng Anh)",
+        value=st.session_state.inat_search_term,
+        key=f"search_input_{key_prefix}"
+    )
+    # Cập nhật state search term nếu có thay đổi
+    if search_term != st.session_state.inat_search_term:
+        st.session_state.inat_search_term = search_term
+        # Reset gợi ý khi gõ mới để tránh hiển thị gợi ý cũ
+        st.session_state.inat_suggestions = []
+        # Không cần rerun ở đây, rerun sẽ xảy ra khi kiểm tra độ dài
+
+    # Gọi API autocomplete nếu có từ khóa mới và đủ dài
+    last_search_key = f"last_search_{key_prefix}"
+    if search_term != st.session_state.get(last_search_key, ""):
+         if len(search_term) >= 3:
+             with st.spinner("Đang tìm gợi ý..."):
+                  st.session_state.inat_suggestions = search_taxa_autocomplete(search_term)
+         else:
+             # Xóa gợi ý nếu từ khóa quá ngắn
+             if len(search_term) < 3 and st.session_state.inat_suggestions:
+                 st.session_state.inat_suggestions = []
+         st.session_state[last_search_key] = search_term
+         # Chỉ rerun nếu thực sự có thay đổi gợi ý hoặc cần xóa gợi ý (chỉ phần tìm kiếm)
+         rerun_fragment()
+
+    # Hiển thị gợi ý dạng nút bấm
+    if st.session_state.inat_suggestions:
+        st.write("Gợi ý:")
+        num_suggestions = len(st.session_state.inat_suggestions)
+        cols_per_row = 3
+        num_rows = (num_suggestions + cols_per_row - 1) // cols_per_row
+
+        suggestion_list = st.session_state.inat_suggestions
+        idx = 0
+        for r in range(num_rows):
+            cols = st.columns(cols_per_row)
+            for c in range(cols_per_row):
+                if idx < num_suggestions:
+                    suggestion = suggestion_list[idx]
+                    button_label = suggestion['formatted_display']
+                    # Giới hạn độ dài nhãn nút nếu quá dài
+                    max_label_len = 35
+                    if len(button_label) > max_label_len:
+                        button_label = button_label[:max_label_len-3] + "..."
+
+                    if cols[c].button(button_label, key=f"suggestion_button_{suggestion['id']}_{key_prefix}", help=suggestion['formatted_display']):
+                        # Chỉ cập nhật nếu chọn gợi ý khác với cái đang chọn
+                        current_selection_id = st.session_state.selected_inat_suggestion.get('id') if st.session_state.selected_inat_suggestion else None
+                        if current_selection_id != suggestion['id']:
+                            st.session_state.selected_inat_suggestion = suggestion
+                            st.session_state.inat_image_urls = [] # Reset ảnh cũ
+                            # Cập nhật ô search với tên được chọn (tùy chọn UX)
+                            st.session_state.inat_search_term = suggestion['display_name']
+                            st.session_state[last_search_key] = suggestion['display_name'] # Cập nhật last search để tránh gọi API lại
+                            rerun_fragment()
+                    idx += 1
+
+
+    # Hiển thị ảnh tham khảo nếu đã chọn 1 gợi ý
+    if st.session_state.selected_inat_suggestion:
+         selected_sug = st.session_state.selected_inat_suggestion
+         st.markdown("---") # Phân cách với các nút gợi ý
+         st.write(f"Bạn đang xem: **{selected_sug['display_name']} ({selected_sug['scientific_name']})**")
+
+         # Tải ảnh nếu chưa có
+         if not st.session_state.inat_image_urls:
+             print(f"APP: Fetching images for {selected_sug['id']}")
+             with st.spinner("Đang tải ảnh tham khảo..."):
+                  st.session_state.inat_image_urls = get_inat_image_urls(selected_sug.get('id'), count=10)
+                  print(f"APP: Got {len(st.session_state.inat_image_urls)} image URLs")
+
+         # Hiển thị ảnh
+         if st.session_state.inat_image_urls:
+             st.write("Ảnh tham khảo (từ iNaturalist.org):")
+             # Thumbnail nhỏ từ cache đĩa của server (tải + thu nhỏ một lần, dùng chung cho mọi người dùng)
+             thumbnails = get_reference_thumbnails(st.session_state.inat_image_urls)
+             cols = st.columns(5)
+             for i, (img_url, thumbnail) in enumerate(zip(st.session_state.inat_image_urls, thumbnails)):
+                 with cols[i % 5]:
+                     try:
+                         st.image(thumbnail if thumbnail is not None else img_url, width=100)
+                         if thumbnail is not None: # Ảnh theo URL do trình duyệt tải thẳng từ iNaturalist
+                             note_media_bytes(len(thumbnail))
+                     except Exception as img_e:
+                         print(f"APP: Error displaying image {img_url}: {img_e}")
+                         # st.caption("Lỗi ảnh")
+         else:
+              print("APP: No image URLs to display.")
+              st.warning("Không tìm thấy ảnh tham khảo cho loài này.")
+
+         # Nút xác nhận cuối cùng
+         st.markdown("---")
+         confirm_button_label = f"✅ Xác nhận đây là cây: {selected_sug['display_name']}"
+         if len(confirm_button_label) > 50: # Rút gọn nếu quá dài
+             confirm_button_label = f"✅ Xác nhận: {selected_sug['display_name'][:30]}..."
+
+         if st.button(confirm_button_label, key=f"confirm_label_{key_prefix}", help=f"Xác nhận là {selected_sug['display_name']} ({selected_sug['scientific_name']})"):
+              final_label_to_save = selected_sug['scientific_name'] # Dùng tên khoa học để lưu
+              # Lưu ảnh đọc lại từ spool theo băm trong session state
+              saved_ok, saved_label_dir = save_feedback_image(
+                  get_upload_spool().read(st.session_state.upload_hash), # Dữ liệu ảnh
+                  st.session_state.original_filename, # Tên file gốc
+                  final_label_to_save,              # Nhãn cuối cùng
+                  COLLECTED_DATA_DIR,
+                  prediction=current_prediction(),
+                  embedding=st.session_state.embedding,
+                  classifier=scheduler
+              )
+              if saved_ok:
+                  st.success(f"Đã lưu ảnh vào thư mục '{saved_label_dir}' để huấn luyện sau. Cảm ơn bạn!")
+                  st.balloons()
+                  st.session_state.image_saved = True
+                  cancel_prefetch(key_prefix)
+                  st.rerun() # Chạy lại để hiển thị trạng thái cuối
+
+
+@st.fragment(run_every=MODEL_LOADING_POLL_SECONDS)
+def model_loading_notice():
+    """Chờ model ở fragment riêng: chỉ phần này chạy lại theo chu kỳ, model xong thì chạy lại cả trang để bật nút."""
+    if model_loader is not None and model_loader.done:
+        st.rerun()
+    st.info("⏳ Mô hình đang được tải, nút phân loại sẽ sẵn sàng trong giây lát...")
+
+
 # --- Tải Model ---
-model = load_keras_model(MODEL_PATH)
+# Bộ gom lô dùng chung giữa các phiên (chạy model theo lô thay vì từng ảnh)
+if BACKGROUND_MODEL_LOADING:
+    # Model tải trên luồng nền; trang và ô tải ảnh hiện ngay, nút phân loại bật khi model sẵn sàng
+    model_loader = start_model_loading(MODEL_PATH)
+    scheduler = model_loader.result
+    model_failed = model_loader.failed
+    if model_failed:
+        start_model_loading.clear() # Không giữ lần tải lỗi trong cache: lần chạy sau tải lại
+else:
+    model_loader = None
+    scheduler = get_inference_scheduler(MODEL_PATH)
+    model_failed = scheduler is None
+    if model_failed:
+        load_keras_model.clear()
+        get_inference_scheduler.clear()
+if model_failed:
+    st.error(f"Lỗi nghiêm trọng khi tải mô hình tại đường dẫn '{MODEL_PATH}'.")
+# Cache xác suất theo nội dung ảnh (ảnh tải lại không phải chạy model lần nữa)
+prediction_cache = get_prediction_cache(MODEL_PATH)
 
 # --- Sidebar ---
 st.sidebar.header("Tải ảnh lên")
@@ -61,43 +391,73 @@ if uploaded_file is not None:
     # Nếu là file mới, reset toàn bộ trạng thái và tạo key mới
     if st.session_state.file_identifier != current_file_id:
         print(f"New file uploaded: {uploaded_file.name}")
+        cancel_prefetch(st.session_state.widget_key_prefix) # Ảnh cũ không cần dữ liệu tải trước nữa
         st.session_state.file_identifier = current_file_id
         st.session_state.widget_key_prefix = f"file_{uuid.uuid4().hex[:10]}"
-        st.session_state.image_data = uploaded_file.getvalue()
+        # Kiểm tra header trước khi giải mã; ảnh bị từ chối không được giữ trong phiên
+        admission = check_upload(uploaded_file.getvalue())
+        if admission.ok:
+            st.session_state.upload_hash = get_upload_spool().put(admission.image_bytes)
+            st.session_state.display_image = display_thumbnail(admission.image_bytes, UPLOAD_DISPLAY_SIZE)
+        else:
+            st.session_state.upload_hash = None
+            st.session_state.display_image = None
         # Reset tất cả các trạng thái liên quan đến xử lý file cũ
         for key in default_states:
-            if key not in ['file_identifier', 'widget_key_prefix', 'image_data']: # Giữ lại 3 cái này
+            if key not in ['file_identifier', 'widget_key_prefix', 'upload_hash', 'display_image']: # Giữ lại 4 cái này
                 st.session_state[key] = default_states[key]
+        if not admission.ok:
+            st.session_state.upload_error = REJECTION_MESSAGES.get(admission.reason, "Ảnh không hợp lệ.")
         # Đặt lại last_search_term cho key mới
         st.session_state[f"last_search_{st.session_state.widget_key_prefix}"] = ""
 
+    if st.session_state.upload_error:
+        st.error(f"{st.session_state.upload_error} Vui lòng chọn ảnh khác.")
 
 else:
     # Reset nếu không có file
     if st.session_state.file_identifier is not None:
         print("No file uploaded, resetting state.")
+        cancel_prefetch(st.session_state.widget_key_prefix)
         for key in default_states:
             st.session_state[key] = default_states[key]
     st.info('⬆️ Hãy tải lên một hình ảnh ở thanh bên trái để bắt đầu!')
 
 
 # --- Hiển thị và xử lý khi có file và model đã tải ---
-if st.session_state.image_data is not None and model is not None:
+if st.session_state.upload_hash is not None and not model_failed:
     key_prefix = st.session_state.widget_key_prefix # Dùng key prefix đã lưu
 
     # Hiển thị ảnh gốc
-    st.image(st.session_state.image_data, caption='Ảnh bạn đã tải lên.', use_container_width=True)
+    st.image(st.session_state.display_image, caption='Ảnh bạn đã tải lên.', use_container_width=True)
+    note_media_bytes(len(st.session_state.display_image))
 
     # --- Nút Phân loại ---
     if not st.session_state.prediction_done:
-        if st.button('Phân loại cây này!', key=f"classify_{key_prefix}"):
+        if scheduler is None:
+            model_loading_notice()
+        if st.button('Phân loại cây này!', key=f"classify_{key_prefix}", disabled=scheduler is None):
             with st.spinner('Đang phân tích hình ảnh...'):
-                processed_image = preprocess_image(st.session_state.image_data)
-                if processed_image is not None:
+                # Đọc ảnh từ spool qua memory map (không giữ bản sao trong phiên)
+                image_data = get_upload_spool().open(st.session_state.upload_hash)
+                if image_data is None:
+                    st.error("Ảnh đã hết hạn trên máy chủ. Vui lòng tải lại ảnh.")
+                # Khóa spool đã là băm sha256 của ảnh: dùng lại, không băm lại nhiều MB mỗi lần tra cache
+                upload_hash = st.session_state.upload_hash
+                probabilities = prediction_cache.get(image_data, upload_hash) if image_data is not None else None
+                embedding = prediction_cache.get_embedding(image_data, upload_hash) if probabilities is not None else None
+                processed_image = preprocess_image(image_data) if image_data is not None and probabilities is None else None
+                if probabilities is not None or processed_image is not None:
                     try:
-                        prediction = model.predict(processed_image)
-                        pred_index = np.argmax(prediction[0])
-                        pred_conf = np.max(prediction[0]) * 100
+                        if probabilities is None:
+                            probabilities, embeddings = scheduler.predict_with_embeddings(processed_image)
+                            probabilities = probabilities[0]
+                            embedding = embeddings[0] if embeddings is not None else None
+                            prediction_cache.put(image_data, probabilities, embedding, digest=upload_hash)
+                            record_first_prediction()
+                        st.session_state.embedding = embedding
+                        pred_index = np.argmax(probabilities)
+                        pred_conf = np.max(probabilities) * 100
 
                         st.session_state.confidence = pred_conf
                         if 0 <= pred_index < len(CLASS_NAMES):
@@ -105,258 +465,37 @@ if st.session_state.image_data is not None and model is not None:
                         else:
                             st.session_state.predicted_class = "Lớp không xác định"
                         st.session_state.prediction_done = True
+                        # Tải trước dữ liệu tham khảo trong lúc người dùng đọc kết quả
+                        prefetch_reference_data(key_prefix, probabilities)
                         st.rerun() # Chạy lại để hiển thị kết quả
                     except Exception as e:
                         st.error(f"Lỗi trong quá trình dự đoán: {e}")
                         print(f"Prediction error: {e}")
                 else:
-                    # Lỗi đã được hiển thị trong preprocess_image
+                    # Lỗi đã được hiển thị trong preprocess_image (hoặc ảnh đã hết hạn ở trên)
                     pass
 
     # --- Khối chính xử lý SAU KHI ĐÃ PHÂN LOẠI và CHƯA LƯU ---
     if st.session_state.prediction_done and not st.session_state.image_saved:
         st.markdown("---") # Phân cách với ảnh
-        pred_class = st.session_state.predicted_class
-        pred_conf = st.session_state.confidence
-
-        # --- Định nghĩa biến điều kiện ---
-        is_confident_prediction = pred_conf >= CONFIDENCE_THRESHOLD and pred_class in CLASS_NAMES
-        is_known_class_prediction = pred_class in CLASS_NAMES
-
-        # Hiển thị kết quả dự đoán
-        if is_confident_prediction:
-            st.success(f"**Kết quả: Có vẻ là cây {pred_class}!** (Độ chắc chắn: {pred_conf:.1f}%)")
-        elif is_known_class_prediction:
-             st.warning(f"**Hmm, không chắc chắn lắm.** Dự đoán gần nhất: **{pred_class}** (Độ chắc chắn: {pred_conf:.1f}%)")
-        else:
-            st.error("**Không thể nhận diện chắc chắn.**")
-
-        # --- Logic Hỏi Feedback Mới ---
-        st.markdown("---") # Phân cách trước câu hỏi feedback
-        if is_confident_prediction:
-            st.write(f"**Hệ thống dự đoán là {pred_class}. Thông tin này có chính xác không?**")
-            feedback_cols = st.columns(2)
-            with feedback_cols[0]:
-                if st.button("✅ Đúng rồi", key=f"feedback_correct_{key_prefix}"):
-                    st.session_state.user_feedback = 'Correct_Confident'
-                    scientific_label_to_save = CLASS_TO_SCIENTIFIC.get(pred_class)
-
-                    if scientific_label_to_save:
-                        # Gọi hàm lưu ảnh ngay lập tức
-                        print(f"APP: Saving correctly identified image as {scientific_label_to_save}") # DEBUG
-                        saved_ok, saved_label_dir = save_feedback_image(
-                            st.session_state.image_data,
-                            st.session_state.original_filename,
-                            scientific_label_to_save, # <<< Dùng tên khoa học
-                            COLLECTED_DATA_DIR
-                        )
-                        if saved_ok:
-                            # Không cần rerun ngay, chỉ cần cập nhật state và hiển thị thông báo
-                            st.session_state.image_saved = True
-                            # st.rerun() # Có thể không cần rerun ở đây nữa
-                        # else: lỗi đã được hiển thị trong save_feedback_image
-                    else:
-                        print(f"APP: Could not find scientific name mapping for {pred_class}")
-                        st.error(f"Lỗi: Không tìm thấy tên khoa học tương ứng cho '{pred_class}' để lưu.")
-
-                    st.rerun()
-            with feedback_cols[1]:
-                 if st.button("❌ Sai rồi", key=f"feedback_incorrect_{key_prefix}"):
-                    st.session_state.user_feedback = 'Incorrect_Confident'
-                    # Reset tìm kiếm khi bấm sai
-                    st.session_state.inat_search_term = ""
-                    st.session_state.selected_inat_suggestion = None
-                    st.session_state.inat_image_urls = []
-                    st.rerun()
-        else: # Trường hợp không chắc chắn hoặc lớp lạ
-            st.write(f"**Hệ thống không chắc chắn về ảnh này. Bạn có thể giúp xác định không?**")
-            feedback_cols = st.columns(2)
-            with feedback_cols[0]:
-                if is_known_class_prediction: # Chỉ hiện nút này nếu biết lớp dự đoán gần nhất
-                    if st.button(f"✅ Đúng, đó là {pred_class}", key=f"feedback_confirm_unsure_{key_prefix}"):
-                        st.session_state.user_feedback = 'Confirmed_Unsure'
-                        st.session_state.final_label_confirmed = pred_class # Xác nhận nhãn dự đoán ban đầu là đúng
-                        st.rerun()
-                # else: Cột này trống nếu không biết lớp
-            with feedback_cols[1]:
-                 if st.button("🔍 Tìm loại cây khác", key=f"feedback_search_unsure_{key_prefix}"):
-                    st.session_state.user_feedback = 'Search_Unsure'
-                    # Reset tìm kiếm
-                    st.session_state.inat_search_term = ""
-                    st.session_state.selected_inat_suggestion = None
-                    st.session_state.inat_image_urls = []
-                    st.rerun()
-
-        # --- Xử lý dựa trên Feedback ---
-        # Chỉ hiển thị các phần này nếu user_feedback đã được đặt
-        if st.session_state.user_feedback == 'Correct_Confident':
-            if not st.session_state.image_saved:
-             st.success("🎉 Cảm ơn bạn đã xác nhận!")
-
-        elif st.session_state.user_feedback == 'Confirmed_Unsure':
-            confirmed_short_label = st.session_state.final_label_confirmed
-            st.success(f"🎉 Cảm ơn bạn đã xác nhận là **{st.session_state.final_label_confirmed}**!")
-
-            if not st.session_state.image_saved:
-                scientific_label_to_save = CLASS_TO_SCIENTIFIC.get(confirmed_short_label)
-                if scientific_label_to_save:
-                    print(f"APP: Saving unsure but confirmed image as {scientific_label_to_save}") # DEBUG
-                    saved_ok, saved_label_dir = save_feedback_image(
-                        st.session_state.image_data,             # Dữ liệu ảnh
-                        st.session_state.original_filename,    # Tên file gốc
-                        scientific_label_to_save, # <<< Dùng tên khoa học đã tra cứu
-                        COLLECTED_DATA_DIR
-                    )
-                    if saved_ok:
-                            st.info(f"Đã lưu ảnh vào thư mục '{saved_label_dir}'.")
-                            st.session_state.image_saved = True
-                            st.rerun() # Rerun để hiển thị trạng thái đã lưu
-                else:
-                    # Trường hợp không tìm thấy mapping (không nên xảy ra nếu config đúng)
-                    print(f"APP: Could not find scientific name mapping for confirmed label '{confirmed_short_label}'")
-                    st.error(f"Lỗi: Không tìm thấy tên khoa học tương ứng cho '{confirmed_short_label}' để lưu.")
-                    # Có thể vẫn rerun để xóa các nút bấm
-                    st.rerun()
-
-            # # Lưu ảnh với nhãn đã xác nhận
-            # if not st.session_state.image_saved: # Chỉ lưu 1 lần
-            #      scientific_label_to_save = CLASS_TO_SCIENTIFIC.get(confirmed_short_label)
-            #      # Sử dụng image_data từ session state để lưu
-            #      saved_ok, saved_label_dir = save_feedback_image(
-            #          st.session_state.image_data,             # Dữ liệu ảnh
-            #          st.session_state.original_filename,    # Tên file gốc
-            #          st.session_state.final_label_confirmed, # Nhãn đã xác nhận
-            #          COLLECTED_DATA_DIR
-            #      )
-            #      if saved_ok:
-            #          st.info(f"Đã lưu ảnh vào thư mục '{saved_label_dir}' để cải thiện độ chắc chắn cho model sau này.")
-            #          st.session_state.image_saved = True
-            #          st.rerun() # Rerun để hiển thị trạng thái đã lưu
-
-        elif st.session_state.user_feedback in ['Incorrect_Confident', 'Search_Unsure']:
-            # Hiển thị giao diện tìm kiếm
-            st.markdown("---")
-            st.subheader("Tìm và xác nhận loài cây:")
-            st.write("Hãy thử tìm tên cây bạn nghĩ đến:")
-
-            # Ô tìm kiếm
-            search_term = st.text_input(
-                "Nhập tên cây (tên khoa học bằng tiếng Anh)",
-                value=st.session_state.inat_search_term,
-                key=f"search_input_{key_prefix}"
-            )
-            # Cập nhật state search term nếu có thay đổi
-            if search_term != st.session_state.inat_search_term:
-                st.session_state.inat_search_term = search_term
-                # Reset gợi ý khi gõ mới để tránh hiển thị gợi ý cũ
-                st.session_state.inat_suggestions = []
-                # Không cần rerun ở đây, rerun sẽ xảy ra khi kiểm tra độ dài
-
-            # Gọi API autocomplete nếu có từ khóa mới và đủ dài
-            last_search_key = f"last_search_{key_prefix}"
-            if search_term != st.session_state.get(last_search_key, ""):
-                 if len(search_term) >= 3:
-                     with st.spinner("Đang tìm gợi ý..."):
-                          st.session_state.inat_suggestions = search_taxa_autocomplete(search_term)
-                 else:
-                     # Xóa gợi ý nếu từ khóa quá ngắn
-                     if len(search_term) < 3 and st.session_state.inat_suggestions:
-                         st.session_state.inat_suggestions = []
-                 st.session_state[last_search_key] = search_term
-                 # Chỉ rerun nếu thực sự có thay đổi gợi ý hoặc cần xóa gợi ý
-                 st.rerun()
-
-            # Hiển thị gợi ý dạng nút bấm
-            if st.session_state.inat_suggestions:
-                st.write("Gợi ý:")
-                num_suggestions = len(st.session_state.inat_suggestions)
-                cols_per_row = 3
-                num_rows = (num_suggestions + cols_per_row - 1) // cols_per_row
-
-                suggestion_list = st.session_state.inat_suggestions
-                idx = 0
-                for r in range(num_rows):
-                    cols = st.columns(cols_per_row)
-                    for c in range(cols_per_row):
-                        if idx < num_suggestions:
-                            suggestion = suggestion_list[idx]
-                            button_label = suggestion['formatted_display']
-                            # Giới hạn độ dài nhãn nút nếu quá dài
-                            max_label_len = 35
-                            if len(button_label) > max_label_len:
-                                button_label = button_label[:max_label_len-3] + "..."
-
-                            if cols[c].button(button_label, key=f"suggestion_button_{suggestion['id']}_{key_prefix}", help=suggestion['formatted_display']):
-                                # Chỉ cập nhật nếu chọn gợi ý khác với cái đang chọn
-                                current_selection_id = st.session_state.selected_inat_suggestion.get('id') if st.session_state.selected_inat_suggestion else None
-                                if current_selection_id != suggestion['id']:
-                                    st.session_state.selected_inat_suggestion = suggestion
-                                    st.session_state.inat_image_urls = [] # Reset ảnh cũ
-                                    # Cập nhật ô search với tên được chọn (tùy chọn UX)
-                                    st.session_state.inat_search_term = suggestion['display_name']
-                                    st.session_state[last_search_key] = suggestion['display_name'] # Cập nhật last search để tránh gọi API lại
-                                    st.rerun()
-                            idx += 1
-
-
-            # Hiển thị ảnh tham khảo nếu đã chọn 1 gợi ý
-            if st.session_state.selected_inat_suggestion:
-                 selected_sug = st.session_state.selected_inat_suggestion
-                 st.markdown("---") # Phân cách với các nút gợi ý
-                 st.write(f"Bạn đang xem: **{selected_sug['display_name']} ({selected_sug['scientific_name']})**")
-
-                 # Tải ảnh nếu chưa có
-                 if not st.session_state.inat_image_urls:
-                     print(f"APP: Fetching images for {selected_sug['id']}")
-                     with st.spinner("Đang tải ảnh tham khảo..."):
-                          st.session_state.inat_image_urls = get_inat_image_urls(selected_sug.get('id'), count=10)
-                          print(f"APP: Got {len(st.session_state.inat_image_urls)} image URLs")
-
-                 # Hiển thị ảnh
-                 if st.session_state.inat_image_urls:
-                     st.write("Ảnh tham khảo (từ iNaturalist.org):")
-                     cols = st.columns(5)
-                     for i, img_url in enumerate(st.session_state.inat_image_urls):
-                         with cols[i % 5]:
-                             try:
-                                 st.image(img_url, width=100) # Để Streamlit tự xử lý URL
-                             except Exception as img_e:
-                                 print(f"APP: Error displaying image {img_url}: {img_e}")
-                                 # st.caption("Lỗi ảnh")
-                 else:
-                      print("APP: No image URLs to display.")
-                      st.warning("Không tìm thấy ảnh tham khảo cho loài này.")
-
-                 # Nút xác nhận cuối cùng
-                 st.markdown("---")
-                 confirm_button_label = f"✅ Xác nhận đây là cây: {selected_sug['display_name']}"
-                 if len(confirm_button_label) > 50: # Rút gọn nếu quá dài
-                     confirm_button_label = f"✅ Xác nhận: {selected_sug['display_name'][:30]}..."
-
-                 if st.button(confirm_button_label, key=f"confirm_label_{key_prefix}", help=f"Xác nhận là {selected_sug['display_name']} ({selected_sug['scientific_name']})"):
-                      final_label_to_save = selected_sug['scientific_name'] # Dùng tên khoa học để lưu
-                      # Lưu ảnh dùng image_data từ session state
-                      saved_ok, saved_label_dir = save_feedback_image(
-                          st.session_state.image_data,          # Dữ liệu ảnh
-                          st.session_state.original_filename, # Tên file gốc
-                          final_label_to_save,              # Nhãn cuối cùng
-                          COLLECTED_DATA_DIR
-                      )
-                      if saved_ok:
-                          st.success(f"Đã lưu ảnh vào thư mục '{saved_label_dir}' để huấn luyện sau. Cảm ơn bạn!")
-                          st.balloons()
-                          st.session_state.image_saved = True
-                          st.rerun() # Chạy lại để hiển thị trạng thái cuối
-            
-
+        result_section()
+        feedback_section(key_prefix)
+        if st.session_state.user_feedback in ['Incorrect_Confident', 'Search_Unsure']:
+            search_section(key_prefix)
 
 # --- Hiển thị khi đã lưu ảnh thành công ---
 # Khối này chỉ chạy nếu prediction_done=True VÀ image_saved=True
-if st.session_state.image_data is not None and st.session_state.prediction_done and st.session_state.image_saved:
+if st.session_state.upload_hash is not None and st.session_state.prediction_done and st.session_state.image_saved:
      st.markdown("---") # Thêm phân cách
      st.success("Đã lưu phản hồi của bạn. Cảm ơn bạn đã đóng góp!")
      st.info("Bạn có thể tải lên ảnh khác ở thanh bên trái.")
 
+# --- Số liệu hiệu năng ---
+if SHOW_METRICS:
+    with st.sidebar.expander("📊 Số liệu hiệu năng"):
+        st.json(metrics.snapshot())
+
 # --- Chân trang ---
 st.markdown("---")
-st.markdown("Xây dựng bởi Hoàng Anh (HA). Dữ liệu tham khảo từ iNaturalist.org.")
\ No newline at end of file
+st.markdown("Xây dựng bởi Hoàng Anh (HA). Dữ liệu tham khảo từ iNaturalist.org.")
+end_run()
\ No newline at end of file
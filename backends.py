@@ -0,0 +1,79 @@
+# backends.py
+# Các backend suy luận CPU thay cho Keras. Mỗi lớp có `predict(images)` giống `model.predict`
+# để app và bộ gom lô dùng theo cùng một cách.
+
+import threading
+
+import numpy as np
+
+
+class TFLiteModel:
+    """Chạy model .tflite (float16/int8) bằng tflite-runtime, hoặc tf.lite nếu không có runtime."""
+
+    def __init__(self, model_path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.model_path = model_path
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = int(self._input['shape'][0])
+        self._lock = threading.Lock() # Interpreter không an toàn khi gọi từ nhiều luồng
+
+    def _quantize(self, images):
+        scale, zero_point = self._input.get('quantization', (0.0, 0))
+        if self._input['dtype'] == np.float32 or not scale:
+            return images.astype(self._input['dtype'], copy=False)
+        info = np.iinfo(self._input['dtype'])
+        return np.clip(np.round(images / scale + zero_point), info.min, info.max).astype(self._input['dtype'])
+
+    def _dequantize(self, outputs):
+        scale, zero_point = self._output.get('quantization', (0.0, 0))
+        if outputs.dtype == np.float32 or not scale:
+            return outputs.astype(np.float32, copy=False)
+        return (outputs.astype(np.float32) - zero_point) * scale
+
+    def predict(self, images, verbose=0):
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            if len(images) != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input['index'], images.shape)
+                self.interpreter.allocate_tensors()
+                self._input = self.interpreter.get_input_details()[0]
+                self._output = self.interpreter.get_output_details()[0]
+                self._batch_size = len(images)
+            self.interpreter.set_tensor(self._input['index'], self._quantize(images))
+            self.interpreter.invoke()
+            return self._dequantize(self.interpreter.get_tensor(self._output['index']).copy())
+
+
+class OnnxModel:
+    """Chạy model .onnx bằng onnxruntime trên CPU."""
+
+    def __init__(self, model_path, num_threads=None):
+        import onnxruntime as ort
+        self.model_path = model_path
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self._input_name = self.session.get_inputs()[0].name
+
+    def predict(self, images, verbose=0):
+        images = np.asarray(images, dtype=np.float32)
+        return self.session.run(None, {self._input_name: images})[0]
+
+
+def load_backend_model(backend, model_path, num_threads=None):
+    """Tạo model cho backend 'tflite', 'onnx' hoặc 'mmap'."""
+    if backend == 'tflite':
+        return TFLiteModel(model_path, num_threads=num_threads)
+    if backend == 'onnx':
+        return OnnxModel(model_path, num_threads=num_threads)
+    if backend == 'mmap':
+        from mmap_weights import MmapModel
+        return MmapModel(model_path)
+    raise ValueError(f"Unknown inference backend: {backend!r}")
@@ -0,0 +1,58 @@
+# benchmarks/bench_inference.py
+# So sánh độ trễ suy luận 1 ảnh: model.predict() vs hàm đã biên dịch (tf.function).
+# Chạy từ thư mục gốc: python -m benchmarks.bench_inference [--model PATH] [--xla]
+
+import argparse
+import time
+
+import numpy as np
+
+from config import MODEL_PATH
+from inference import INPUT_SHAPE, build_compiled_predict_fn, warm_up
+
+
+def time_calls(fn, images, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn(images)
+        timings.append((time.perf_counter() - started) * 1000.0)
+    return np.array(timings)
+
+
+def describe(name, timings):
+    print(f"{name:<28} p50={np.percentile(timings, 50):8.2f} ms  "
+          f"p95={np.percentile(timings, 95):8.2f} ms  mean={timings.mean():8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark model.predict vs compiled inference")
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--xla', action='store_true', help="Bật jit_compile cho hàm đã biên dịch")
+    args = parser.parse_args()
+
+    from tensorflow.keras.models import load_model
+    model = load_model(args.model, compile=False)
+    images = np.random.uniform(-120, 150, size=(args.batch_size,) + INPUT_SHAPE).astype(np.float32)
+
+    # Làm nóng cả hai đường để không tính thời gian trace lần đầu
+    model.predict(images, verbose=0)
+    compiled = build_compiled_predict_fn(model, jit_compile=args.xla)
+    warm_up(compiled, (args.batch_size,))
+
+    baseline = time_calls(lambda x: model.predict(x, verbose=0), images, args.iterations)
+    fast = time_calls(compiled, images, args.iterations)
+
+    print(f"Batch size {args.batch_size}, {args.iterations} iterations")
+    describe("model.predict", baseline)
+    describe("compiled" + (" (XLA)" if args.xla else ""), fast)
+    print(f"Speed-up (p50): {np.percentile(baseline, 50) / np.percentile(fast, 50):.2f}x")
+
+    max_diff = np.abs(model.predict(images, verbose=0) - compiled(images)).max()
+    print(f"Max |Δprob| between paths: {max_diff:.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# benchmarks/bench_preprocess.py
+# So sánh độ trễ và RSS đỉnh giữa preprocess_image cũ (giải mã toàn bộ rồi resize)
+# và đường giải mã mới (draft/reduce, ghi thẳng vào bộ đệm float32).
+# Chạy từ thư mục gốc: python -m benchmarks.bench_preprocess [--images a.jpg b.png ...]
+
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+
+def legacy_preprocess(image_data):
+    """Bản sao của utils.preprocess_image trước khi tối ưu, dùng làm mốc so sánh."""
+    from PIL import Image
+    from tensorflow.keras.applications.vgg16 import preprocess_input
+    img = Image.open(io.BytesIO(image_data))
+    if img.format == 'GIF':
+        img = img.convert('RGB')
+    img = img.convert('RGB')
+    img = img.resize((224, 224))
+    return preprocess_input(np.expand_dims(np.array(img), axis=0))
+
+
+def fast_preprocess(image_data):
+    """Cùng đường xử lý với utils.preprocess_image hiện tại (không cần Streamlit)."""
+    from tensorflow.keras.applications.vgg16 import preprocess_input
+    from imaging import decode_into
+    buffer = np.empty((1, 224, 224, 3), dtype=np.float32)
+    decode_into(image_data, buffer[0])
+    return preprocess_input(buffer)
+
+
+VARIANTS = {'legacy': legacy_preprocess, 'fast': fast_preprocess}
+
+
+def make_sample_images(directory):
+    """Tạo ảnh lớn giả lập ảnh điện thoại: JPEG 12 MP, PNG 8 MP, GIF động 2 MP."""
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    # Nhiễu mịn (gradient + nhiễu) để nén giống ảnh thật hơn nhiễu trắng
+    def photo(width, height):
+        base = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+        noise = rng.normal(0, 25, size=(height // 8, width // 8, 3)).astype(np.float32)
+        noise = np.kron(noise, np.ones((8, 8, 1), dtype=np.float32))[:height, :width]
+        return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+    paths = []
+    path = os.path.join(directory, 'large_12mp.jpg')
+    photo(4000, 3000).save(path, quality=92)
+    paths.append(path)
+    path = os.path.join(directory, 'large_8mp.png')
+    photo(3264, 2448).save(path)
+    paths.append(path)
+    path = os.path.join(directory, 'animated_2mp.gif')
+    frames = [photo(1600, 1200).convert('P') for _ in range(4)]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100)
+    paths.append(path)
+    return paths
+
+
+def _run_variant(variant, path, iterations):
+    """Chạy trong tiến trình con riêng để RSS đỉnh (ru_maxrss) không bị lẫn giữa các lần đo."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    fn = VARIANTS[variant]
+    # Làm nóng import TensorFlow/Pillow rồi mới lấy mốc RSS
+    fn(_tiny_jpeg())
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn(data)
+        timings.append((time.perf_counter() - started) * 1000.0)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return timings, (peak_kb - baseline_kb) / 1024.0
+
+
+def _tiny_jpeg():
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (32, 32)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark legacy vs fast preprocess_image")
+    parser.add_argument('--images', nargs='*', help="Ảnh dùng để đo (mặc định: tự tạo ảnh lớn)")
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.images or make_sample_images(tmp)
+        ctx = multiprocessing.get_context('spawn')
+        print(f"{'image':<24} {'variant':<8} {'p50 ms':>9} {'p95 ms':>9} {'peak ΔRSS MB':>13}")
+        for path in paths:
+            for variant in VARIANTS:
+                with ctx.Pool(1) as pool:
+                    timings, peak_mb = pool.apply(_run_variant, (variant, path, args.iterations))
+                print(f"{os.path.basename(path)[:24]:<24} {variant:<8} {np.percentile(timings, 50):>9.1f} "
+                      f"{np.percentile(timings, 95):>9.1f} {peak_mb:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
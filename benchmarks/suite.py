@@ -0,0 +1,387 @@
+# benchmarks/suite.py
+# Bộ đo hiệu năng offline cho các đường nóng trong utils.py, so với baseline đã lưu:
+#   preprocess.*  preprocess_image theo kích thước và định dạng ảnh
+#   inference.*   suy luận lô 1/8/32 (model thật nếu có file, không thì model thay thế cùng đầu vào/đầu ra)
+#   inat.*        get_taxon_id / get_inat_image_urls / search_taxa_autocomplete trên máy chủ giả lập cục bộ
+#   feedback.*    save_feedback_image với Storage/Firestore giả lập trong bộ nhớ
+# Mỗi trường hợp chạy trong một tiến trình con riêng; bộ nhớ đỉnh chỉ tính riêng lời gọi được đo.
+# Kết quả (p50/p95/p99, bộ nhớ đỉnh) ghi ra JSON; chỉ số chậm/tốn bộ nhớ hơn baseline quá ngưỡng thì
+# được đánh dấu và lệnh thoát với mã 1 (dùng được trong CI).
+#
+# Chạy từ thư mục gốc:
+#   python -m benchmarks.suite                          # đo tất cả, so với benchmarks/baseline.json
+#   python -m benchmarks.suite --filter 'preprocess.*'  # chỉ một nhóm
+#   python -m benchmarks.suite --update-baseline        # lưu kết quả lần này làm baseline
+
+import argparse
+import contextlib
+import fnmatch
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+
+from config import CLASS_NAMES, MODEL_PATH
+
+IMAGE_SIZES = ((640, 480), (1920, 1440), (4032, 3024))
+IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')
+BATCH_SIZES = (1, 8, 32)
+FEEDBACK_IMAGE_SIZE = (1600, 1200)
+
+# Chỉ số dùng để báo chậm đi và mức chênh tuyệt đối tối thiểu (bỏ qua dao động nhỏ của phép đo).
+# p99 chỉ để tham khảo: với vài chục lần lặp nó gần như là lần chậm nhất.
+GATED_FIELDS = (('p50_ms', 0.5), ('p95_ms', 0.5), ('peak_rss_mb', 8.0))
+
+
+def sample_image(size, image_format, seed=0):
+    """Ảnh giả lập ảnh chụp: mảng màu lớn ngẫu nhiên theo `seed` (băm cảm nhận khác nhau) cộng nhiễu mịn."""
+    from PIL import Image
+    width, height = size
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)).resize(size, Image.BILINEAR)
+    pixels = np.asarray(coarse, dtype=np.float32)
+    pixels += rng.standard_normal((height, width, 3), dtype=np.float32) * 12.0
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    options = {'quality': 90} if image_format in ('JPEG', 'WEBP') else {}
+    if image_format == 'GIF':
+        img = img.convert('P')
+    out = io.BytesIO()
+    img.save(out, format=image_format, **options)
+    return out.getvalue()
+
+
+def _patched(stack, module, **attributes):
+    for name, value in attributes.items():
+        stack.enter_context(mock.patch.object(module, name, value))
+
+
+# --- Các nhóm: context manager trả (hàm được đo, thông tin mô tả trường hợp) ---
+@contextlib.contextmanager
+def _preprocess(calls, size, image_format):
+    import utils
+    data = sample_image(size, image_format)
+    utils.preprocess_image(sample_image((32, 32), image_format)) # Nạp plugin Pillow trước khi lấy mốc RSS
+
+    def run():
+        if utils.preprocess_image(data) is None:
+            raise RuntimeError(f"preprocess_image failed on {image_format} {size}")
+    yield run, {'bytes': len(data)}
+
+
+def _stand_in_model():
+    """Model nhỏ cùng đầu vào (224, 224, 3) và đầu ra softmax len(CLASS_NAMES) như VGG16, khi không có file model."""
+    import tensorflow as tf
+    from inference import INPUT_SHAPE
+    inputs = tf.keras.Input(shape=INPUT_SHAPE)
+    x = tf.keras.layers.Conv2D(16, 3, strides=2, activation='relu')(inputs)
+    x = tf.keras.layers.Conv2D(32, 3, strides=2, activation='relu')(x)
+    x = tf.keras.layers.Conv2D(64, 3, strides=2, activation='relu')(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    x = tf.keras.layers.Dense(128, activation='relu')(x)
+    outputs = tf.keras.layers.Dense(len(CLASS_NAMES), activation='softmax')(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+@contextlib.contextmanager
+def _inference(calls, batch_size, model_path):
+    """Cùng hàm suy luận và chuẩn hóa như build_classifier, gọi trực tiếp (không qua thời gian chờ gom lô)."""
+    import utils
+    from config import INFERENCE_BACKEND, INFERENCE_USE_XLA, SIMILARITY_ENABLED
+    from imaging import normalize
+    from inference import INPUT_SHAPE, build_compiled_predict_fn
+    if os.path.exists(utils.resolve_model_path(model_path)):
+        model = utils.load_model_for_backend(model_path)
+        info = {'model': os.path.basename(utils.resolve_model_path(model_path)), 'backend': INFERENCE_BACKEND}
+    else:
+        model = _stand_in_model()
+        info = {'model': 'stand-in', 'backend': 'keras'}
+    if info['backend'] == 'keras':
+        predict_fn = build_compiled_predict_fn(model, jit_compile=INFERENCE_USE_XLA, with_embeddings=SIMILARITY_ENABLED)
+        info['xla'] = INFERENCE_USE_XLA
+    else:
+        predict_fn = model.predict
+    images = np.random.default_rng(0).uniform(0, 255, size=(batch_size,) + INPUT_SHAPE).astype(np.float32)
+    yield (lambda: predict_fn(normalize(images, 'vgg16'))), info
+
+
+@contextlib.contextmanager
+def _inat(calls, helper):
+    """Gọi hàm gốc (bỏ qua st.cache_data) với client trỏ vào máy chủ giả lập, không cache đĩa."""
+    import utils
+    from inat_client import INatClient
+    from inat_stub import INatStubServer
+    from prefetch import Prefetcher
+    with INatStubServer() as server, contextlib.ExitStack() as stack:
+        client = INatClient(base_url=server.base_url, cache_path=None)
+        prefetcher = Prefetcher(client, None, max_workers=1)
+        _patched(stack, utils, get_inat_client=lambda: client, get_prefetcher=lambda: prefetcher,
+                 get_taxonomy_index=lambda: None)
+        fn = getattr(utils, helper)
+        fn = getattr(fn, '__wrapped__', fn)
+        args = {'get_taxon_id': ('Monstera deliciosa',), 'get_inat_image_urls': (47128,),
+                'search_taxa_autocomplete': ('monst',)}[helper]
+
+        def run():
+            if not fn(*args):
+                raise RuntimeError(f"{helper} returned no result from the stub server")
+        yield run, {}
+
+
+@contextlib.contextmanager
+def _feedback(calls, mode):
+    """save_feedback_image lưu trực tiếp, qua hàng đợi nền, hoặc ảnh trùng (chỉ ghi document liên kết)."""
+    import utils
+    from config import DEDUP_ENABLED, MANIFEST_ENABLED, STORAGE_PROFILE_ENABLED
+    from dedup import HashIndex
+    from feedback_backends import MemoryBackend
+    from feedback_queue import FeedbackUploadQueue
+    from manifest import Manifest
+    count = 1 if mode == 'duplicate' else calls
+    images = [sample_image(FEEDBACK_IMAGE_SIZE, 'JPEG', seed) for seed in range(count)]
+    backend = MemoryBackend()
+    with tempfile.TemporaryDirectory() as tmp, contextlib.ExitStack() as stack:
+        queue = None
+        if mode == 'queued':
+            queue = FeedbackUploadQueue(os.path.join(tmp, 'spool'), backend)
+            stack.callback(queue.stop)
+            stack.callback(queue.wait_idle, 30)
+        # Chỉ mục trùng và manifest ghi vào thư mục tạm, không đụng dữ liệu thật của app
+        dedup_index = HashIndex(os.path.join(tmp, 'hashes.tsv'))
+        manifest = Manifest(os.path.join(tmp, 'manifest')) if MANIFEST_ENABLED else None
+        _patched(stack, utils, FEEDBACK_ASYNC_UPLOAD=queue is not None, get_feedback_backend=lambda: backend,
+                 get_feedback_queue=lambda: queue, get_dedup_index=lambda: dedup_index,
+                 get_manifest=lambda: manifest, get_similarity_index=lambda: None)
+        position = 0
+
+        def run():
+            nonlocal position
+            image_bytes = images[position % len(images)]
+            position += 1
+            saved, _ = utils.save_feedback_image(image_bytes, 'photo.jpg', 'Epipremnum aureum',
+                                                 prediction={'class': 'Epipremnum_aureum', 'confidence': 97.5})
+            if not saved:
+                raise RuntimeError("save_feedback_image failed")
+        yield run, {'bytes': len(images[0]), 'dedup': DEDUP_ENABLED, 'storage_profile': STORAGE_PROFILE_ENABLED,
+                    'manifest': MANIFEST_ENABLED}
+
+
+GROUPS = {'preprocess': _preprocess, 'inference': _inference, 'inat': _inat, 'feedback': _feedback}
+
+
+def _build_cases():
+    cases = {}
+    for width, height in IMAGE_SIZES:
+        for image_format in IMAGE_FORMATS:
+            cases[f"preprocess.{image_format.lower()}.{width}x{height}"] = (
+                'preprocess', {'size': (width, height), 'image_format': image_format})
+    for batch_size in BATCH_SIZES:
+        cases[f"inference.batch{batch_size}"] = ('inference', {'batch_size': batch_size})
+    for helper, short in (('get_taxon_id', 'taxon_id'), ('get_inat_image_urls', 'image_urls'),
+                          ('search_taxa_autocomplete', 'autocomplete')):
+        cases[f"inat.{short}"] = ('inat', {'helper': helper})
+    for mode in ('direct', 'queued', 'duplicate'):
+        cases[f"feedback.{mode}"] = ('feedback', {'mode': mode})
+    return cases
+
+
+CASES = _build_cases()
+
+
+# --- Đo ---
+def _status_mb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024.0 # kB
+    raise OSError(f"{field} not in /proc/self/status")
+
+
+def _release_free_memory():
+    """Trả bộ nhớ đã giải phóng của các lần gọi trước về hệ điều hành (glibc), để lần gọi được đo
+    phải cấp phát lại thay vì dùng lại vùng nhớ vẫn nằm trong RSS."""
+    import ctypes
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass # Không phải glibc (musl...): số đo có thể thấp hơn thực tế
+
+
+def _start_peak_memory():
+    """Bắt đầu đo bộ nhớ đỉnh của riêng các lần gọi (không tính phần chuẩn bị); trả cách đo đang dùng.
+
+    Linux: đặt lại mốc RSS đỉnh (VmHWM) của tiến trình về RSS hiện tại, tính cả bộ nhớ C của Pillow/TensorFlow.
+    Nơi khác: tracemalloc (chỉ thấy cấp phát Python/NumPy).
+    """
+    try:
+        _release_free_memory()
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return 'rss', _status_mb('VmRSS')
+    except OSError:
+        import tracemalloc
+        tracemalloc.start()
+        return 'tracemalloc', 0.0
+
+
+def _peak_memory_mb(method, baseline_mb):
+    if method == 'rss':
+        return _status_mb('VmHWM') - baseline_mb
+    import tracemalloc
+    peak = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+    tracemalloc.stop()
+    return peak
+
+
+def _run_case(name, iterations, warmup, model_path):
+    """Chạy trong tiến trình con: chuẩn bị, làm nóng, đo `iterations` lần gọi, rồi đo bộ nhớ đỉnh của một lần gọi."""
+    group, params = CASES[name]
+    if group == 'inference':
+        params = dict(params, model_path=model_path)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        with GROUPS[group](warmup + iterations + 1, **params) as (fn, info):
+            for _ in range(warmup):
+                fn()
+            timings = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                fn()
+                timings.append((time.perf_counter() - started) * 1000.0)
+            # Đo bộ nhớ ở lần gọi riêng sau phần đo thời gian (tracemalloc làm chậm lời gọi);
+            # mốc lấy ngay trước lời gọi nên ảnh mẫu, model... tạo lúc chuẩn bị không bị tính
+            method, baseline_mb = _start_peak_memory()
+            fn()
+            peak_mb = _peak_memory_mb(method, baseline_mb)
+    timings = np.array(timings)
+    return {
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p95_ms': round(float(np.percentile(timings, 95)), 3),
+        'p99_ms': round(float(np.percentile(timings, 99)), 3),
+        'mean_ms': round(float(timings.mean()), 3),
+        'peak_rss_mb': round(peak_mb, 1),
+        'iterations': iterations,
+        'info': dict(info, memory=method), # Hai cách đo cho số khác nhau: không so với baseline đo kiểu kia
+    }
+
+
+def run_suite(names, iterations, warmup, model_path):
+    ctx = multiprocessing.get_context('spawn')
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'cpu_count': os.cpu_count()},
+        'cases': {},
+    }
+    for name in names:
+        with ctx.Pool(1) as pool:
+            try:
+                results['cases'][name] = pool.apply(_run_case, (name, iterations, warmup, model_path))
+            except Exception as e:
+                results['cases'][name] = {'error': f"{type(e).__name__}: {e}"}
+        _print_case(name, results['cases'][name])
+    return results
+
+
+# --- So sánh với baseline ---
+def compare(results, baseline, tolerance):
+    """(hồi quy, trường hợp không so được). Hồi quy: (tên, chỉ số, baseline, hiện tại) vượt quá `tolerance`."""
+    regressions, skipped = [], []
+    for name, current in results['cases'].items():
+        previous = baseline.get('cases', {}).get(name)
+        if previous is None or 'error' in current or 'error' in previous:
+            continue
+        if previous.get('info') != current.get('info'):
+            skipped.append(name) # Khác model / cấu hình / kích thước ảnh: số liệu không cùng mốc
+            continue
+        for field, min_delta in GATED_FIELDS:
+            before, after = previous[field], current[field]
+            if after > before * (1.0 + tolerance) and after - before > min_delta:
+                regressions.append((name, field, before, after))
+    return regressions, skipped
+
+
+def _print_case(name, result):
+    if 'error' in result:
+        print(f"{name:<32} ERROR {result['error']}")
+        return
+    print(f"{name:<32} {result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f} {result['p99_ms']:>10.2f} "
+          f"{result['peak_rss_mb']:>10.1f}")
+
+
+def _write_json(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks for the preprocessing, inference and "
+                                                 "feedback hot paths, compared against a stored baseline")
+    parser.add_argument('--filter', nargs='*', default=['*'], help="Mẫu tên trường hợp, ví dụ 'inference.*'")
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--model', default=MODEL_PATH, help="Model thật (không có thì dùng model thay thế)")
+    parser.add_argument('--output', default='benchmarks/results.json')
+    parser.add_argument('--baseline', default='benchmarks/baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.15, help="Mức chậm đi cho phép so với baseline (0.15 = 15%%)")
+    parser.add_argument('--update-baseline', action='store_true', help="Lưu kết quả lần này làm baseline")
+    parser.add_argument('--list', action='store_true', help="Chỉ liệt kê các trường hợp")
+    args = parser.parse_args()
+
+    names = [name for name in CASES if any(fnmatch.fnmatch(name, pattern) for pattern in args.filter)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+    if not names:
+        print(f"No benchmark matches {args.filter}")
+        return 2
+
+    print(f"{'case':<32} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'peak MB':>10}")
+    results = run_suite(names, args.iterations, args.warmup, args.model)
+    _write_json(args.output, results)
+    print(f"Results written to {args.output}")
+
+    if args.update_baseline:
+        # Giữ số liệu cũ của các trường hợp không chạy lần này (khi dùng --filter)
+        baseline = {'cases': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+        baseline.update({key: value for key, value in results.items() if key != 'cases'})
+        baseline['cases'].update({name: result for name, result in results['cases'].items() if 'error' not in result})
+        _write_json(args.baseline, baseline)
+        print(f"Baseline updated: {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to create one")
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('machine') != results['machine']:
+        print(f"Warning: baseline was recorded on a different machine ({baseline.get('machine')})")
+    regressions, skipped = compare(results, baseline, args.tolerance)
+    for name in skipped:
+        print(f"SKIPPED {name}: case info differs from baseline (model, config or input changed)")
+    for name, field, before, after in regressions:
+        change = f" ({(after / before - 1.0) * 100.0:+.0f}%)" if before else ""
+        print(f"REGRESSION {name} {field}: {before:.2f} -> {after:.2f}{change}")
+    if regressions:
+        return 1
+    print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
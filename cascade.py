@@ -0,0 +1,253 @@
+# cascade.py
+# Phân loại hai tầng theo độ tin cậy: một model nhỏ (MobileNetV2 / EfficientNetB0, cùng CLASS_NAMES)
+# chạy trước trên CPU; chỉ những ảnh mà model nhỏ chưa đủ chắc (< CASCADE_THRESHOLD) mới được
+# chuyển lên VGG16. Mỗi tầng giữ phép chuẩn hóa đầu vào riêng (imaging.normalize), áp lên cùng
+# một ảnh đã giải mã (RGB 0..255, float32).
+#
+# Huấn luyện model nhỏ từ shard đã xuất (export_dataset.py):
+#   python cascade.py train --data datasets/feedback --output plant_classifier_mobilenetv2.h5
+# Báo cáo tỷ lệ chuyển tầng, độ trễ trung bình và mức đồng thuận với VGG16 trên thư mục <nhãn>/<file>:
+#   python cascade.py report --input collected_data --thresholds 80 90 95 99
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from backends import load_backend_model
+from config import (CLASS_NAMES, MODEL_PATH, CASCADE_MODEL_PATH, CASCADE_PREPROCESSING, CASCADE_THRESHOLD,
+                    INFERENCE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS, INFERENCE_NUM_THREADS)
+from imaging import decode_into, normalize
+from inference import INPUT_SHAPE, BatchingScheduler, build_compiled_predict_fn, warm_up
+from metrics import metrics
+
+# Kiến trúc model nhỏ: tên lớp trong tf.keras.applications và phép chuẩn hóa tương ứng
+ARCHITECTURES = {
+    'mobilenet_v2': ('MobileNetV2', 'mobilenet_v2'),
+    'efficientnet_b0': ('EfficientNetB0', 'efficientnet'),
+}
+
+
+def load_predict_fn(model_path, num_threads=None):
+    """Hàm suy luận cho một file model, chọn backend theo đuôi file (.tflite, .onnx, còn lại là Keras)."""
+    extension = os.path.splitext(model_path)[1].lower()
+    if extension in ('.tflite', '.onnx'):
+        return load_backend_model(extension[1:], model_path, num_threads=num_threads).predict
+    from tensorflow.keras.models import load_model
+    return build_compiled_predict_fn(load_model(model_path, compile=False))
+
+
+class Stage:
+    """Một tầng phân loại: bộ gom lô suy luận + phép chuẩn hóa đầu vào của model đó.
+
+    Nhận ảnh đã giải mã (N, 224, 224, 3) RGB 0..255; cùng giao diện `predict` /
+    `predict_with_embeddings` với BatchingScheduler nên app dùng được một tầng hay cả cascade.
+    """
+
+    def __init__(self, scheduler, preprocessing='vgg16'):
+        self.scheduler = scheduler
+        self.preprocessing = preprocessing
+
+    def predict_with_embeddings(self, images, timeout=None):
+        return self.scheduler.predict_with_embeddings(normalize(images, self.preprocessing), timeout=timeout)
+
+    def predict(self, images, timeout=None):
+        return self.predict_with_embeddings(images, timeout=timeout)[0]
+
+    def embed(self, images, timeout=None):
+        return self.predict_with_embeddings(images, timeout=timeout)[1]
+
+
+def load_small_stage(model_path=CASCADE_MODEL_PATH, preprocessing=CASCADE_PREPROCESSING,
+                     num_threads=INFERENCE_NUM_THREADS, max_batch_size=INFERENCE_MAX_BATCH_SIZE):
+    """Tải, làm nóng và kiểm tra model nhỏ (số lớp phải khớp CLASS_NAMES), bọc trong bộ gom lô riêng."""
+    predict_fn = load_predict_fn(model_path, num_threads=num_threads)
+    warm_up(predict_fn)
+    num_classes = np.asarray(predict_fn(np.zeros((1,) + INPUT_SHAPE, dtype=np.float32))).shape[-1]
+    if num_classes != len(CLASS_NAMES):
+        raise ValueError(f"Cascade model {model_path} has {num_classes} classes, expected {len(CLASS_NAMES)}")
+    print(f"CASCADE: Small model {model_path} ready (preprocessing: {preprocessing})")
+    scheduler = BatchingScheduler(predict_fn, max_batch_size=max_batch_size,
+                                  max_wait_ms=INFERENCE_MAX_WAIT_MS, name='small')
+    return Stage(scheduler, preprocessing)
+
+
+class Cascade:
+    """Chạy tầng nhỏ cho mọi ảnh, chỉ gửi lên tầng lớn những ảnh có độ tin cậy < `threshold` (%).
+
+    Embedding (cho chỉ mục ảnh tương tự) đến từ tầng lớn: trả danh sách theo từng ảnh, None cho
+    ảnh tầng nhỏ đã tự xử lý (tính bù bằng `embed` khi cần, ví dụ lúc lưu phản hồi).
+    """
+
+    def __init__(self, small, large, threshold=CASCADE_THRESHOLD):
+        self.small = small
+        self.large = large
+        self.threshold = threshold
+
+    def predict_with_embeddings(self, images, timeout=None):
+        images = np.asarray(images, dtype=np.float32)
+        if images.ndim == 3:
+            images = np.expand_dims(images, axis=0)
+        started = time.perf_counter()
+        probabilities = np.array(self.small.predict(images, timeout=timeout), dtype=np.float32)
+        metrics.observe('cascade.small_ms', (time.perf_counter() - started) * 1000.0)
+        escalate = probabilities.max(axis=1) * 100.0 < self.threshold
+        metrics.incr('cascade.images', len(images))
+        embeddings = [None] * len(images)
+        if escalate.any():
+            metrics.incr('cascade.escalated', int(escalate.sum()))
+            started = time.perf_counter()
+            large_probabilities, large_embeddings = self.large.predict_with_embeddings(images[escalate], timeout=timeout)
+            metrics.observe('cascade.large_ms', (time.perf_counter() - started) * 1000.0)
+            probabilities[escalate] = large_probabilities
+            if large_embeddings is None:
+                embeddings = None # Tầng lớn không trả embedding (tắt SIMILARITY_ENABLED)
+            else:
+                for row, embedding in zip(np.flatnonzero(escalate), large_embeddings):
+                    embeddings[row] = embedding
+        metrics.set_gauge('cascade.escalation_rate',
+                          metrics.counter('cascade.escalated') / metrics.counter('cascade.images'))
+        return probabilities, embeddings
+
+    def predict(self, images, timeout=None):
+        return self.predict_with_embeddings(images, timeout=timeout)[0]
+
+    def embed(self, images, timeout=None):
+        """Embedding tầng lớn cho ảnh, kể cả ảnh mà tầng nhỏ đã đủ chắc."""
+        return self.large.embed(images, timeout=timeout)
+
+
+# --- Báo cáo ---
+def report(samples, fetch, small_fn, small_preprocessing, large_fn, thresholds):
+    """Chạy cả hai model trên từng ảnh (lô 1, như trong app) rồi mô phỏng cascade ở từng ngưỡng."""
+    from export_dataset import label_indices
+    from manifest import shard_name
+    labels = label_indices()
+    buffer = np.empty((1,) + INPUT_SHAPE, dtype=np.float32)
+    rows = []
+    for sample in samples:
+        try:
+            decode_into(fetch(sample['storage_path']), buffer[0])
+        except Exception as e:
+            print(f"CASCADE: Skipping {sample['storage_path']}: {e}")
+            continue
+        started = time.perf_counter()
+        small = np.asarray(small_fn(normalize(buffer, small_preprocessing)))[0]
+        small_ms = (time.perf_counter() - started) * 1000.0
+        started = time.perf_counter()
+        large = np.asarray(large_fn(normalize(buffer, 'vgg16')))[0]
+        large_ms = (time.perf_counter() - started) * 1000.0
+        rows.append((small.max() * 100.0, small.argmax(), small_ms, large.argmax(), large_ms,
+                     labels.get(shard_name(sample['label']).lower(), -1)))
+    if not rows:
+        print("CASCADE: No images to report on")
+        return []
+    small_conf, small_pred, small_ms, large_pred, large_ms, truth = (np.array(column) for column in zip(*rows))
+    labelled = truth >= 0
+
+    print(f"CASCADE: {len(rows)} images, VGG16 only: {large_ms.mean():.1f} ms/image"
+          + (f", accuracy {np.mean(large_pred[labelled] == truth[labelled]) * 100:.1f}%" if labelled.any() else ""))
+    print(f"{'threshold':>9s} {'escalated':>9s} {'avg ms':>8s} {'speedup':>8s} {'agree':>7s} {'accuracy':>9s}")
+    results = []
+    for threshold in thresholds:
+        escalated = small_conf < threshold
+        prediction = np.where(escalated, large_pred, small_pred)
+        latency = small_ms + np.where(escalated, large_ms, 0.0)
+        result = {'threshold': threshold, 'escalation_rate': float(escalated.mean()),
+                  'avg_latency_ms': float(latency.mean()), 'vgg16_latency_ms': float(large_ms.mean()),
+                  'agreement': float(np.mean(prediction == large_pred)),
+                  'accuracy': float(np.mean(prediction[labelled] == truth[labelled])) if labelled.any() else None}
+        results.append(result)
+        accuracy = f"{result['accuracy'] * 100:8.1f}%" if result['accuracy'] is not None else f"{'-':>9s}"
+        print(f"{threshold:9.1f} {result['escalation_rate'] * 100:8.1f}% {result['avg_latency_ms']:8.1f} "
+              f"{large_ms.mean() / result['avg_latency_ms']:7.2f}x {result['agreement'] * 100:6.1f}% {accuracy}")
+    return results
+
+
+# --- Huấn luyện model nhỏ ---
+def _load_shards(data_dir):
+    with open(os.path.join(data_dir, 'index.json'), encoding='utf-8') as f:
+        index = json.load(f)
+    if index['class_names'] != CLASS_NAMES:
+        raise ValueError(f"Shards in {data_dir} were exported with different CLASS_NAMES")
+    images, labels = [], []
+    for shard in index['shards']:
+        prefix = os.path.join(data_dir, shard['name'])
+        images.append(np.load(prefix + '.images.npy', mmap_mode='r'))
+        labels.append(np.load(prefix + '.labels.npy'))
+    return images, labels
+
+
+def train(data_dir, output_path, architecture='mobilenet_v2', epochs=5, batch_size=32, validation_fraction=0.1):
+    """Khớp đầu phân loại trên base ImageNet đóng băng, đọc ảnh trực tiếp từ shard memory-map."""
+    import tensorflow as tf
+    class_name, preprocessing = ARCHITECTURES[architecture]
+    images, labels = _load_shards(data_dir)
+    positions = np.array([(s, r) for s, shard_labels in enumerate(labels) for r in range(len(shard_labels))])
+    if len(positions) == 0:
+        raise ValueError(f"No exported samples in {data_dir}")
+    rng = np.random.default_rng(0)
+    rng.shuffle(positions)
+    n_validation = int(len(positions) * validation_fraction)
+    validation, training = positions[:n_validation], positions[n_validation:]
+
+    def batches(rows, shuffle):
+        def generate():
+            order = rng.permutation(len(rows)) if shuffle else np.arange(len(rows))
+            for start in range(0, len(rows), batch_size):
+                chosen = rows[order[start:start + batch_size]]
+                batch = np.stack([images[s][r] for s, r in chosen])
+                yield normalize(batch, preprocessing), np.array([labels[s][r] for s, r in chosen], dtype=np.int32)
+        signature = (tf.TensorSpec((None,) + INPUT_SHAPE, tf.float32), tf.TensorSpec((None,), tf.int32))
+        return tf.data.Dataset.from_generator(generate, output_signature=signature).prefetch(2)
+
+    base = getattr(tf.keras.applications, class_name)(input_shape=INPUT_SHAPE, include_top=False,
+                                                      weights='imagenet', pooling='avg')
+    base.trainable = False
+    model = tf.keras.Sequential([base, tf.keras.layers.Dropout(0.2),
+                                 tf.keras.layers.Dense(len(CLASS_NAMES), activation='softmax')])
+    model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    print(f"CASCADE: Training {class_name} head on {len(training)} images ({len(validation)} for validation)")
+    model.fit(batches(training, shuffle=True), epochs=epochs,
+              validation_data=batches(validation, shuffle=False) if len(validation) else None)
+    model.save(output_path)
+    print(f"CASCADE: Saved {output_path}; set CASCADE_MODEL_PATH = '{output_path}' "
+          f"and CASCADE_PREPROCESSING = '{preprocessing}' in config.py")
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confidence-gated small-model -> VGG16 cascade")
+    sub = parser.add_subparsers(dest='command', required=True)
+    train_parser = sub.add_parser('train', help="Huấn luyện model nhỏ từ shard đã xuất")
+    train_parser.add_argument('--data', required=True, help="Thư mục shard của export_dataset.py")
+    train_parser.add_argument('--output', default=CASCADE_MODEL_PATH)
+    train_parser.add_argument('--architecture', choices=sorted(ARCHITECTURES), default='mobilenet_v2')
+    train_parser.add_argument('--epochs', type=int, default=5)
+    train_parser.add_argument('--batch-size', type=int, default=32)
+    report_parser = sub.add_parser('report', help="Tỷ lệ chuyển tầng, độ trễ và mức đồng thuận với VGG16")
+    report_parser.add_argument('--input', required=True, help="Thư mục ảnh <nhãn>/<file>")
+    report_parser.add_argument('--small-model', default=CASCADE_MODEL_PATH)
+    report_parser.add_argument('--preprocessing', default=CASCADE_PREPROCESSING)
+    report_parser.add_argument('--large-model', default=MODEL_PATH)
+    report_parser.add_argument('--thresholds', type=float, nargs='+', default=[CASCADE_THRESHOLD])
+    report_parser.add_argument('--limit', type=int, default=None, help="Số ảnh tối đa")
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train(args.data, args.output, args.architecture, args.epochs, args.batch_size)
+    else:
+        from itertools import islice
+        from export_dataset import read_file, samples_from_directory
+        small_fn = load_predict_fn(args.small_model, num_threads=INFERENCE_NUM_THREADS)
+        large_fn = load_predict_fn(args.large_model, num_threads=INFERENCE_NUM_THREADS)
+        warm_up(small_fn)
+        warm_up(large_fn)
+        samples = islice(samples_from_directory(args.input), args.limit)
+        report(samples, read_file, small_fn, args.preprocessing, large_fn, args.thresholds)
+
+
+if __name__ == '__main__':
+    main()
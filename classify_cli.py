@@ -0,0 +1,266 @@
+# classify_cli.py
+# Phân loại hàng loạt ngoài giao diện: thư mục, glob, file tar/zip -> JSONL hoặc CSV.
+# Đường ống dạng generator có giới hạn số việc đang chờ (bộ nhớ không tăng theo số file):
+#   liệt kê ảnh -> kiểm tra + giải mã + resize trên process pool (cùng cách với app)
+#   -> suy luận theo lô lớn trên model đã tải -> ghi kết quả ngay.
+# Chạy lại với cùng file kết quả thì bỏ qua các ảnh đã phân loại.
+#
+# Ví dụ:
+#   python classify_cli.py photos/ 'more/**/*.jpg' batch.tar.gz --output labels.jsonl
+#   python classify_cli.py archive.zip --output labels.csv --batch-size 128 --workers 8
+
+import argparse
+import csv
+import glob
+import json
+import os
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from admission import check_upload
+from config import CLASS_NAMES, CLASS_TO_SCIENTIFIC, MODEL_PATH
+from export_dataset import IMAGE_EXTENSIONS
+from imaging import decode_to_array
+from inference import INPUT_SHAPE
+from prediction_cache import image_hash
+
+FIELDS = ('path', 'class', 'scientific_name', 'confidence', 'sha256', 'error')
+ARCHIVE_SEPARATOR = '::' # Khóa của ảnh trong archive: <archive>::<tên trong archive>
+
+
+# --- Nguồn ảnh ---
+def _is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _is_archive(path):
+    return path.lower().endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.zip'))
+
+
+def _iter_archive(path, skip):
+    """(khóa, bytes) của các ảnh trong tar (đọc tuần tự, kể cả nén) hoặc zip."""
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                key = f"{path}{ARCHIVE_SEPARATOR}{info.filename}"
+                if not info.is_dir() and _is_image(info.filename) and key not in skip:
+                    yield key, archive.read(info)
+        return
+    with tarfile.open(path, 'r|*') as archive: # Chế độ stream: không cần seek, không giữ danh sách thành viên
+        for member in archive:
+            key = f"{path}{ARCHIVE_SEPARATOR}{member.name}"
+            if member.isfile() and _is_image(member.name) and key not in skip:
+                yield key, archive.extractfile(member).read()
+
+
+def _covered(real_path, roots):
+    """`real_path` là một gốc đã xử lý hoặc nằm trong thư mục gốc đã xử lý (duyệt lên các thư mục cha)."""
+    while True:
+        if real_path in roots:
+            return True
+        parent = os.path.dirname(real_path)
+        if parent == real_path:
+            return False
+        real_path = parent
+
+
+def _iter_spec(spec, skip, roots):
+    paths = [spec] if os.path.exists(spec) else sorted(glob.iglob(spec, recursive=True))
+    for path in paths:
+        real_path = os.path.realpath(path)
+        if _covered(real_path, roots):
+            continue # Đã nằm trong thư mục / file của đầu vào trước (glob và thư mục chồng nhau)
+        roots.add(real_path)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    if _is_image(name) and file_path not in skip:
+                        yield file_path, file_path
+        elif _is_archive(path):
+            yield from _iter_archive(path, skip)
+        elif _is_image(path) and path not in skip:
+            yield path, path
+
+
+def iter_inputs(inputs, skip=frozenset()):
+    """(khóa, đường dẫn hoặc bytes) cho mọi ảnh trong các thư mục, glob và archive.
+
+    Bỏ qua khóa trong `skip` (ảnh đã có trong file kết quả). Đầu vào chồng nhau được loại trùng theo
+    đường dẫn thật của các gốc (thư mục, file, archive) khớp từng đầu vào, không nhớ từng ảnh đã trả,
+    nên bộ nhớ không tăng theo số file.
+    """
+    roots = set()
+    for spec in inputs:
+        yield from _iter_spec(spec, skip, roots)
+
+
+def _decode(source):
+    """Chạy trong process con: (băm sha256, mảng uint8 (224, 224, 3)) hoặc (băm, thông báo lỗi)."""
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            source = f.read()
+    digest = image_hash(source)
+    admission = check_upload(source) # Cùng kiểm tra và thu nhỏ JPEG lớn như khi tải lên app
+    if not admission.ok:
+        return digest, f"rejected: {admission.reason}"
+    try:
+        return digest, decode_to_array(admission.image_bytes, INPUT_SHAPE[1::-1])
+    except Exception as e:
+        return digest, f"decode: {e}"
+
+
+# --- Kết quả ---
+def _truncate_partial_line(path):
+    """Cắt dòng cuối chưa ghi xong (nếu lần trước bị dừng giữa chừng) để ghi nối tiếp được."""
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        position = size
+        while position > 0:
+            step = min(65536, position)
+            f.seek(position - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if position != size:
+            f.truncate(position)
+
+
+def load_done(path, output_format):
+    """Khóa các ảnh đã có trong file kết quả."""
+    if not os.path.exists(path):
+        return set()
+    _truncate_partial_line(path)
+    with open(path, encoding='utf-8', newline='') as f:
+        if output_format == 'csv':
+            return {row['path'] for row in csv.DictReader(f)}
+        return {json.loads(line)['path'] for line in f if line.strip()}
+
+
+class ResultWriter:
+    def __init__(self, path, output_format, append):
+        self.format = output_format
+        write_header = not (append and os.path.exists(path) and os.path.getsize(path) > 0)
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8', newline='')
+        if output_format == 'csv':
+            self._csv = csv.DictWriter(self._file, fieldnames=FIELDS)
+            if write_header:
+                self._csv.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            if self.format == 'csv':
+                self._csv.writerow(row)
+            else:
+                self._file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# --- Đường ống ---
+def run(inputs, output_path, classifier, output_format='jsonl', batch_size=64, workers=None, max_pending=None,
+        resume=True, report_every=10.0):
+    done = load_done(output_path, output_format) if resume else set()
+    if done:
+        print(f"CLASSIFY: Resuming, {len(done)} image(s) already in {output_path}")
+    writer = ResultWriter(output_path, output_format, append=resume)
+    max_pending = max_pending or batch_size * 4
+    buffer = np.empty((batch_size,) + INPUT_SHAPE, dtype=np.float32)
+    batch = []
+    total = failed = 0
+    started = last_report = time.perf_counter()
+
+    def flush():
+        nonlocal total
+        if not batch:
+            return
+        probabilities = classifier.predict(buffer[:len(batch)])
+        rows = []
+        for (key, digest), row in zip(batch, probabilities):
+            index = int(np.argmax(row))
+            rows.append({'path': key, 'class': CLASS_NAMES[index],
+                         'scientific_name': CLASS_TO_SCIENTIFIC.get(CLASS_NAMES[index]),
+                         'confidence': round(float(row[index]) * 100.0, 3), 'sha256': digest, 'error': None})
+        writer.write(rows)
+        total += len(rows)
+        batch.clear()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            pending = deque()
+            sources = iter_inputs(inputs, done)
+            exhausted = False
+            while pending or not exhausted:
+                # Giữ tối đa `max_pending` ảnh đang giải mã: liệt kê/đọc file chỉ chạy trước ngần ấy
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        key, source = next(sources)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append((key, pool.submit(_decode, source)))
+                if not pending:
+                    break
+                key, future = pending.popleft()
+                try:
+                    digest, decoded = future.result()
+                except Exception as e:
+                    digest, decoded = None, f"decode: {e}"
+                if isinstance(decoded, str):
+                    # Ảnh lỗi vẫn được ghi lại (có lý do) để lần chạy tiếp không thử lại
+                    failed += 1
+                    total += 1
+                    writer.write([{'path': key, 'class': None, 'scientific_name': None, 'confidence': None,
+                                   'sha256': digest, 'error': decoded}])
+                else:
+                    buffer[len(batch)] = decoded
+                    batch.append((key, digest))
+                if len(batch) == batch_size:
+                    flush()
+                now = time.perf_counter()
+                if now - last_report >= report_every:
+                    last_report = now
+                    print(f"CLASSIFY: {total} images, {total / (now - started):.1f} img/s, {failed} failed")
+            flush()
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - started
+    print(f"CLASSIFY: Done, {total} images in {elapsed:.1f} s "
+          f"({total / elapsed if elapsed else 0:.1f} img/s, {failed} failed) -> {output_path}")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify folders, globs and tar/zip archives of plant photos")
+    parser.add_argument('inputs', nargs='+', help="Thư mục, mẫu glob ('**' đệ quy) hoặc file .tar/.tar.gz/.zip")
+    parser.add_argument('--output', required=True, help="File kết quả .jsonl hoặc .csv")
+    parser.add_argument('--format', choices=('jsonl', 'csv'), help="Mặc định theo đuôi file kết quả")
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=None, help="Số process giải mã (mặc định: số CPU)")
+    parser.add_argument('--max-pending', type=int, default=None, help="Số ảnh đang giải mã tối đa (mặc định: 4 lô)")
+    parser.add_argument('--overwrite', action='store_true', help="Ghi đè file kết quả thay vì chạy tiếp")
+    args = parser.parse_args()
+
+    output_format = args.format or ('csv' if args.output.lower().endswith('.csv') else 'jsonl')
+    from utils import build_classifier, load_model_for_backend
+    # Bộ gom lô của CLI nhận nguyên lô --batch-size (bộ gom của app giới hạn INFERENCE_MAX_BATCH_SIZE)
+    classifier = build_classifier(load_model_for_backend(args.model), max_batch_size=args.batch_size)
+    run(args.inputs, args.output, classifier, output_format, args.batch_size, args.workers, args.max_pending,
+        resume=not args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
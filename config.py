@@ -1,8 +1,21 @@
 # config.py
 
+import json
+import os
+
 # Đường dẫn tới file model
 MODEL_PATH = 'best_plant_classifier_vgg16.h5'
 
+# Backend suy luận: 'keras' (file .h5 gốc), 'tflite' hoặc 'onnx' (tạo bằng export_model.py),
+# 'mmap' (trọng số mmap dùng chung giữa các worker, tạo bằng mmap_weights.py)
+INFERENCE_BACKEND = 'keras'
+# Đường dẫn các file model đã xuất, dùng khi INFERENCE_BACKEND khác 'keras'
+TFLITE_MODEL_PATH = 'best_plant_classifier_vgg16_int8.tflite'
+ONNX_MODEL_PATH = 'best_plant_classifier_vgg16.onnx'
+MMAP_WEIGHTS_PATH = 'best_plant_classifier_vgg16.weights.bin'
+# Số luồng CPU cho backend tflite/onnx (None = để runtime tự chọn)
+INFERENCE_NUM_THREADS = None
+
 # Danh sách tên lớp model có thể nhận diện (PHẢI KHỚP THỨ TỰ HUẤN LUYỆN)
 # Ví dụ: ['Pothos', 'Monstera'] - Bạn cần xác nhận lại!
 CLASS_NAMES = ['Epipremnum Aureum', 'Monstera Deliciosa']
@@ -12,14 +25,145 @@ CLASS_TO_SCIENTIFIC = {
     'Monstera Deliciosa': 'Monstera_deliciosa'
 }
 
+# Mapping lớp đi kèm model huấn luyện lại bằng feature_store.py (<model>.classes.json); nếu có thì thay cho danh sách trên
+CLASS_MAPPING_PATH = os.path.splitext(MODEL_PATH)[0] + '.classes.json'
+if os.path.exists(CLASS_MAPPING_PATH):
+    with open(CLASS_MAPPING_PATH, encoding='utf-8') as _mapping_file:
+        _mapping = json.load(_mapping_file)
+    CLASS_NAMES = _mapping['CLASS_NAMES']
+    CLASS_TO_SCIENTIFIC = _mapping['CLASS_TO_SCIENTIFIC']
+
 # Ngưỡng tin cậy để coi là chắc chắn (%)
 CONFIDENCE_THRESHOLD = 90.0 # Sử dụng dạng phần trăm
+# Cascade: model nhỏ chuyển ảnh lên VGG16 khi độ chắc chắn của nó thấp hơn mức này (%).
+# Nên >= CONFIDENCE_THRESHOLD để mọi kết quả "không chắc chắn" đều đã qua VGG16.
+CASCADE_THRESHOLD = 95.0
+
+# Tải và làm nóng model trên luồng nền: giao diện hiện ngay, nút "Phân loại" bật khi model sẵn sàng
+BACKGROUND_MODEL_LOADING = True
+MODEL_LOADING_POLL_SECONDS = 1.0 # Chu kỳ fragment chờ model kiểm tra lại (chỉ fragment đó chạy lại)
+
+# --- Kiểm tra ảnh tải lên (chỉ đọc header, trước khi giải mã) ---
+UPLOAD_MAX_BYTES = 20 * 1024 * 1024 # 20 MB
+UPLOAD_ALLOWED_FORMATS = ('JPEG', 'PNG', 'GIF')
+UPLOAD_MAX_PIXELS = 40_000_000 # Tổng số điểm ảnh tối đa (40 MP)
+UPLOAD_MAX_DIMENSION = 8000 # Cạnh dài tối đa (px) với PNG/GIF
+UPLOAD_MAX_FRAMES = 200 # Số khung hình tối đa của ảnh động
+# JPEG có cạnh dài hơn mức này được thu nhỏ ngay (giải mã draft) thay vì giữ nguyên bản gốc
+UPLOAD_DOWNSCALE_LONG_SIDE = 2048
+# Ảnh tải lên được ghi một lần vào spool trên đĩa (khóa theo băm nội dung, dùng chung giữa các phiên/worker);
+# phiên chỉ giữ băm + thumbnail hiển thị
+UPLOAD_SPOOL_DIR = 'spool/uploads'
+UPLOAD_SPOOL_MAX_BYTES = 2 * 1024 * 1024 * 1024 # Tổng dung lượng tối đa (2 GB), vượt quá thì xóa ảnh lâu không dùng
+UPLOAD_SPOOL_TTL = 6 * 3600 # Giây; ảnh không được dùng lâu hơn thì bị xóa
+UPLOAD_DISPLAY_SIZE = 640 # Cạnh dài (px) của thumbnail hiển thị ảnh tải lên
+
+# --- Gom lô suy luận (micro-batching) giữa các phiên ---
+# Số ảnh tối đa trong một lô gửi vào model
+INFERENCE_MAX_BATCH_SIZE = 8
+# Thời gian chờ tối đa (ms) để gom lô trước khi chạy model
+INFERENCE_MAX_WAIT_MS = 15
+# Biên dịch hàm suy luận bằng XLA (jit_compile); tắt nếu máy không hỗ trợ tốt
+INFERENCE_USE_XLA = False
+
+# --- Phân loại hai tầng (cascade) ---
+# Model nhỏ chạy trước trên CPU; VGG16 chỉ chạy khi model nhỏ không đủ chắc (xem CASCADE_THRESHOLD)
+CASCADE_ENABLED = False
+# Model nhỏ cùng CLASS_NAMES (.h5/.keras, .tflite hoặc .onnx), tạo bằng `python cascade.py train`
+CASCADE_MODEL_PATH = 'plant_classifier_mobilenetv2.h5'
+# Chuẩn hóa đầu vào của model nhỏ: 'mobilenet_v2', 'efficientnet' hoặc 'vgg16'
+CASCADE_PREPROCESSING = 'mobilenet_v2'
+
+# --- Dịch vụ HTTP phân loại (api_server.py) ---
+API_HOST = '0.0.0.0'
+API_PORT = 8080
+API_WORKERS = 8 # Số yêu cầu giải mã + suy luận cùng lúc (kết nối keep-alive rảnh không tính)
+API_MAX_PENDING = 32 # Số yêu cầu chờ lượt suy luận tối đa; vượt quá thì trả 503
+API_MAX_IMAGES = 16 # Số ảnh tối đa trong một yêu cầu
+API_KEEPALIVE_TIMEOUT = 15 # Giây; kết nối rảnh lâu hơn thì bị đóng
+
+# --- Cache kết quả dự đoán theo nội dung ảnh ---
+# Số ảnh giữ trong bộ nhớ (LRU); 0 để tắt cache
+PREDICTION_CACHE_SIZE = 1024
+# File SQLite cho tầng cache trên đĩa, dùng chung giữa các worker (None = chỉ dùng bộ nhớ)
+PREDICTION_CACHE_DB = None # Ví dụ: 'cache/predictions.sqlite'
+
+# Hiển thị số liệu hiệu năng (hàng đợi, kích thước lô...) ở thanh bên
+SHOW_METRICS = False
 
 # Thư mục lưu dữ liệu người dùng phản hồi
 COLLECTED_DATA_DIR = "collected_data"
 
+# --- Lưu phản hồi ---
+FIREBASE_STORAGE_BUCKET = "plantidentify-ca6f7.firebasestorage.app"
+# 'firebase' (Storage + Firestore) hoặc 'local' (thư mục giả lập cùng giao diện, để chạy thử/kiểm thử)
+FEEDBACK_BACKEND = 'firebase'
+FEEDBACK_LOCAL_DIR = 'local_backend'
+# Tải lên ở nền qua spool trên đĩa (nút bấm trả về ngay, không mất ảnh khi lỗi mạng tạm thời)
+FEEDBACK_ASYNC_UPLOAD = True
+FEEDBACK_SPOOL_DIR = 'spool/feedback'
+FEEDBACK_UPLOAD_WORKERS = 2 # Số ảnh tải lên đồng thời
+FEEDBACK_MAX_RETRIES = 5
+FEEDBACK_DEAD_LETTER_DIR = 'spool/feedback_dead_letter' # Việc thất bại quá số lần thử (xem / đưa lại bằng tay)
+FEEDBACK_BATCH_SIZE = 50 # Số document tối đa mỗi batch write Firestore
+FEEDBACK_FLUSH_INTERVAL = 2.0 # Giây chờ gom batch trước khi ghi
+# Chống trùng: ảnh có băm cảm nhận cách ảnh đã lưu <= DEDUP_MAX_DISTANCE bit chỉ được liên kết, không tải lại
+DEDUP_ENABLED = True
+DEDUP_HASH = 'dhash' # 'dhash' hoặc 'phash'
+DEDUP_MAX_DISTANCE = 6 # Ngưỡng Hamming trên 64 bit
+DEDUP_INDEX_PATH = 'cache/feedback_hashes.tsv'
+# Định dạng lưu: mã hóa lại một lần, giới hạn cạnh dài, bỏ EXIF (False = lưu nguyên ảnh như khi tải lên)
+STORAGE_PROFILE_ENABLED = True
+STORAGE_MAX_LONG_SIDE = 512 # Đủ cho đầu vào 224x224 kèm crop/augment khi huấn luyện lại
+STORAGE_FORMAT = 'JPEG' # 'JPEG' hoặc 'WEBP'
+STORAGE_QUALITY = 88
+# Tầng lưu ảnh gốc nguyên vẹn (không mất mát) dưới tiền tố riêng, tắt mặc định
+STORAGE_KEEP_ORIGINAL = False
+STORAGE_ORIGINALS_DIR = 'collected_originals'
+# Manifest ghi nối của dữ liệu đã thu thập (đọc theo nhãn/thời gian mà không liệt kê bucket)
+MANIFEST_ENABLED = True
+MANIFEST_DIR = 'manifest'
+MANIFEST_SEGMENT_MAX_BYTES = 4 * 1024 * 1024 # Segment live lớn hơn thì mở segment mới
+MANIFEST_COMPACT_MAX_RECORDS = 50000 # Số bản ghi tối đa mỗi segment đã gộp
+# Kho đặc trưng VGG16 (embedding sau GAP) của ảnh phản hồi, dùng để huấn luyện lại phần đầu phân loại
+FEATURE_STORE_DIR = 'feature_store'
+# Gợi ý loài từ ảnh tương tự đã được người dùng xác nhận (embedding lớp áp chót, chỉ backend 'keras')
+SIMILARITY_ENABLED = True
+SIMILARITY_INDEX_DIR = 'similarity_index'
+SIMILARITY_N_LISTS = 64 # Số cụm IVF (chỉ chia cụm khi có >= 32 vector mỗi cụm)
+SIMILARITY_N_PROBE = 8 # Số cụm được quét mỗi truy vấn
+SIMILARITY_TOP_K = 20 # Số láng giềng dùng để xếp hạng loài
+SIMILARITY_MIN_SCORE = 0.5 # Độ giống cosine tối thiểu của một láng giềng
+
 # --- iNaturalist Config ---
 INAT_API_BASE_URL = "https://api.inaturalist.org/v1"
+# Cache SQLite trên đĩa cho kết quả iNaturalist, dùng chung giữa các worker (None = tắt)
+INAT_CACHE_DB = 'cache/inat.sqlite'
+# Thời gian sống (giây) của cache theo endpoint
+INAT_CACHE_TTLS = {
+    'taxa': 7 * 24 * 3600, # Tên khoa học -> ID hầu như không đổi
+    'observations': 24 * 3600,
+    'taxa/autocomplete': 24 * 3600,
+}
+# Số request đồng thời tối đa tới iNaturalist và số lần thử lại khi gặp 429/5xx
+INAT_MAX_CONCURRENCY = 4
+INAT_MAX_RETRIES = 3
+# --- Cache thumbnail ảnh tham khảo iNaturalist ---
+REFERENCE_THUMB_DIR = 'cache/thumbnails'
+REFERENCE_THUMB_MAX_BYTES = 200 * 1024 * 1024 # Tổng dung lượng tối đa (200 MB)
+REFERENCE_THUMB_SIZE = 200 # Cạnh dài thumbnail (px), gấp đôi 100 px hiển thị cho màn hình mật độ cao
+REFERENCE_THUMB_FORMAT = 'WEBP' # 'WEBP' hoặc 'JPEG'
+REFERENCE_FETCH_WORKERS = 8 # Số luồng tải ảnh song song
+REFERENCE_FETCH_MAX_BYTES = 5 * 1024 * 1024 # Ảnh gốc lớn hơn bị bỏ (ảnh 'medium' thường < 200 KB)
+# --- Tải trước dữ liệu tham khảo sau khi dự đoán ---
+PREFETCH_ENABLED = True
+PREFETCH_TOP_K = 2 # Số lớp dự đoán cao nhất được tải trước
+PREFETCH_COMMON_SPECIES = True # Tải trước cả các loài trong SUGGESTED_SPECIES_VN
+PREFETCH_THUMBNAILS = True # Tải trước cả thumbnail ảnh tham khảo
+PREFETCH_WORKERS = 2
+PREFETCH_MAX_PENDING = 16 # Số việc chờ tối đa (vượt quá thì bỏ qua)
+# Snapshot taxa cho chỉ mục tìm loài cục bộ (tạo/làm mới bằng: python taxonomy_index.py refresh)
+TAXA_SNAPSHOT_PATH = 'data/taxa_snapshot.json'
 
 # Dictionary các loài gợi ý ban đầu (có thể không cần dùng nhiều nếu có autocomplete)
 # Dùng để tham khảo hoặc gợi ý nhanh nếu muốn
@@ -0,0 +1,214 @@
+# dedup.py
+# Chống trùng ảnh phản hồi bằng băm cảm nhận (dHash/pHash 64 bit): ảnh giống hệt hoặc gần giống
+# (khác nhau <= ngưỡng Hamming) với ảnh đã thu thập thì chỉ được liên kết tới document cũ, không tải lại.
+#
+# Chỉ mục băm là file văn bản chỉ ghi nối (mỗi dòng: băm hex, doc id, đường dẫn Storage), được nạp vào
+# BK-tree trong bộ nhớ; các tiến trình khác cùng ghi file được đọc bù phần đuôi mới trước mỗi lần tra.
+#
+# Dựng lại chỉ mục từ metadata đã lưu: python dedup.py rebuild [--backend local]
+# Kiểm tra một ảnh:                     python dedup.py check anh.jpg
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from config import DEDUP_HASH, DEDUP_INDEX_PATH, DEDUP_MAX_DISTANCE
+from imaging import open_image
+from metrics import metrics
+
+
+def dhash(img):
+    """Difference hash: so sánh độ sáng các điểm ảnh liền kề trên ảnh xám 9x8."""
+    pixels = np.asarray(img.convert('L').resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    return _pack_bits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * k * (2 * np.arange(n)[None, :] + 1) / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def phash(img):
+    """Perceptual hash: DCT 2 chiều của ảnh xám 32x32, lấy 8x8 tần số thấp so với trung vị."""
+    pixels = np.asarray(img.convert('L').resize((32, 32), Image.Resampling.LANCZOS), dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8]
+    return _pack_bits(low > np.median(low.ravel()[1:])) # Bỏ thành phần DC khi tính trung vị
+
+
+def _pack_bits(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+HASH_FUNCTIONS = {'dhash': dhash, 'phash': phash}
+
+
+def image_hash(image_bytes, method=DEDUP_HASH):
+    """Băm cảm nhận 64 bit của ảnh (int). Giải mã ở độ phân giải nhỏ vì chỉ cần ảnh thu nhỏ."""
+    return HASH_FUNCTIONS[method](open_image(image_bytes, (64, 64)))
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """BK-tree theo khoảng cách Hamming: tra các băm trong bán kính r mà không quét toàn bộ."""
+
+    def __init__(self):
+        self._root = None # [băm, giá trị, {khoảng cách: nút con}]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value_hash, value):
+        self._size += 1
+        if self._root is None:
+            self._root = [value_hash, value, {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value_hash, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value_hash, value, {}]
+                return
+            node = child
+
+    def search(self, query_hash, max_distance):
+        """Danh sách (khoảng cách, băm, giá trị) trong bán kính `max_distance`, gần nhất trước."""
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node_hash, value, children = stack.pop()
+            distance = hamming(query_hash, node_hash)
+            if distance <= max_distance:
+                results.append((distance, node_hash, value))
+            # Bất đẳng thức tam giác: chỉ nhánh con có khoảng cách trong [d - r, d + r] mới có thể khớp
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+class HashIndex:
+    """Chỉ mục băm ảnh đã thu thập, bền vững trong file chỉ ghi nối `path`."""
+
+    def __init__(self, path=DEDUP_INDEX_PATH, max_distance=DEDUP_MAX_DISTANCE):
+        self.path = path
+        self.max_distance = max_distance
+        self._tree = BKTree()
+        self._offset = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        started = time.perf_counter()
+        with self._lock:
+            self._load_tail()
+        print(f"DEDUP: Loaded {len(self._tree)} hashes in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def __len__(self):
+        return len(self._tree)
+
+    def _load_tail(self):
+        """Đọc các dòng mới được ghi thêm (bởi tiến trình này hoặc tiến trình khác) từ lần đọc trước."""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1 # Bỏ qua dòng cuối đang ghi dở
+        for line in data[:end].decode('utf-8').splitlines():
+            parts = line.split('\t')
+            if len(parts) < 3:
+                continue
+            try:
+                self._tree.add(int(parts[0], 16), (parts[1], parts[2]))
+            except ValueError:
+                continue
+        self._offset += end
+        metrics.set_gauge('dedup.index_size', len(self._tree))
+
+    def find(self, value_hash):
+        """(doc id, đường dẫn Storage, khoảng cách) của ảnh gần nhất trong ngưỡng, hoặc None."""
+        started = time.perf_counter()
+        with self._lock:
+            self._load_tail()
+            matches = self._tree.search(value_hash, self.max_distance)
+        metrics.observe('dedup.lookup_ms', (time.perf_counter() - started) * 1000.0,
+                        buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 50))
+        if not matches:
+            return None
+        distance, _, (doc_id, storage_path) = matches[0]
+        return doc_id, storage_path, distance
+
+    def add(self, value_hash, doc_id, storage_path):
+        line = f"{value_hash:016x}\t{doc_id}\t{storage_path}\n".encode('utf-8')
+        with self._lock:
+            self._load_tail()
+            # O_APPEND: mỗi lần ghi một dòng trọn vẹn, an toàn khi nhiều tiến trình cùng ghi
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            self._load_tail()
+
+
+def rebuild(backend, path=DEDUP_INDEX_PATH):
+    """Dựng lại chỉ mục từ trường `image_hash` trong metadata đã lưu (bỏ qua document chỉ là liên kết)."""
+    tmp_path = path + '.tmp'
+    count = 0
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for doc_id, data in backend.iter_documents():
+            if data.get('image_hash') and not data.get('duplicate_of'):
+                f.write(f"{data['image_hash']}\t{doc_id}\t{data.get('storage_path', '')}\n")
+                count += 1
+    os.replace(tmp_path, path)
+    print(f"DEDUP: Wrote {count} hashes to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Perceptual-hash index of collected feedback images")
+    sub = parser.add_subparsers(dest='command', required=True)
+    rebuild_parser = sub.add_parser('rebuild', help="Dựng lại chỉ mục từ metadata phản hồi")
+    rebuild_parser.add_argument('--backend', choices=('firebase', 'local'), default='firebase')
+    rebuild_parser.add_argument('--local-dir', default='local_backend')
+    check_parser = sub.add_parser('check', help="Tìm ảnh đã thu thập gần giống một ảnh")
+    check_parser.add_argument('image')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        from feedback_backends import FirebaseBackend, LocalBackend
+        if args.backend == 'local':
+            backend = LocalBackend(args.local_dir)
+        else:
+            import firebase_admin
+            firebase_admin.initialize_app() # Dùng GOOGLE_APPLICATION_CREDENTIALS
+            backend = FirebaseBackend()
+        rebuild(backend)
+        return
+    with open(args.image, 'rb') as f:
+        value_hash = image_hash(f.read())
+    match = HashIndex().find(value_hash)
+    print(f"{DEDUP_HASH}: {value_hash:016x}")
+    print(f"Duplicate of {match[0]} ({match[1]}), distance {match[2]}" if match else "No duplicate found")
+
+
+if __name__ == '__main__':
+    main()
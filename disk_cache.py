@@ -0,0 +1,75 @@
+# disk_cache.py
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class SQLiteCache:
+    """Cache key/value trên đĩa (SQLite, chế độ WAL), dùng chung được giữa nhiều tiến trình.
+
+    Giá trị là bytes; mỗi mục có thể có thời hạn (ttl, giây). Mục hết hạn bị bỏ qua khi đọc.
+    """
+
+    def __init__(self, path, table='cache'):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table!r}")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            f"(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+        )
+        conn.commit()
+
+    def _connection(self):
+        # Mỗi luồng một kết nối riêng; sqlite3 không cho dùng chung kết nối giữa các luồng
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        conn = self._connection()
+        conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, sqlite3.Binary(value), expires_at),
+        )
+        conn.commit()
+
+    def delete(self, key):
+        conn = self._connection()
+        conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        conn.commit()
+
+    def purge(self, keep_prefix=None):
+        """Xóa các mục hết hạn, và (nếu có) mọi mục không bắt đầu bằng `keep_prefix`."""
+        conn = self._connection()
+        conn.execute(f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        if keep_prefix is not None:
+            conn.execute(f"DELETE FROM {self.table} WHERE substr(key, 1, ?) != ?", (len(keep_prefix), keep_prefix))
+        conn.commit()
+
+    def __len__(self):
+        return self._connection().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
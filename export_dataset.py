@@ -0,0 +1,244 @@
+# export_dataset.py
+# Xuất dữ liệu phản hồi đã thu thập thành shard huấn luyện đã tiền xử lý, dạng streaming:
+# tải ảnh song song (thread pool), giải mã + resize trên process pool bằng đúng hàm của imaging
+# (cùng phép tính với preprocess_image, trước bước preprocess_input), ghi thẳng vào shard .npy
+# memory-map được. Nhãn là chỉ số trong CLASS_NAMES. Chạy lại thì chỉ xử lý mẫu mới.
+#
+# Mỗi shard gồm:
+#   shard-00000.images.npy   uint8 (N, 224, 224, 3)   (np.load(..., mmap_mode='r'))
+#   shard-00000.labels.npy   int16 (N,)
+#   shard-00000.jsonl        doc id, đường dẫn, nhãn, băm của từng dòng
+# Khi huấn luyện: ảnh float32 rồi qua tensorflow.keras.applications.vgg16.preprocess_input.
+#
+# Ví dụ:
+#   python export_dataset.py --source manifest --backend firebase --output datasets/feedback
+#   python export_dataset.py --source directory --input collected_data --output datasets/feedback
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from config import CLASS_NAMES, CLASS_TO_SCIENTIFIC, MANIFEST_DIR
+from imaging import TARGET_SIZE, decode_to_array
+from manifest import Manifest, shard_name
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+def label_indices():
+    """Tên lớp / tên khoa học (đã chuẩn hóa như đường dẫn Storage) -> chỉ số trong CLASS_NAMES."""
+    mapping = {}
+    for index, class_name in enumerate(CLASS_NAMES):
+        for name in (class_name, CLASS_TO_SCIENTIFIC.get(class_name)):
+            if name:
+                mapping[shard_name(name).lower()] = index
+    return mapping
+
+
+# --- Nguồn mẫu ---
+def samples_from_manifest(manifest_dir=MANIFEST_DIR):
+    manifest = Manifest(manifest_dir)
+    for label in manifest.labels():
+        for record in manifest.samples_for_label(label):
+            if not record.get('duplicate_of'):
+                yield record
+
+
+def samples_from_documents(backend):
+    for doc_id, data in backend.iter_documents():
+        if data.get('storage_path') and not data.get('duplicate_of'):
+            yield dict(data, doc_id=doc_id)
+
+
+def samples_from_directory(directory):
+    """Thư mục theo bố cục Storage: <thư mục>/<nhãn>/<file>; doc id là đường dẫn tương đối."""
+    for label in sorted(os.listdir(directory)):
+        label_dir = os.path.join(directory, label)
+        if not os.path.isdir(label_dir):
+            continue
+        for name in sorted(os.listdir(label_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield {'doc_id': f"{label}/{name}", 'label': label, 'storage_path': os.path.join(label_dir, name)}
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _decode(image_bytes):
+    """Chạy trong process con: bytes -> mảng uint8 (cao, rộng, 3)."""
+    return decode_to_array(image_bytes, TARGET_SIZE)
+
+
+class DatasetExporter:
+    """Ghi shard kích thước cố định vào `output_dir`; `exported.txt` ghi lại doc id đã xuất để chạy tiếp."""
+
+    def __init__(self, output_dir, fetch, shard_size=1024, download_workers=16, decode_workers=None):
+        self.output_dir = output_dir
+        self.fetch = fetch # storage_path -> bytes
+        self.shard_size = shard_size
+        self.download_workers = download_workers
+        self.decode_workers = decode_workers or os.cpu_count()
+        self.labels = label_indices()
+        os.makedirs(output_dir, exist_ok=True)
+        self._exported_path = os.path.join(output_dir, 'exported.txt')
+        self._index_path = os.path.join(output_dir, 'index.json')
+
+    def _load_state(self):
+        exported = set()
+        if os.path.exists(self._exported_path):
+            with open(self._exported_path, encoding='utf-8') as f:
+                exported = {line.rstrip('\n') for line in f if line.endswith('\n')}
+        index = {'class_names': CLASS_NAMES, 'image_shape': [TARGET_SIZE[1], TARGET_SIZE[0], 3], 'shards': []}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, encoding='utf-8') as f:
+                index = json.load(f)
+            if index['class_names'] != CLASS_NAMES:
+                raise ValueError("CLASS_NAMES changed since the last export; use a new output directory")
+        return exported, index
+
+    def _fetch(self, sample):
+        try:
+            return self.fetch(sample['storage_path'])
+        except Exception as e:
+            print(f"EXPORT: Download failed for {sample['storage_path']}: {e}")
+            return None
+
+    def run(self, samples):
+        exported, index = self._load_state()
+        skipped_labels = {}
+        todo = []
+        for sample in samples:
+            if sample['doc_id'] in exported:
+                continue
+            label_index = self.labels.get(shard_name(sample['label']).lower())
+            if label_index is None:
+                skipped_labels[sample['label']] = skipped_labels.get(sample['label'], 0) + 1
+                continue
+            todo.append(dict(sample, label_index=label_index))
+        for label, count in sorted(skipped_labels.items()):
+            print(f"EXPORT: Skipping {count} sample(s) with label '{label}' (not in CLASS_NAMES)")
+        print(f"EXPORT: {len(exported)} already exported, {len(todo)} new sample(s)")
+
+        started = time.perf_counter()
+        written = failed = 0
+        chunks = [todo[i:i + self.shard_size] for i in range(0, len(todo), self.shard_size)]
+        with ThreadPoolExecutor(max_workers=self.download_workers) as downloads, \
+                ProcessPoolExecutor(max_workers=self.decode_workers) as decoders:
+            # Tải trước shard kế tiếp trong lúc giải mã shard hiện tại (bộ nhớ giữ tối đa ~2 shard bytes)
+            next_blobs = [downloads.submit(self._fetch, s) for s in chunks[0]] if chunks else []
+            for position, chunk in enumerate(chunks):
+                blobs = next_blobs
+                if position + 1 < len(chunks):
+                    next_blobs = [downloads.submit(self._fetch, s) for s in chunks[position + 1]]
+                decoded = []
+                for sample, blob in zip(chunk, blobs):
+                    data = blob.result()
+                    decoded.append((sample, decoders.submit(_decode, data) if data is not None else None))
+                shard_index = len(index['shards'])
+                count, errors = self._write_shard(shard_index, decoded, index, exported)
+                written += count
+                failed += errors
+                elapsed = time.perf_counter() - started
+                print(f"EXPORT: Shard {shard_index}: {count} images "
+                      f"({written / elapsed:.1f} img/s overall, {failed} failed)")
+        print(f"EXPORT: Wrote {written} images in {time.perf_counter() - started:.1f} s to {self.output_dir}")
+        return written
+
+    def _write_shard(self, shard_index, decoded, index, exported):
+        prefix = os.path.join(self.output_dir, f"shard-{shard_index:05d}")
+        height, width = TARGET_SIZE[1], TARGET_SIZE[0]
+        images = np.lib.format.open_memmap(prefix + '.images.npy.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(decoded), height, width, 3))
+        labels = np.empty(len(decoded), dtype=np.int16)
+        rows = []
+        errors = 0
+        for sample, future in decoded:
+            try:
+                if future is None:
+                    raise ValueError("download failed")
+                images[len(rows)] = future.result()
+            except Exception as e:
+                print(f"EXPORT: Skipping {sample['storage_path']}: {e}")
+                errors += 1
+                continue
+            labels[len(rows)] = sample['label_index']
+            rows.append({'doc_id': sample['doc_id'], 'storage_path': sample['storage_path'],
+                         'label': sample['label'], 'label_index': sample['label_index'],
+                         'image_hash': sample.get('image_hash')})
+        count = len(rows)
+        images.flush()
+        del images
+        if count == 0:
+            os.remove(prefix + '.images.npy.tmp')
+            return 0, errors
+        if count < len(decoded):
+            # Cắt bỏ các dòng lỗi ở cuối (chỉ viết lại header + phần dữ liệu hợp lệ)
+            valid = np.load(prefix + '.images.npy.tmp', mmap_mode='r')[:count]
+            trimmed = np.lib.format.open_memmap(prefix + '.images.npy.trim', mode='w+', dtype=np.uint8, shape=valid.shape)
+            trimmed[:] = valid
+            trimmed.flush()
+            del trimmed, valid
+            os.replace(prefix + '.images.npy.trim', prefix + '.images.npy.tmp')
+        np.save(prefix + '.labels.npy', labels[:count])
+        with open(prefix + '.jsonl', 'w', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        os.replace(prefix + '.images.npy.tmp', prefix + '.images.npy') # Shard chỉ "có" khi ảnh đã ghi xong
+
+        # Cập nhật trạng thái sau cùng: nếu dừng trước bước này, lần sau xuất lại shard này (ghi đè)
+        index['shards'].append({'name': os.path.basename(prefix), 'count': count,
+                                'label_counts': np.bincount(labels[:count], minlength=len(CLASS_NAMES)).tolist()})
+        tmp_index = self._index_path + '.tmp'
+        with open(tmp_index, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_index, self._index_path)
+        with open(self._exported_path, 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(row['doc_id'] + '\n')
+                exported.add(row['doc_id'])
+        return count, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export collected feedback images to preprocessed training shards")
+    parser.add_argument('--source', choices=('manifest', 'firestore', 'directory'), default='manifest',
+                        help="Danh sách mẫu: manifest cục bộ, collection Firestore, hoặc thư mục <nhãn>/<file>")
+    parser.add_argument('--backend', choices=('firebase', 'local'), default='firebase',
+                        help="Nơi tải ảnh về (với --source manifest/firestore)")
+    parser.add_argument('--local-dir', default='local_backend')
+    parser.add_argument('--manifest-dir', default=MANIFEST_DIR)
+    parser.add_argument('--input', help="Thư mục ảnh (với --source directory)")
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--shard-size', type=int, default=1024)
+    parser.add_argument('--download-workers', type=int, default=16)
+    parser.add_argument('--decode-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.source == 'directory':
+        if not args.input:
+            parser.error("--input is required with --source directory")
+        samples, fetch = samples_from_directory(args.input), read_file
+    else:
+        from feedback_backends import FirebaseBackend, LocalBackend
+        if args.backend == 'local':
+            backend = LocalBackend(args.local_dir)
+        else:
+            import firebase_admin
+            from config import FIREBASE_STORAGE_BUCKET
+            firebase_admin.initialize_app(options={'storageBucket': FIREBASE_STORAGE_BUCKET}) # Dùng GOOGLE_APPLICATION_CREDENTIALS
+            backend = FirebaseBackend()
+        samples = samples_from_manifest(args.manifest_dir) if args.source == 'manifest' else samples_from_documents(backend)
+        fetch = backend.download
+
+    exporter = DatasetExporter(args.output, fetch, args.shard_size, args.download_workers, args.decode_workers)
+    exporter.run(samples)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# export_model.py
+# Xuất model Keras (config.MODEL_PATH) sang TFLite (float16, int8) và/hoặc ONNX cho máy chỉ có CPU,
+# sau đó in báo cáo sai khác (độ trùng top-1 và độ lệch xác suất lớn nhất) so với model Keras.
+#
+# Ví dụ: python export_model.py --formats float16 int8 onnx --calibration-dir collected_data
+
+import argparse
+import glob
+import os
+import random
+
+import numpy as np
+
+from config import MODEL_PATH, COLLECTED_DATA_DIR, TFLITE_MODEL_PATH, ONNX_MODEL_PATH
+from backends import load_backend_model
+from inference import INPUT_SHAPE
+from imaging import decode_into
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+
+def find_images(directory):
+    """Liệt kê ảnh trong thư mục dữ liệu thu thập (collected_data/<label>/*)."""
+    paths = []
+    for ext in IMAGE_EXTENSIONS:
+        paths.extend(glob.glob(os.path.join(directory, '**', f'*{ext}'), recursive=True))
+        paths.extend(glob.glob(os.path.join(directory, '**', f'*{ext.upper()}'), recursive=True))
+    return sorted(set(paths))
+
+
+def load_preprocessed(path):
+    """Đọc và tiền xử lý một ảnh giống `utils.preprocess_image`."""
+    from tensorflow.keras.applications.vgg16 import preprocess_input
+    buffer = np.empty((1,) + INPUT_SHAPE, dtype=np.float32)
+    with open(path, 'rb') as f:
+        decode_into(f.read(), buffer[0], INPUT_SHAPE[1::-1])
+    return preprocess_input(buffer)
+
+
+def sample_inputs(paths, limit, seed=0):
+    """Lấy tối đa `limit` ảnh đã tiền xử lý; dùng ảnh ngẫu nhiên nếu không có dữ liệu thật."""
+    if not paths:
+        print(f"EXPORT: No images found, using {limit} random inputs instead (calibration will be poor).")
+        rng = np.random.default_rng(seed)
+        return [rng.uniform(-124, 152, size=(1,) + INPUT_SHAPE).astype(np.float32) for _ in range(limit)]
+    chosen = random.Random(seed).sample(paths, min(limit, len(paths)))
+    inputs = []
+    for path in chosen:
+        try:
+            inputs.append(load_preprocessed(path).astype(np.float32))
+        except Exception as e:
+            print(f"EXPORT: Skipping unreadable image {path}: {e}")
+    return inputs
+
+
+def export_tflite(model, output_path, quantization, calibration_inputs=None):
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if not calibration_inputs:
+            raise ValueError("int8 quantization needs calibration images")
+
+        def representative_dataset():
+            for batch in calibration_inputs:
+                yield [batch]
+
+        converter.representative_dataset = representative_dataset
+        # Trọng số và phép tính int8, vào/ra vẫn là float32 để app không phải đổi gì
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        raise ValueError(f"Unknown TFLite quantization: {quantization!r}")
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f"EXPORT: Wrote {output_path} ({os.path.getsize(output_path) / 1e6:.1f} MB)")
+
+
+def export_onnx(model, output_path, opset=13):
+    import tensorflow as tf
+    import tf2onnx
+    signature = (tf.TensorSpec((None,) + INPUT_SHAPE, tf.float32, name='input'),)
+    tf2onnx.convert.from_keras(model, input_signature=signature, opset=opset, output_path=output_path)
+    print(f"EXPORT: Wrote {output_path} ({os.path.getsize(output_path) / 1e6:.1f} MB)")
+
+
+def parity_report(model, exported, inputs):
+    """So sánh từng model đã xuất với model Keras trên cùng tập ảnh."""
+    batch = np.concatenate(inputs, axis=0)
+    reference = model.predict(batch, verbose=0)
+    print(f"\nParity report on {len(batch)} images (reference: Keras float32)")
+    print(f"{'model':<50} {'top-1 agree':>12} {'max |Δp|':>10} {'size MB':>8}")
+    for name, path in exported:
+        backend = 'onnx' if path.endswith('.onnx') else 'tflite'
+        candidate = load_backend_model(backend, path).predict(batch)
+        agreement = np.mean(np.argmax(candidate, axis=1) == np.argmax(reference, axis=1)) * 100
+        drift = np.abs(candidate - reference).max()
+        print(f"{name + ' (' + path + ')':<50} {agreement:>11.1f}% {drift:>10.4f} {os.path.getsize(path) / 1e6:>8.1f}")
+
+
+def tflite_output_path(quantization):
+    if quantization == 'int8':
+        return TFLITE_MODEL_PATH
+    base, _ = os.path.splitext(MODEL_PATH)
+    return f"{base}_{quantization}.tflite"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the Keras plant classifier to TFLite/ONNX")
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--formats', nargs='+', choices=['float16', 'int8', 'onnx'], default=['float16', 'int8'])
+    parser.add_argument('--calibration-dir', default=COLLECTED_DATA_DIR)
+    parser.add_argument('--calibration-samples', type=int, default=200)
+    parser.add_argument('--parity-samples', type=int, default=100)
+    args = parser.parse_args()
+
+    from tensorflow.keras.models import load_model
+    model = load_model(args.model, compile=False)
+    images = find_images(args.calibration_dir) if os.path.isdir(args.calibration_dir) else []
+    print(f"EXPORT: Found {len(images)} images under '{args.calibration_dir}'")
+
+    exported = []
+    for fmt in args.formats:
+        if fmt == 'onnx':
+            export_onnx(model, ONNX_MODEL_PATH)
+            exported.append(('onnx', ONNX_MODEL_PATH))
+        else:
+            calibration = sample_inputs(images, args.calibration_samples) if fmt == 'int8' else None
+            path = tflite_output_path(fmt)
+            export_tflite(model, path, fmt, calibration)
+            exported.append((f"tflite-{fmt}", path))
+
+    parity_report(model, exported, sample_inputs(images, args.parity_samples, seed=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+# feature_store.py
+# Kho đặc trưng (bottleneck) VGG16: mỗi ảnh phản hồi chỉ chạy phần conv VGG16 đã đóng băng đúng một lần,
+# vector sau Global Average Pooling (512 chiều) được ghi nối vào một mảng float32 memory-map,
+# tra theo băm nội dung ảnh. Huấn luyện lại chỉ khớp phần đầu phân loại trên các vector đã lưu.
+#
+# Bố cục thư mục:
+#   embeddings.f32   các hàng float32 (dim) nối tiếp nhau, chỉ ghi nối
+#   index.jsonl      mỗi dòng: băm ảnh, hàng, nhãn, doc id (dòng sau cùng của một băm được dùng)
+#   meta.json        số chiều và dấu vân tay trọng số của phần conv (đổi base thì phải dựng lại kho)
+#
+# Thêm ảnh mới:  python feature_store.py ingest --source manifest --backend local
+# Huấn luyện lại: python feature_store.py train-head --output best_plant_classifier_vgg16_v2.h5
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from config import CLASS_NAMES, CLASS_TO_SCIENTIFIC, FEATURE_STORE_DIR, MANIFEST_DIR, MODEL_PATH
+from imaging import decode_into
+from inference import INPUT_SHAPE
+from manifest import shard_name
+from metrics import metrics
+from prediction_cache import image_hash
+
+
+def load_conv_base(model_path=MODEL_PATH):
+    """Phần conv VGG16 của model hiện tại (hoặc VGG16 ImageNet nếu không tách được), đóng băng, + GAP."""
+    import tensorflow as tf
+    try:
+        model = tf.keras.models.load_model(model_path, compile=False)
+        nested = [layer for layer in model.layers if isinstance(layer, tf.keras.Model) and 'vgg16' in layer.name]
+        conv = nested[0] if nested else tf.keras.Model(model.inputs, model.get_layer('block5_pool').output)
+        print(f"FEATURES: Using convolutional base of {model_path}")
+    except (OSError, ValueError) as e:
+        print(f"FEATURES: Could not extract base from {model_path} ({e}), using ImageNet VGG16")
+        conv = tf.keras.applications.VGG16(include_top=False, weights='imagenet', input_shape=INPUT_SHAPE)
+    conv.trainable = False
+    inputs = tf.keras.Input(INPUT_SHAPE)
+    outputs = tf.keras.layers.GlobalAveragePooling2D()(conv(inputs, training=False))
+    return tf.keras.Model(inputs, outputs, name='feature_extractor'), conv
+
+
+def weights_fingerprint(model):
+    digest = hashlib.sha256()
+    for weight in model.get_weights():
+        digest.update(np.ascontiguousarray(weight).tobytes())
+    return digest.hexdigest()[:16]
+
+
+class FeatureStore:
+    """Mảng embedding chỉ ghi nối, memory-map khi đọc, tra theo băm ảnh."""
+
+    def __init__(self, directory=FEATURE_STORE_DIR, dim=512, base_fingerprint=None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._embeddings_path = os.path.join(directory, 'embeddings.f32')
+        self._index_path = os.path.join(directory, 'index.jsonl')
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if base_fingerprint and meta.get('base_fingerprint') not in (None, base_fingerprint):
+                raise ValueError(f"Feature store {directory} was built with a different convolutional base; "
+                                 "rebuild it in a new directory")
+            self.dim = meta['dim']
+        else:
+            self.dim = dim
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({'dim': dim, 'base_fingerprint': base_fingerprint}, f)
+        self._lock = threading.Lock()
+        self._row_bytes = self.dim * 4
+        # Bỏ hàng cuối ghi dở (nếu tiến trình trước dừng giữa chừng)
+        if os.path.exists(self._embeddings_path):
+            size = os.path.getsize(self._embeddings_path)
+            if size % self._row_bytes:
+                with open(self._embeddings_path, 'r+b') as f:
+                    f.truncate(size - size % self._row_bytes)
+        self.entries = {} # băm -> {'row', 'label', 'doc_id'}
+        self.doc_ids = set()
+        if os.path.exists(self._index_path):
+            with open(self._index_path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        continue
+                    entry = json.loads(line)
+                    self.entries[entry['hash']] = entry
+                    if entry.get('doc_id'):
+                        self.doc_ids.add(entry['doc_id'])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, value_hash):
+        return value_hash in self.entries
+
+    def embeddings(self):
+        """Toàn bộ mảng embedding dạng memmap chỉ đọc (số hàng, dim)."""
+        rows = os.path.getsize(self._embeddings_path) // self._row_bytes if os.path.exists(self._embeddings_path) else 0
+        if rows == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.memmap(self._embeddings_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def add(self, hashes, vectors, labels, doc_ids):
+        """Ghi nối một lô vector; embedding được ghi (fsync) trước rồi mới ghi chỉ mục trỏ tới nó."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            with open(self._embeddings_path, 'ab') as f:
+                first_row = f.tell() // self._row_bytes
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._index_path, 'a', encoding='utf-8') as f:
+                for offset, (value_hash, label, doc_id) in enumerate(zip(hashes, labels, doc_ids)):
+                    entry = {'hash': value_hash, 'row': first_row + offset, 'label': label, 'doc_id': doc_id}
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                    self.entries[value_hash] = entry
+                    if doc_id:
+                        self.doc_ids.add(doc_id)
+        metrics.incr('features.added', len(hashes))
+
+    def relabel(self, value_hash, label, doc_id=None):
+        """Ảnh đã có embedding nhưng được gán nhãn (lại): chỉ ghi thêm dòng chỉ mục, không chạy lại model."""
+        with self._lock:
+            entry = dict(self.entries[value_hash], label=label, doc_id=doc_id)
+            with open(self._index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.entries[value_hash] = entry
+            if doc_id:
+                self.doc_ids.add(doc_id)
+
+    def labelled(self):
+        """(ma trận embedding, danh sách nhãn) của mọi ảnh đã có nhãn."""
+        entries = sorted((e for e in self.entries.values() if e.get('label')), key=lambda e: e['row'])
+        embeddings = self.embeddings()
+        rows = np.array([e['row'] for e in entries], dtype=np.int64)
+        return np.asarray(embeddings[rows]) if len(rows) else np.empty((0, self.dim), np.float32), [e['label'] for e in entries]
+
+
+def ingest(store, extractor, samples, fetch, batch_size=32, download_workers=8):
+    """Chạy phần conv cho các mẫu chưa có trong kho; mẫu có băm đã biết chỉ được gán nhãn."""
+    from tensorflow.keras.applications.vgg16 import preprocess_input
+    todo = [s for s in samples if s['doc_id'] not in store.doc_ids]
+    print(f"FEATURES: {len(store)} embeddings stored, {len(todo)} new sample(s)")
+    started = time.perf_counter()
+    computed = 0
+    buffer = np.empty((batch_size,) + INPUT_SHAPE, dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=download_workers) as downloads:
+        for start in range(0, len(todo), batch_size):
+            chunk = todo[start:start + batch_size]
+            batch_hashes, batch_labels, batch_doc_ids = [], [], []
+            for sample, data in zip(chunk, downloads.map(lambda s: _fetch(fetch, s), chunk)):
+                if data is None:
+                    continue
+                value_hash = image_hash(data)
+                if value_hash in store or value_hash in batch_hashes:
+                    if value_hash in store:
+                        store.relabel(value_hash, sample['label'], sample['doc_id'])
+                    continue
+                try:
+                    decode_into(data, buffer[len(batch_hashes)], INPUT_SHAPE[1::-1])
+                except Exception as e:
+                    print(f"FEATURES: Skipping {sample['storage_path']}: {e}")
+                    continue
+                batch_hashes.append(value_hash)
+                batch_labels.append(sample['label'])
+                batch_doc_ids.append(sample['doc_id'])
+            if not batch_hashes:
+                continue
+            count = len(batch_hashes)
+            vectors = extractor(preprocess_input(buffer[:count].copy()), training=False).numpy()
+            store.add(batch_hashes, vectors, batch_labels, batch_doc_ids)
+            computed += count
+            print(f"FEATURES: {computed} forward passes ({computed / (time.perf_counter() - started):.1f} img/s)")
+    return computed
+
+
+def _fetch(fetch, sample):
+    try:
+        return fetch(sample['storage_path'])
+    except Exception as e:
+        print(f"FEATURES: Download failed for {sample['storage_path']}: {e}")
+        return None
+
+
+def class_mapping(labels, min_samples):
+    """CLASS_NAMES mới: giữ nguyên thứ tự các lớp cũ, thêm loài mới (đủ `min_samples` ảnh) theo thứ tự tên."""
+    known = {shard_name(CLASS_TO_SCIENTIFIC.get(name, name)).lower(): name for name in CLASS_NAMES}
+    class_names = list(CLASS_NAMES)
+    class_to_scientific = dict(CLASS_TO_SCIENTIFIC)
+    label_to_class = {}
+    counts = Counter(shard_name(label) for label in labels)
+    for scientific in sorted(counts):
+        if scientific.lower() in known:
+            label_to_class[scientific] = known[scientific.lower()]
+        elif counts[scientific] >= min_samples:
+            class_name = scientific.replace('_', ' ').title() # Cùng kiểu với CLASS_NAMES hiện có
+            class_names.append(class_name)
+            class_to_scientific[class_name] = scientific
+            label_to_class[scientific] = class_name
+    return class_names, class_to_scientific, label_to_class
+
+
+def check_class_counts(class_names, counts, min_samples, allow_missing=False):
+    """In số embedding của từng lớp; lớp có ít hơn `min_samples` (kể cả lớp cũ không còn ảnh nào)
+    làm dừng huấn luyện, trừ khi `allow_missing` (model mới sẽ khó hoặc không thể dự đoán các lớp đó)."""
+    print("FEATURES: Embeddings per class:")
+    for class_name, count in zip(class_names, counts):
+        print(f"  {class_name:40s} {count:6d}" + ("  (below --min-samples)" if count < min_samples else ""))
+    missing = [class_name for class_name, count in zip(class_names, counts) if count < min_samples]
+    if missing and not allow_missing:
+        raise ValueError(f"{len(missing)} class(es) have fewer than {min_samples} embeddings: {missing}; "
+                         f"ingest more feedback or pass --allow-missing")
+    return missing
+
+
+def train_head(store, conv, output_path, epochs=30, min_samples=20, validation_split=0.1, seed=0, allow_missing=False):
+    """Khớp phần đầu phân loại trên embedding đã lưu rồi ghép với phần conv thành model đầy đủ."""
+    features, labels = store.labelled()
+    class_names, class_to_scientific, label_to_class = class_mapping(labels, min_samples)
+    keep = [i for i, label in enumerate(labels) if shard_name(label) in label_to_class]
+    x = features[keep]
+    y = np.array([class_names.index(label_to_class[shard_name(labels[i])]) for i in keep], dtype=np.int32)
+    counts = np.bincount(y, minlength=len(class_names))
+    check_class_counts(class_names, counts, min_samples, allow_missing)
+    print(f"FEATURES: Training head on {len(y)} embeddings, {len(class_names)} classes: {class_names}")
+
+    import tensorflow as tf
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(y))
+    x, y = x[order], y[order]
+    class_weight = {i: len(y) / (len(class_names) * c) for i, c in enumerate(counts) if c}
+
+    tf.keras.utils.set_random_seed(seed)
+    head = tf.keras.Sequential([
+        tf.keras.Input((store.dim,)),
+        tf.keras.layers.Dense(256, activation='relu'),
+        tf.keras.layers.Dropout(0.5),
+        tf.keras.layers.Dense(len(class_names), activation='softmax'),
+    ], name='head')
+    head.compile(optimizer=tf.keras.optimizers.Adam(1e-3), loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    started = time.perf_counter()
+    head.fit(x, y, epochs=epochs, batch_size=64, validation_split=validation_split, class_weight=class_weight,
+             callbacks=[tf.keras.callbacks.EarlyStopping(patience=5, restore_best_weights=True)], verbose=2)
+    print(f"FEATURES: Head trained in {time.perf_counter() - started:.1f} s")
+
+    inputs = tf.keras.Input(INPUT_SHAPE)
+    pooled = tf.keras.layers.GlobalAveragePooling2D()(conv(inputs, training=False))
+    model = tf.keras.Model(inputs, head(pooled), name='plant_classifier')
+    model.save(output_path)
+    mapping_path = os.path.splitext(output_path)[0] + '.classes.json'
+    with open(mapping_path, 'w', encoding='utf-8') as f:
+        json.dump({'CLASS_NAMES': class_names, 'CLASS_TO_SCIENTIFIC': class_to_scientific}, f,
+                  ensure_ascii=False, indent=2)
+    print(f"FEATURES: Wrote {output_path} and {mapping_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cached VGG16 bottleneck features and head retraining")
+    parser.add_argument('--dir', default=FEATURE_STORE_DIR)
+    parser.add_argument('--model', default=MODEL_PATH, help="Model lấy phần conv VGG16")
+    sub = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = sub.add_parser('ingest', help="Tính embedding cho ảnh phản hồi mới")
+    ingest_parser.add_argument('--source', choices=('manifest', 'firestore', 'directory'), default='manifest')
+    ingest_parser.add_argument('--backend', choices=('firebase', 'local'), default='firebase')
+    ingest_parser.add_argument('--local-dir', default='local_backend')
+    ingest_parser.add_argument('--manifest-dir', default=MANIFEST_DIR)
+    ingest_parser.add_argument('--input', help="Thư mục <nhãn>/<file> (với --source directory)")
+    ingest_parser.add_argument('--batch-size', type=int, default=32)
+    train_parser = sub.add_parser('train-head', help="Huấn luyện lại phần đầu phân loại")
+    train_parser.add_argument('--output', required=True)
+    train_parser.add_argument('--epochs', type=int, default=30)
+    train_parser.add_argument('--min-samples', type=int, default=20,
+                              help="Số ảnh tối thiểu để thêm một loài mới; mọi lớp giữ lại cũng cần đủ số này")
+    train_parser.add_argument('--allow-missing', action='store_true',
+                              help="Vẫn huấn luyện khi có lớp ít hơn --min-samples embedding")
+    args = parser.parse_args()
+
+    extractor, conv = load_conv_base(args.model)
+    store = FeatureStore(args.dir, extractor.output_shape[-1], weights_fingerprint(conv))
+    if args.command == 'train-head':
+        train_head(store, conv, args.output, args.epochs, args.min_samples, allow_missing=args.allow_missing)
+        return
+
+    from export_dataset import samples_from_directory, samples_from_documents, samples_from_manifest, read_file
+    if args.source == 'directory':
+        if not args.input:
+            parser.error("--input is required with --source directory")
+        samples, fetch = samples_from_directory(args.input), read_file
+    else:
+        from feedback_backends import FirebaseBackend, LocalBackend
+        if args.backend == 'local':
+            backend = LocalBackend(args.local_dir)
+        else:
+            import firebase_admin
+            from config import FIREBASE_STORAGE_BUCKET
+            firebase_admin.initialize_app(options={'storageBucket': FIREBASE_STORAGE_BUCKET}) # Dùng GOOGLE_APPLICATION_CREDENTIALS
+            backend = FirebaseBackend()
+        samples = samples_from_manifest(args.manifest_dir) if args.source == 'manifest' else samples_from_documents(backend)
+        fetch = backend.download
+    ingest(store, extractor, list(samples), fetch, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# feedback_backends.py
+# Nơi lưu ảnh phản hồi và metadata: Firebase (Storage + Firestore) hoặc bản giả lập cục bộ
+# (trên đĩa hoặc trong bộ nhớ) có cùng giao diện, để chạy thử / kiểm thử / đo mà không cần tài khoản Firebase.
+
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+# Collection Firestore chứa metadata phản hồi
+FEEDBACK_COLLECTION = 'plant_feedback'
+# Firestore cho phép tối đa 500 thao tác trong một batch
+FIRESTORE_MAX_BATCH = 500
+
+
+class FirebaseBackend:
+    """Ghi ảnh lên Firebase Storage và metadata vào Firestore (Firebase phải được khởi tạo trước)."""
+
+    name = 'firebase'
+
+    def upload(self, storage_path, data, content_type):
+        from firebase_admin import storage
+        blob = storage.bucket().blob(storage_path)
+        blob.upload_from_string(data, content_type=content_type)
+
+    def write_documents(self, documents, collection=FEEDBACK_COLLECTION):
+        """Ghi nhiều document bằng batch write. `documents`: danh sách (doc_id, dict)."""
+        from firebase_admin import firestore
+        db = firestore.client()
+        for start in range(0, len(documents), FIRESTORE_MAX_BATCH):
+            batch = db.batch()
+            for doc_id, data in documents[start:start + FIRESTORE_MAX_BATCH]:
+                batch.set(db.collection(collection).document(doc_id),
+                          dict(data, timestamp=firestore.SERVER_TIMESTAMP)) # Tự động lấy giờ server
+            batch.commit()
+
+    def iter_documents(self, collection=FEEDBACK_COLLECTION):
+        from firebase_admin import firestore
+        for snapshot in firestore.client().collection(collection).stream():
+            yield snapshot.id, snapshot.to_dict()
+
+    def download(self, storage_path):
+        from firebase_admin import storage
+        return storage.bucket().blob(storage_path).download_as_bytes()
+
+
+class LocalBackend:
+    """Bản giả lập cục bộ: Storage là thư mục `root/storage`, Firestore là `root/firestore/<collection>/<id>.json`."""
+
+    name = 'local'
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _storage_path(self, storage_path):
+        path = os.path.normpath(os.path.join(self.root, 'storage', storage_path))
+        if not path.startswith(os.path.normpath(os.path.join(self.root, 'storage')) + os.sep):
+            raise ValueError(f"Invalid storage path: {storage_path}")
+        return path
+
+    @staticmethod
+    def _write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def upload(self, storage_path, data, content_type):
+        self._write_atomic(self._storage_path(storage_path), data)
+
+    def write_documents(self, documents, collection=FEEDBACK_COLLECTION):
+        timestamp = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            for doc_id, data in documents:
+                path = os.path.join(self.root, 'firestore', collection, f"{doc_id}.json")
+                payload = json.dumps(dict(data, timestamp=timestamp), ensure_ascii=False)
+                self._write_atomic(path, payload.encode('utf-8'))
+
+    def iter_documents(self, collection=FEEDBACK_COLLECTION):
+        directory = os.path.join(self.root, 'firestore', collection)
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.json'):
+                with open(os.path.join(directory, name), encoding='utf-8') as f:
+                    yield name[:-len('.json')], json.load(f)
+
+    def download(self, storage_path):
+        with open(self._storage_path(storage_path), 'rb') as f:
+            return f.read()
+
+
+class MemoryBackend:
+    """Bản giả lập trong bộ nhớ (benchmark): Storage là dict đường dẫn -> bytes, Firestore là dict theo collection."""
+
+    name = 'memory'
+
+    def __init__(self):
+        self.blobs = {}
+        self.collections = {}
+        self._lock = threading.Lock()
+
+    def upload(self, storage_path, data, content_type):
+        with self._lock:
+            self.blobs[storage_path] = bytes(data)
+
+    def write_documents(self, documents, collection=FEEDBACK_COLLECTION):
+        timestamp = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            docs = self.collections.setdefault(collection, {})
+            for doc_id, data in documents:
+                docs[doc_id] = dict(data, timestamp=timestamp)
+
+    def iter_documents(self, collection=FEEDBACK_COLLECTION):
+        with self._lock:
+            documents = sorted(self.collections.get(collection, {}).items())
+        yield from documents
+
+    def download(self, storage_path):
+        with self._lock:
+            return self.blobs[storage_path]
@@ -0,0 +1,285 @@
+# feedback_queue.py
+# Hàng đợi tải phản hồi lên nền với spool bền vững trên đĩa: nút bấm chỉ ghi ảnh + metadata vào spool
+# rồi trả về ngay; worker nền tải ảnh lên (giới hạn đồng thời, thử lại có backoff), gom metadata thành
+# batch write Firestore, và khi khởi động lại thì tiếp tục xử lý những gì còn trong spool.
+#
+# Mỗi việc trong spool gồm `<id>.bin` (ảnh) và `<id>.json` (đường dẫn, content type, metadata,
+# trạng thái đã tải ảnh hay chưa). File .json được ghi sau cùng nên việc chỉ "tồn tại" khi đã ghi đủ.
+# Việc thất bại quá `max_retries` lần được chuyển sang thư mục dead-letter (giữ nguyên .bin/.json để xem
+# và đưa lại vào spool bằng tay), không thử lại mãi.
+
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from metrics import metrics
+from process_liveness import pid_alive
+
+
+class FeedbackUploadQueue:
+    """Tải phản hồi lên `backend` (FirebaseBackend / LocalBackend) ở nền, bền vững qua khởi động lại."""
+
+    def __init__(self, spool_dir, backend, upload_workers=2, max_retries=5, batch_size=50,
+                 flush_interval=2.0, backoff=0.5, dead_letter_dir=None):
+        self.spool_dir = spool_dir
+        self.dead_letter_dir = dead_letter_dir or os.path.join(spool_dir, 'dead_letter')
+        self.backend = backend
+        self.max_retries = max_retries
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backoff = backoff
+        os.makedirs(spool_dir, exist_ok=True)
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        self._uploads = queue.Queue()
+        self._documents = queue.Queue()
+        self._threads = [threading.Thread(target=self._upload_loop, name=f"feedback-upload-{i}", daemon=True)
+                         for i in range(upload_workers)]
+        self._threads.append(threading.Thread(target=self._commit_loop, name='feedback-commit', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        recovered = self._drain_spool()
+        if recovered:
+            print(f"FEEDBACK_QUEUE: Recovered {recovered} pending job(s) from {spool_dir}")
+
+    # --- Spool ---
+    def _path(self, job_id, suffix):
+        return os.path.join(self.spool_dir, f"{job_id}{suffix}")
+
+    def _write_job(self, job_id, job):
+        tmp_path = self._path(job_id, '.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(job_id, '.json'))
+
+    def _read_job(self, job_id):
+        with open(self._path(job_id, '.json'), encoding='utf-8') as f:
+            return json.load(f)
+
+    def _claim(self, job_id):
+        """Giữ quyền xử lý việc bằng file .lock (nhiều worker có thể dùng chung một spool)."""
+        lock_path = self._path(job_id, '.lock')
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return True
+            except FileExistsError:
+                try:
+                    with open(lock_path) as f:
+                        owner = int(f.read() or 0)
+                except (OSError, ValueError):
+                    owner = 0
+                if owner and (owner == os.getpid() or pid_alive(owner)):
+                    return False
+                try:
+                    os.remove(lock_path) # Tiến trình giữ khóa đã chết: lấy lại việc
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def _remove_job(self, job_id):
+        for suffix in ('.bin', '.json', '.lock'):
+            try:
+                os.remove(self._path(job_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _dead_letter(self, job_id):
+        """Chuyển việc đã hết số lần thử sang thư mục dead-letter (vẫn giữ ảnh và metadata)."""
+        for suffix in ('.bin', '.json'):
+            try:
+                os.replace(self._path(job_id, suffix), os.path.join(self.dead_letter_dir, f"{job_id}{suffix}"))
+            except FileNotFoundError:
+                pass
+        self._remove_job(job_id)
+        metrics.incr('feedback.dead_lettered')
+        print(f"FEEDBACK_QUEUE: Moved job {job_id} to {self.dead_letter_dir}")
+
+    def _drain_spool(self):
+        """Đưa các việc còn dở trong spool (của lần chạy trước) vào hàng đợi."""
+        count = 0
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith('.json'):
+                continue
+            job_id = name[:-len('.json')]
+            if not self._claim(job_id):
+                continue
+            try:
+                job = self._read_job(job_id)
+            except (OSError, ValueError) as e:
+                print(f"FEEDBACK_QUEUE: Dropping unreadable job {job_id}: {e}")
+                self._remove_job(job_id)
+                continue
+            (self._documents if job.get('uploaded') else self._uploads).put(job_id)
+            count += 1
+        self._update_depth()
+        return count
+
+    def _update_depth(self):
+        metrics.set_gauge('feedback.upload_queue_depth', self._uploads.qsize())
+        metrics.set_gauge('feedback.document_queue_depth', self._documents.qsize())
+
+    # --- API ---
+    def enqueue(self, image_bytes, storage_path, content_type, doc_id=None, metadata=None):
+        """Ghi việc vào spool và trả về ngay; ảnh và metadata được tải lên ở nền (doc_id None: chỉ tải ảnh)."""
+        job_id = f"{int(time.time() * 1000):013d}_{uuid.uuid4().hex[:8]}"
+        self._claim(job_id)
+        tmp_path = self._path(job_id, '.bin.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(job_id, '.bin'))
+        self._write_job(job_id, {
+            'storage_path': storage_path, 'content_type': content_type, 'doc_id': doc_id,
+            'metadata': metadata, 'uploaded': False, 'enqueued_at': time.time(),
+        })
+        self._uploads.put(job_id)
+        metrics.incr('feedback.enqueued')
+        self._update_depth()
+        return job_id
+
+    def enqueue_document(self, doc_id, metadata):
+        """Chỉ ghi metadata (không có ảnh), vẫn qua spool và batch write."""
+        job_id = f"{int(time.time() * 1000):013d}_{uuid.uuid4().hex[:8]}"
+        self._claim(job_id)
+        self._write_job(job_id, {'doc_id': doc_id, 'metadata': metadata, 'uploaded': True,
+                                 'enqueued_at': time.time()})
+        self._documents.put(job_id)
+        metrics.incr('feedback.enqueued')
+        self._update_depth()
+        return job_id
+
+    def pending(self):
+        return self._uploads.qsize() + self._documents.qsize()
+
+    def wait_idle(self, timeout=None):
+        """Chờ đến khi hàng đợi trống (dùng cho script/kiểm thử)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._uploads.unfinished_tasks or self._documents.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    # --- Worker ---
+    def _upload_loop(self):
+        while True:
+            job_id = self._uploads.get()
+            if job_id is None: # Tín hiệu dừng từ `stop`
+                self._uploads.task_done()
+                return
+            try:
+                self._upload(job_id)
+            finally:
+                self._uploads.task_done()
+                self._update_depth()
+
+    def _upload(self, job_id):
+        try:
+            job = self._read_job(job_id)
+            with open(self._path(job_id, '.bin'), 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            print(f"FEEDBACK_QUEUE: Job {job_id} vanished from spool: {e}")
+            self._remove_job(job_id)
+            return
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self.backend.upload(job['storage_path'], data, job['content_type'])
+            except Exception as e:
+                metrics.incr('feedback.upload_retries')
+                print(f"FEEDBACK_QUEUE: Upload of {job['storage_path']} failed (attempt {attempt + 1}): {e}")
+                time.sleep(self.backoff * (2 ** attempt))
+                continue
+            metrics.observe('feedback.upload_ms', (time.perf_counter() - started) * 1000.0)
+            metrics.observe('feedback.end_to_end_ms', (time.time() - job['enqueued_at']) * 1000.0)
+            if job.get('doc_id') is None:
+                self._remove_job(job_id) # Chỉ tải ảnh, không có document
+                return
+            job['uploaded'] = True
+            self._write_job(job_id, job)
+            try:
+                os.remove(self._path(job_id, '.bin'))
+            except FileNotFoundError:
+                pass
+            self._documents.put(job_id)
+            return
+        metrics.incr('feedback.upload_failures')
+        self._dead_letter(job_id)
+
+    def _commit_loop(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                batch.append(self._documents.get(timeout=self.flush_interval))
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._documents.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is None: # Tín hiệu dừng: ghi nốt lô đang gom rồi thoát
+                stopping = True
+            try:
+                self._commit([job_id for job_id in batch if job_id is not None])
+            finally:
+                for _ in batch:
+                    self._documents.task_done()
+                self._update_depth()
+
+    def _commit(self, job_ids):
+        jobs = {}
+        for job_id in job_ids:
+            try:
+                jobs[job_id] = self._read_job(job_id)
+            except (OSError, ValueError) as e:
+                print(f"FEEDBACK_QUEUE: Skipping unreadable job {job_id}: {e}")
+                self._remove_job(job_id)
+        documents = [(job['doc_id'], job['metadata']) for job in jobs.values()]
+        if not documents:
+            return
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self.backend.write_documents(documents)
+            except Exception as e:
+                metrics.incr('feedback.commit_retries')
+                print(f"FEEDBACK_QUEUE: Batch write of {len(documents)} docs failed (attempt {attempt + 1}): {e}")
+                time.sleep(self.backoff * (2 ** attempt))
+                continue
+            metrics.observe('feedback.commit_ms', (time.perf_counter() - started) * 1000.0)
+            metrics.observe('feedback.batch_size', len(documents), buckets=(1, 2, 5, 10, 20, 50, 100, 500))
+            metrics.incr('feedback.committed', len(documents))
+            for job_id in jobs:
+                self._remove_job(job_id)
+            return
+        metrics.incr('feedback.commit_failures')
+        for job_id in jobs:
+            self._dead_letter(job_id)
+
+    def stop(self, timeout=None):
+        """Xử lý nốt việc đã vào hàng đợi rồi dừng các worker (tín hiệu dừng xếp sau các việc đó).
+
+        Việc chưa xong khi hết `timeout` vẫn nằm trong spool và được tiếp tục ở lần chạy sau.
+        """
+        upload_threads, commit_thread = self._threads[:-1], self._threads[-1]
+        for _ in upload_threads:
+            self._uploads.put(None)
+        for thread in upload_threads:
+            thread.join(timeout)
+        self._documents.put(None) # Sau khi worker tải ảnh dừng, để lô cuối có cả document của chúng
+        commit_thread.join(timeout)
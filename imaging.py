@@ -0,0 +1,71 @@
+# imaging.py
+# Giải mã ảnh tiết kiệm bộ nhớ, dùng chung cho app, các script và worker (không phụ thuộc Streamlit/TensorFlow).
+
+import io
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Kích thước đầu vào model (rộng, cao)
+TARGET_SIZE = (224, 224)
+
+
+def open_image(image_bytes, target_size=TARGET_SIZE):
+    """Mở ảnh, giải mã ở độ phân giải gần `target_size` nhất có thể, xoay theo EXIF, chuyển RGB đúng một lần.
+
+    Với JPEG, `draft` cho phép bộ giải mã thu nhỏ 1/2, 1/4, 1/8 ngay khi giải mã nên
+    ảnh 12 MP không bao giờ được bung ra toàn bộ. Với GIF chỉ lấy khung hình đầu.
+    `image_bytes` có thể là bytes hoặc đối tượng dạng file như memory map (đọc trực tiếp, không sao chép).
+    """
+    if hasattr(image_bytes, 'read'):
+        image_bytes.seek(0)
+        img = Image.open(image_bytes)
+    else:
+        img = Image.open(io.BytesIO(image_bytes))
+    if target_size is not None and img.format == 'JPEG':
+        # Kết quả draft luôn >= kích thước yêu cầu nên không mất chi tiết khi resize
+        img.draft('RGB', target_size)
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
+def resize_image(img, target_size=TARGET_SIZE):
+    """Resize về `target_size`; `reducing_gap` dùng reduce() nguyên lần trước khi nội suy cho ảnh lớn."""
+    if img.size == tuple(target_size):
+        return img
+    return img.resize(target_size, Image.Resampling.BICUBIC, reducing_gap=3.0)
+
+
+def decode_into(image_bytes, out, target_size=TARGET_SIZE):
+    """Giải mã + resize rồi ghi thẳng vào mảng `out` (cao, rộng, 3) đã cấp phát sẵn."""
+    img = resize_image(open_image(image_bytes, target_size), target_size)
+    out[...] = np.asarray(img)
+    return out
+
+
+def decode_to_array(image_bytes, target_size=TARGET_SIZE, dtype=np.uint8):
+    """Giải mã thành mảng (cao, rộng, 3) kiểu `dtype`."""
+    out = np.empty((target_size[1], target_size[0], 3), dtype=dtype)
+    return decode_into(image_bytes, out, target_size)
+
+
+# Trung bình kênh của ImageNet theo thứ tự BGR (chế độ 'caffe' của keras preprocess_input)
+_CAFFE_MEAN_BGR = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+
+def normalize(images, mode='vgg16'):
+    """Chuẩn hóa ảnh đã giải mã (RGB 0..255) theo model: cùng phép tính với `preprocess_input` của Keras.
+
+    'vgg16': đổi sang BGR rồi trừ trung bình ImageNet; 'mobilenet_v2': đưa về [-1, 1];
+    'efficientnet': giữ nguyên (model EfficientNet của Keras đã có lớp Rescaling bên trong).
+    """
+    images = np.asarray(images, dtype=np.float32)
+    if mode == 'vgg16':
+        return images[..., ::-1] - _CAFFE_MEAN_BGR
+    if mode == 'mobilenet_v2':
+        return images / 127.5 - 1.0
+    if mode == 'efficientnet':
+        return images
+    raise ValueError(f"Unknown preprocessing mode: {mode!r}")
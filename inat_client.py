@@ -0,0 +1,161 @@
+# inat_client.py
+# Client iNaturalist dùng chung: một Session keep-alive có pool kết nối, giới hạn số request đồng thời,
+# thử lại với backoff khi gặp 429/5xx, gộp các request giống nhau đang chạy, và cache SQLite trên đĩa
+# (TTL theo endpoint) dùng chung giữa các worker, còn nguyên sau khi deploy lại.
+
+import json
+import random
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (INAT_API_BASE_URL, INAT_CACHE_DB, INAT_CACHE_TTLS, INAT_MAX_CONCURRENCY, INAT_MAX_RETRIES)
+from disk_cache import SQLiteCache
+from metrics import metrics
+
+# Mã lỗi đáng thử lại (quá tải / lỗi tạm thời phía máy chủ)
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class INatClient:
+    """Client iNaturalist an toàn đa luồng. `base_url` có thể trỏ vào máy chủ giả lập khi kiểm thử."""
+
+    def __init__(self, base_url=INAT_API_BASE_URL, cache_path=INAT_CACHE_DB, ttls=INAT_CACHE_TTLS,
+                 max_concurrency=INAT_MAX_CONCURRENCY, max_retries=INAT_MAX_RETRIES, backoff=0.5, pool_size=16):
+        self.base_url = base_url.rstrip('/')
+        self.ttls = dict(ttls)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['User-Agent'] = 'plantidentify/1.0'
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._disk = SQLiteCache(cache_path, table='inat') if cache_path else None
+
+    # --- Tầng HTTP chung ---
+    def get_json(self, endpoint, params, timeout=10):
+        """GET `{base_url}/{endpoint}` và trả JSON, qua cache đĩa và gộp request trùng đang chạy."""
+        key = f"{endpoint}?{urlencode(sorted(params.items()))}"
+        if self._disk is not None:
+            cached = self._disk.get(key)
+            if cached is not None:
+                metrics.incr('inat.cache_hits')
+                return json.loads(cached)
+            metrics.incr('inat.cache_misses')
+
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            # Một luồng khác đang gọi đúng request này: chờ và dùng chung kết quả
+            metrics.incr('inat.coalesced')
+            return future.result()
+
+        try:
+            data = self._fetch(endpoint, params, timeout)
+            if self._disk is not None:
+                self._disk.set(key, json.dumps(data).encode('utf-8'), ttl=self.ttls.get(endpoint))
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
+    def _fetch(self, endpoint, params, timeout):
+        url = f"{self.base_url}/{endpoint}"
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            with self._semaphore:
+                started = time.perf_counter()
+                try:
+                    response = self.session.get(url, params=params, timeout=timeout)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    if attempt == self.max_retries:
+                        metrics.incr('inat.errors')
+                        raise
+                    print(f"INAT: {endpoint} attempt {attempt + 1} failed ({e}), retrying")
+                    response = None
+                finally:
+                    metrics.observe(f"inat.{endpoint}.latency_ms", (time.perf_counter() - started) * 1000.0)
+            if response is not None:
+                if response.status_code not in RETRYABLE_STATUS or attempt == self.max_retries:
+                    if not response.ok:
+                        metrics.incr('inat.errors')
+                    response.raise_for_status()
+                    return response.json()
+                print(f"INAT: {endpoint} returned {response.status_code}, retrying (attempt {attempt + 1})")
+                retry_after = response.headers.get('Retry-After')
+            metrics.incr('inat.retries')
+            time.sleep(self._retry_delay(attempt, retry_after))
+
+    def _retry_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(float(retry_after), 30.0)
+            except ValueError:
+                pass
+        return self.backoff * (2 ** attempt) * (0.5 + random.random())
+
+    # --- Các endpoint app dùng ---
+    def get_taxon_id(self, scientific_name, timeout=10):
+        """ID loài (rank species) khớp tên khoa học, hoặc None."""
+        if not scientific_name:
+            return None
+        data = self.get_json('taxa', {'q': scientific_name, 'is_active': 'true', 'rank': 'species'}, timeout)
+        if data.get('results') and data['total_results'] > 0:
+            return data['results'][0]['id']
+        return None
+
+    def get_observation_photo_urls(self, taxon_id, count=10, timeout=15):
+        """URL ảnh cỡ 'medium' của các quan sát research-grade được bình chọn nhiều nhất."""
+        if not taxon_id:
+            return []
+        params = {
+            'taxon_id': taxon_id, 'photos': 'true', 'quality_grade': 'research',
+            'per_page': count, 'order': 'desc', 'order_by': 'votes'
+        }
+        data = self.get_json('observations', params, timeout)
+        image_urls = []
+        for obs in data.get('results') or []:
+            if obs.get('photos'):
+                photo_url = obs['photos'][0].get('url')
+                if photo_url:
+                    image_urls.append(photo_url.replace('square', 'medium'))
+                if len(image_urls) >= count:
+                    break
+        return image_urls
+
+    def autocomplete(self, query, timeout=5):
+        """Gợi ý loài/chi/họ theo từ khóa, dạng dict mà giao diện dùng."""
+        data = self.get_json('taxa/autocomplete', {'q': query, 'is_active': 'true', 'rank': 'species,genus,family'}, timeout)
+        suggestions = []
+        for result in data.get('results') or []:
+            scientific_name = result.get('name') # Tên khoa học
+            display_name = result.get('preferred_common_name') or scientific_name # Ưu tiên tên thường gọi
+            suggestions.append(make_suggestion(result.get('id'), scientific_name, display_name, result.get('rank')))
+        return suggestions
+
+
+def make_suggestion(taxon_id, scientific_name, display_name, rank):
+    """Dict gợi ý loài theo đúng định dạng giao diện đang dùng."""
+    return {
+        "id": taxon_id,
+        "scientific_name": scientific_name,
+        "display_name": display_name,
+        "rank": rank,
+        "formatted_display": f"{display_name} ({scientific_name}) - Rank: {rank}" # Chuỗi để hiển thị trong selectbox/radio
+    }
@@ -0,0 +1,108 @@
+# inat_stub.py
+# Máy chủ HTTP giả lập iNaturalist chạy cục bộ, để kiểm thử / đo INatClient mà không cần mạng.
+#
+#   with INatStubServer(fail_first=2) as server:
+#       client = INatClient(base_url=server.base_url, cache_path=None)
+#       client.get_taxon_id('Monstera deliciosa')
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Dữ liệu mẫu nhỏ, đủ cho các endpoint app dùng
+STUB_TAXA = [
+    {'id': 47126 + i, 'name': name, 'preferred_common_name': common, 'rank': 'species'}
+    for i, (name, common) in enumerate([
+        ('Epipremnum aureum', 'Golden Pothos'),
+        ('Monstera deliciosa', 'Swiss Cheese Plant'),
+        ('Zamioculcas zamiifolia', 'ZZ Plant'),
+        ('Spathiphyllum wallisii', 'Peace Lily'),
+        ('Ficus lyrata', 'Fiddle-leaf Fig'),
+    ], start=1)
+]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Giữ kết nối keep-alive như máy chủ thật
+    disable_nagle_algorithm = True # Header và body gửi làm hai lần write; tránh trễ ~40 ms do Nagle + delayed ACK
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            should_fail = server.request_count <= server.fail_first
+        if server.delay:
+            time.sleep(server.delay)
+        if should_fail:
+            return self._send(server.fail_status, {'error': 'stub failure'}, {'Retry-After': '0'})
+
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        path = parsed.path[len(server.prefix):] if parsed.path.startswith(server.prefix) else parsed.path
+        q = query.get('q', '').lower()
+        if path in ('/taxa', '/taxa/autocomplete'):
+            results = [t for t in STUB_TAXA if q in t['name'].lower() or q in t['preferred_common_name'].lower()]
+            return self._send(200, {'total_results': len(results), 'results': results})
+        if path == '/observations':
+            count = int(query.get('per_page', 10))
+            taxon_id = query.get('taxon_id')
+            results = [
+                {'id': n, 'photos': [{'id': n, 'url': f"{server.base_url}/photos/{taxon_id}{n:03d}/square.jpg"}]}
+                for n in range(count)
+            ]
+            return self._send(200, {'total_results': len(results), 'results': results})
+        self._send(404, {'error': 'not found'})
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class INatStubServer(ThreadingHTTPServer):
+    """Máy chủ giả lập chạy trên luồng nền. `fail_first` request đầu trả `fail_status` để thử cơ chế retry."""
+
+    daemon_threads = True
+
+    def __init__(self, port=0, prefix='/v1', delay=0.0, fail_first=0, fail_status=503):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.prefix = prefix
+        self.delay = delay
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}{self.prefix}"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    with INatStubServer(port=8765) as stub:
+        print(f"iNaturalist stub listening at {stub.base_url} (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,229 @@
+# inference.py
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from metrics import metrics
+
+# Mốc histogram cho kích thước lô
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+# Kích thước đầu vào cố định của VGG16
+INPUT_SHAPE = (224, 224, 3)
+
+
+def build_compiled_predict_fn(model, jit_compile=False, with_embeddings=False):
+    """Tạo hàm suy luận đã biên dịch (tf.function) với chữ ký đầu vào cố định (None, 224, 224, 3) float32.
+
+    Gọi trực tiếp đồ thị đã trace, bỏ qua data adapter và vòng lặp callback của `model.predict`.
+    Với `with_embeddings`, hàm trả (xác suất, embedding lớp áp chót) trong cùng một lần chạy.
+    """
+    import tensorflow as tf
+
+    if with_embeddings:
+        # Embedding lớp áp chót = đầu vào của lớp Dense phân loại cuối cùng
+        model = tf.keras.Model(model.inputs, [model.output, model.layers[-1].input])
+
+    @tf.function(
+        input_signature=[tf.TensorSpec(shape=(None,) + INPUT_SHAPE, dtype=tf.float32)],
+        jit_compile=jit_compile,
+    )
+    def serve(images):
+        return model(images, training=False)
+
+    def predict(images):
+        outputs = serve(tf.convert_to_tensor(images, dtype=tf.float32))
+        if with_embeddings:
+            return tuple(output.numpy() for output in outputs)
+        return outputs.numpy()
+
+    return predict
+
+
+def warm_up(predict_fn, batch_sizes=(1,)):
+    """Chạy thử hàm suy luận để trace/biên dịch trước khi người dùng đầu tiên bấm nút."""
+    for batch_size in batch_sizes:
+        started = time.perf_counter()
+        predict_fn(np.zeros((batch_size,) + INPUT_SHAPE, dtype=np.float32))
+        print(f"INFERENCE: Warm-up batch={batch_size} took {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+class _PendingRequest:
+    __slots__ = ('images', 'future', 'enqueued_at')
+
+    def __init__(self, images):
+        self.images = images
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+def _join_futures(parts):
+    """Future trả kết quả các phần ghép lại theo thứ tự (mảng, hoặc tuple mảng); lỗi của phần nào cũng được chuyển tiếp."""
+    joined = Future()
+    lock = threading.Lock()
+    remaining = [len(parts)]
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        errors = [part.exception() for part in parts if part.exception() is not None]
+        if errors:
+            joined.set_exception(errors[0])
+            return
+        results = [part.result() for part in parts]
+        if isinstance(results[0], tuple):
+            joined.set_result(tuple(np.concatenate(outputs, axis=0) for outputs in zip(*results)))
+        else:
+            joined.set_result(np.concatenate(results, axis=0))
+
+    for part in parts:
+        part.add_done_callback(on_done)
+    return joined
+
+
+class BatchingScheduler:
+    """Gom các yêu cầu suy luận từ nhiều phiên Streamlit thành một lô duy nhất.
+
+    Một luồng nền lấy yêu cầu từ hàng đợi, gom đến khi đủ `max_batch_size` ảnh
+    hoặc hết `max_wait_ms`, gọi `predict_fn` một lần rồi trả xác suất riêng cho từng người gọi.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=15, name='vgg16'):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000.0)
+        self.name = name
+        self._queue = queue.Queue()
+        self._held = None # Yêu cầu không vừa lô trước, chạy đầu lô sau (chỉ luồng nền dùng)
+        self._thread = threading.Thread(target=self._run, name=f"batching-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, images):
+        """Đưa một lô ảnh đã tiền xử lý (N, 224, 224, 3) vào hàng đợi, trả về Future."""
+        images = np.asarray(images)
+        if images.ndim == 3:
+            images = np.expand_dims(images, axis=0)
+        if len(images) <= self.max_batch_size:
+            return self._enqueue(images)
+        # Yêu cầu nhiều ảnh hơn một lô (API, cascade) được chia thành các phần vừa `max_batch_size`
+        parts = [self._enqueue(images[start:start + self.max_batch_size])
+                 for start in range(0, len(images), self.max_batch_size)]
+        return _join_futures(parts)
+
+    def _enqueue(self, images):
+        request = _PendingRequest(images)
+        self._queue.put(request)
+        metrics.set_gauge(f"scheduler.{self.name}.queue_depth", self._queue.qsize())
+        return request.future
+
+    def predict(self, images, timeout=None):
+        """Giống `model.predict`: trả mảng xác suất (N, số lớp) cho các ảnh đã gửi."""
+        result = self.submit(images).result(timeout=timeout)
+        return result[0] if isinstance(result, tuple) else result
+
+    def predict_with_embeddings(self, images, timeout=None):
+        """(xác suất, embedding) nếu `predict_fn` trả cả embedding, ngược lại (xác suất, None)."""
+        result = self.submit(images).result(timeout=timeout)
+        return result if isinstance(result, tuple) else (result, None)
+
+    def _collect_batch(self):
+        first = self._held if self._held is not None else self._queue.get()
+        self._held = None
+        batch = [first]
+        size = len(first.images)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(request.images) > self.max_batch_size:
+                self._held = request # Không vượt `max_batch_size` (XLA chỉ được làm nóng đến cỡ lô này)
+                break
+            batch.append(request)
+            size += len(request.images)
+        return batch, size
+
+    def _run(self):
+        while True:
+            batch, size = self._collect_batch()
+            metrics.set_gauge(f"scheduler.{self.name}.queue_depth", self._queue.qsize())
+            metrics.observe(f"scheduler.{self.name}.batch_size", size, BATCH_SIZE_BUCKETS)
+            started = time.perf_counter()
+            for request in batch:
+                metrics.observe(f"scheduler.{self.name}.queue_wait_ms", (started - request.enqueued_at) * 1000.0)
+            try:
+                inputs = batch[0].images if len(batch) == 1 else np.concatenate([r.images for r in batch], axis=0)
+                outputs = self.predict_fn(inputs)
+                # predict_fn trả một mảng xác suất, hoặc tuple (xác suất, embedding)
+                outputs = tuple(np.asarray(o) for o in outputs) if isinstance(outputs, tuple) else np.asarray(outputs)
+            except Exception as e:
+                print(f"SCHEDULER: Batch of {size} failed: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            metrics.observe(f"scheduler.{self.name}.batch_latency_ms", (time.perf_counter() - started) * 1000.0)
+
+            offset = 0
+            for request in batch:
+                count = len(request.images)
+                if isinstance(outputs, tuple):
+                    request.future.set_result(tuple(o[offset:offset + count] for o in outputs))
+                else:
+                    request.future.set_result(outputs[offset:offset + count])
+                offset += count
+
+
+class BackgroundLoader:
+    """Chạy một hàm tải nặng (đọc model + làm nóng) trên luồng nền, không chặn giao diện."""
+
+    def __init__(self, load_fn, name='model'):
+        self.load_fn = load_fn
+        self.name = name
+        self.result = None
+        self.error = None
+        self.load_ms = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"loader-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            self.result = self.load_fn()
+        except Exception as e:
+            print(f"LOADER: Loading {self.name} failed: {e}")
+            self.error = e
+        finally:
+            self.load_ms = (time.perf_counter() - started) * 1000.0
+            metrics.set_gauge(f"startup.{self.name}_load_ms", self.load_ms)
+            print(f"LOADER: {self.name} finished in {self.load_ms:.0f} ms")
+            self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def ready(self):
+        return self._done.is_set() and self.result is not None
+
+    @property
+    def failed(self):
+        return self._done.is_set() and self.result is None
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.ready
@@ -0,0 +1,268 @@
+# manifest.py
+# Manifest cục bộ của dữ liệu phản hồi đã thu thập: mỗi lần lưu ảnh ghi nối một dòng JSON
+# (đường dẫn Storage, nhãn, băm, kích thước, dự đoán) vào segment của nhãn đó, kèm bộ đếm theo nhãn.
+# Huấn luyện lại / dashboard đọc manifest thay vì liệt kê cả bucket hay quét collection Firestore.
+#
+# Bố cục thư mục:
+#   labels/<nhãn>/live-<writer>-<seq>.jsonl        segment đang ghi nối (mỗi tiến trình một writer)
+#   labels/<nhãn>/compacted-<đầu>-<cuối>-<n>.jsonl  segment đã gộp, sắp theo thời gian
+#   counters/<writer>.json, counters/base.json      bộ đếm theo nhãn
+#
+# Gộp segment:          python manifest.py compact
+# Đếm theo nhãn:        python manifest.py counts
+# Mẫu của một nhãn:     python manifest.py samples Epipremnum_aureum --since 2024-01-01
+
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from config import MANIFEST_DIR, MANIFEST_SEGMENT_MAX_BYTES, MANIFEST_COMPACT_MAX_RECORDS
+from metrics import metrics
+from process_liveness import pid_alive
+
+
+def shard_name(label):
+    """Tên thư mục của nhãn (cùng cách làm sạch với đường dẫn Storage trong save_feedback_image)."""
+    safe_label = re.sub(r'[^\w\s-]', '', label).strip().replace(' ', '_')[:100]
+    return safe_label or 'unknown_label'
+
+
+def _to_epoch(since):
+    if since is None:
+        return None
+    if isinstance(since, datetime):
+        return since.timestamp()
+    if isinstance(since, str):
+        return datetime.fromisoformat(since).timestamp()
+    return float(since)
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _read_jsonl(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.endswith('\n'): # Dòng cuối chưa ghi xong thì bỏ qua
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+    except FileNotFoundError:
+        return
+
+
+class Manifest:
+    """Ghi nối và đọc manifest trong `directory`. An toàn khi nhiều tiến trình cùng ghi (mỗi tiến trình file riêng)."""
+
+    def __init__(self, directory=MANIFEST_DIR, segment_max_bytes=MANIFEST_SEGMENT_MAX_BYTES):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.writer_id = f"{os.getpid()}-{int(time.time() * 1000)}"
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._counters = {}
+        os.makedirs(os.path.join(directory, 'labels'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'counters'), exist_ok=True)
+
+    def _label_dir(self, label):
+        return os.path.join(self.directory, 'labels', shard_name(label))
+
+    # --- Ghi ---
+    def append(self, record):
+        """Ghi một bản ghi (dict có 'label'); tự thêm 'ts' (epoch) nếu thiếu."""
+        record = dict(record)
+        record.setdefault('ts', time.time())
+        label_dir = self._label_dir(record['label'])
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            os.makedirs(label_dir, exist_ok=True)
+            path = os.path.join(label_dir, f"live-{self.writer_id}-{self._seq:06d}.jsonl")
+            try:
+                if os.path.getsize(path) + len(line) > self.segment_max_bytes:
+                    self._seq += 1 # Segment cũ đóng lại, được phép gộp
+                    path = os.path.join(label_dir, f"live-{self.writer_id}-{self._seq:06d}.jsonl")
+            except FileNotFoundError:
+                pass
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            counter = self._counters.setdefault(shard_name(record['label']), {'count': 0, 'bytes': 0, 'last_ts': 0})
+            counter['count'] += 1
+            counter['bytes'] += record.get('bytes') or 0
+            counter['last_ts'] = max(counter['last_ts'], record['ts'])
+            _write_json_atomic(os.path.join(self.directory, 'counters', f"{self.writer_id}.json"), self._counters)
+        metrics.incr('manifest.appended')
+
+    # --- Đọc ---
+    def label_counts(self):
+        """{nhãn: {'count', 'bytes', 'last_ts'}} cộng từ các file bộ đếm, không đọc segment."""
+        totals = {}
+        counters_dir = os.path.join(self.directory, 'counters')
+        for name in os.listdir(counters_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(counters_dir, name), encoding='utf-8') as f:
+                    counters = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for label, counter in counters.items():
+                total = totals.setdefault(label, {'count': 0, 'bytes': 0, 'last_ts': 0})
+                total['count'] += counter['count']
+                total['bytes'] += counter['bytes']
+                total['last_ts'] = max(total['last_ts'], counter['last_ts'])
+        return totals
+
+    def samples_for_label(self, label, since=None):
+        """Các bản ghi của `label` có ts >= `since` (epoch, datetime hoặc chuỗi ISO), sắp theo thời gian."""
+        since = _to_epoch(since)
+        label_dir = self._label_dir(label)
+        if not os.path.isdir(label_dir):
+            return []
+        records, seen = [], set()
+        for name in os.listdir(label_dir):
+            if not name.endswith('.jsonl'):
+                continue
+            if name.startswith('compacted-') and since is not None:
+                last_ts = float(name.split('-')[2]) / 1000
+                if last_ts < since:
+                    continue # Cả segment cũ hơn `since`: không cần mở
+            for record in _read_jsonl(os.path.join(label_dir, name)):
+                key = record.get('doc_id') or (record.get('storage_path'), record['ts'])
+                if (since is None or record['ts'] >= since) and key not in seen:
+                    seen.add(key) # Bản ghi trùng nếu lần gộp trước bị dừng giữa chừng
+                    records.append(record)
+        records.sort(key=lambda record: record['ts'])
+        return records
+
+    def labels(self):
+        return sorted(os.listdir(os.path.join(self.directory, 'labels')))
+
+    # --- Gộp ---
+    def _closed(self, name, current):
+        """Segment live đã đóng: không phải segment mới nhất của một writer còn sống."""
+        writer_pid, writer_started, seq = name[len('live-'):-len('.jsonl')].split('-')
+        writer = f"{writer_pid}-{writer_started}"
+        if writer == self.writer_id:
+            return int(seq) < self._seq
+        return not pid_alive(int(writer_pid)) or int(seq) < current.get(writer, -1)
+
+    def compact(self, max_records=MANIFEST_COMPACT_MAX_RECORDS):
+        """Gộp segment live đã đóng và segment gộp còn nhỏ thành segment sắp theo thời gian, mỗi file <= max_records."""
+        started = time.perf_counter()
+        merged_files = 0
+        for label in self.labels():
+            label_dir = os.path.join(self.directory, 'labels', label)
+            names = [n for n in os.listdir(label_dir) if n.endswith('.jsonl')]
+            current = {} # writer -> seq lớn nhất
+            for name in names:
+                if name.startswith('live-'):
+                    writer_pid, writer_started, seq = name[len('live-'):-len('.jsonl')].split('-')
+                    writer = f"{writer_pid}-{writer_started}"
+                    current[writer] = max(current.get(writer, -1), int(seq))
+            sources = [n for n in names if n.startswith('live-') and self._closed(n, current)]
+            if not sources:
+                continue
+            sources += [n for n in names if n.startswith('compacted-') and int(n[:-len('.jsonl')].split('-')[3]) < max_records]
+            records, seen = [], set()
+            for name in sources:
+                for record in _read_jsonl(os.path.join(label_dir, name)):
+                    key = record.get('doc_id') or (record.get('storage_path'), record['ts'])
+                    if key not in seen:
+                        seen.add(key)
+                        records.append(record)
+            records.sort(key=lambda record: record['ts'])
+            written = []
+            for start in range(0, len(records), max_records):
+                chunk = records[start:start + max_records]
+                name = f"compacted-{int(chunk[0]['ts'] * 1000)}-{int(chunk[-1]['ts'] * 1000)}-{len(chunk)}.jsonl"
+                tmp_path = os.path.join(label_dir, name + '.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    for record in chunk:
+                        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, os.path.join(label_dir, name))
+                written.append(name)
+            # Chỉ xóa nguồn sau khi file gộp đã ghi xong (nếu dừng giữa chừng, đọc vẫn loại được bản trùng)
+            for name in sources:
+                if name not in written:
+                    os.remove(os.path.join(label_dir, name))
+            merged_files += len(sources)
+        self._fold_counters()
+        print(f"MANIFEST: Compacted {merged_files} segment(s) in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return merged_files
+
+    def _fold_counters(self):
+        """Cộng bộ đếm của các writer đã dừng vào base.json để thư mục counters không phình ra."""
+        counters_dir = os.path.join(self.directory, 'counters')
+        base_path = os.path.join(counters_dir, 'base.json')
+        try:
+            with open(base_path, encoding='utf-8') as f:
+                base = json.load(f)
+        except (OSError, ValueError):
+            base = {}
+        folded = []
+        for name in os.listdir(counters_dir):
+            if not name.endswith('.json') or name == 'base.json':
+                continue
+            writer = name[:-len('.json')]
+            if writer == self.writer_id or pid_alive(int(writer.split('-')[0])):
+                continue
+            try:
+                with open(os.path.join(counters_dir, name), encoding='utf-8') as f:
+                    counters = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for label, counter in counters.items():
+                total = base.setdefault(label, {'count': 0, 'bytes': 0, 'last_ts': 0})
+                total['count'] += counter['count']
+                total['bytes'] += counter['bytes']
+                total['last_ts'] = max(total['last_ts'], counter['last_ts'])
+            folded.append(name)
+        if folded:
+            _write_json_atomic(base_path, base)
+            for name in folded:
+                os.remove(os.path.join(counters_dir, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manifest of collected feedback data")
+    parser.add_argument('--dir', default=MANIFEST_DIR)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('compact', help="Gộp các segment đã đóng")
+    sub.add_parser('counts', help="Số mẫu theo nhãn")
+    samples_parser = sub.add_parser('samples', help="Các mẫu của một nhãn")
+    samples_parser.add_argument('label')
+    samples_parser.add_argument('--since', help="Thời điểm ISO, ví dụ 2024-01-01")
+    args = parser.parse_args()
+
+    manifest = Manifest(args.dir)
+    if args.command == 'compact':
+        manifest.compact()
+    elif args.command == 'counts':
+        for label, counter in sorted(manifest.label_counts().items()):
+            last = datetime.fromtimestamp(counter['last_ts']).isoformat(timespec='seconds')
+            print(f"{label:40s} {counter['count']:7d} {counter['bytes'] / 1e6:9.2f} MB  last {last}")
+    else:
+        started = time.perf_counter()
+        records = manifest.samples_for_label(args.label, args.since)
+        for record in records:
+            print(json.dumps(record, ensure_ascii=False))
+        print(f"{len(records)} samples in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
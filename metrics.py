@@ -0,0 +1,95 @@
+# metrics.py
+
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Mốc histogram mặc định cho thời gian (ms)
+DEFAULT_LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    """Histogram với các mốc cố định và một cửa sổ mẫu gần nhất để tính phân vị."""
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS_MS, reservoir_size=1024):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # Ô cuối cho giá trị > mốc lớn nhất
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=reservoir_size)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def percentile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        index = min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def to_dict(self):
+        labels = [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}" if self.buckets else "+Inf"]
+        return {
+            'count': self.count,
+            'mean': (self.total / self.count) if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class Metrics:
+    """Bộ đếm, gauge và histogram dùng chung trong một tiến trình (an toàn đa luồng)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._histograms = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value, buckets=None):
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = Histogram(buckets) if buckets is not None else Histogram()
+                self._histograms[name] = hist
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name, buckets=None):
+        """Đo thời gian (ms) của một khối lệnh và ghi vào histogram `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000.0, buckets)
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {name: h.to_dict() for name, h in self._histograms.items()},
+            }
+
+
+# Đối tượng dùng chung cho toàn bộ tiến trình
+metrics = Metrics()
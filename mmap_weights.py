@@ -0,0 +1,277 @@
+# mmap_weights.py
+# Ghi trọng số model (MODEL_PATH) ra một file phẳng, căn theo trang bộ nhớ, rồi nạp lại bằng mmap chỉ đọc.
+# Nhiều worker Streamlit trên cùng máy dùng chung một bản trọng số trong page cache của hệ điều hành
+# (không ai giữ bản sao riêng ~500 MB) và khởi động không cần đọc/parse HDF5.
+#
+# Chuyển đổi: python mmap_weights.py convert [--model best_plant_classifier_vgg16.h5]
+# Kiểm tra:   python mmap_weights.py check   (so khớp với model Keras + báo cáo bộ nhớ)
+
+import argparse
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from config import MODEL_PATH, MMAP_WEIGHTS_PATH
+from metrics import metrics
+
+MAGIC = b'PLANTW01'
+PAGE_SIZE = mmap.PAGESIZE
+
+# Các loại layer có thể chạy trực tiếp từ trọng số mmap (đủ cho VGG16 + đầu phân loại)
+SUPPORTED_LAYERS = {
+    'Conv2D', 'Dense', 'MaxPooling2D', 'AveragePooling2D', 'GlobalAveragePooling2D',
+    'GlobalMaxPooling2D', 'Flatten', 'Dropout', 'Activation', 'ReLU', 'BatchNormalization',
+}
+# Layer không có tác dụng khi suy luận
+_SKIPPED_LAYERS = {'InputLayer', 'Dropout'}
+
+
+def _align(offset):
+    return (offset + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+
+def _activation_name(activation):
+    if activation is None:
+        return 'linear'
+    if isinstance(activation, dict): # Keras 3 có thể serialize activation thành dict
+        return activation.get('config', {}).get('name') or activation.get('class_name', 'linear')
+    return activation
+
+
+def _flatten_layers(model):
+    """Trải phẳng các model lồng nhau (VGG16 bên trong Sequential) thành một chuỗi layer tuyến tính."""
+    layers = []
+    for layer in model.layers:
+        if hasattr(layer, 'layers'):
+            layers.extend(_flatten_layers(layer))
+        else:
+            layers.append(layer)
+    return layers
+
+
+def _layer_spec(layer):
+    kind = layer.__class__.__name__
+    if kind not in SUPPORTED_LAYERS:
+        raise ValueError(f"Layer '{layer.name}' of type {kind} is not supported by the mmap loader")
+    config = layer.get_config()
+    if config.get('data_format', 'channels_last') != 'channels_last':
+        raise ValueError(f"Layer '{layer.name}' uses {config['data_format']}; only channels_last is supported")
+    spec = {'type': kind, 'name': layer.name}
+    if kind in ('Conv2D', 'Dense'):
+        spec['activation'] = _activation_name(config.get('activation'))
+        spec['use_bias'] = config.get('use_bias', True)
+    if kind == 'Conv2D':
+        spec['strides'] = list(config['strides'])
+        spec['padding'] = config['padding'].upper()
+        spec['dilation_rate'] = list(config.get('dilation_rate', (1, 1)))
+    elif kind in ('MaxPooling2D', 'AveragePooling2D'):
+        spec['pool_size'] = list(config['pool_size'])
+        spec['strides'] = list(config['strides'] or config['pool_size'])
+        spec['padding'] = config['padding'].upper()
+    elif kind == 'Activation':
+        spec['activation'] = _activation_name(config.get('activation'))
+    elif kind == 'ReLU':
+        if config.get('max_value') is not None or config.get('negative_slope') or config.get('threshold'):
+            raise ValueError(f"Layer '{layer.name}': only plain ReLU is supported")
+    elif kind == 'BatchNormalization':
+        spec['epsilon'] = config['epsilon']
+        spec['center'] = config.get('center', True)
+        spec['scale'] = config.get('scale', True)
+    return spec
+
+
+def convert(model_path, output_path):
+    """Đọc model Keras và ghi file trọng số phẳng: MAGIC | độ dài header | header JSON | các tensor căn trang."""
+    from tensorflow.keras.models import load_model
+    model = load_model(model_path, compile=False)
+
+    layers, tensors = [], []
+    for layer in _flatten_layers(model):
+        kind = layer.__class__.__name__
+        if kind == 'InputLayer':
+            continue
+        spec = _layer_spec(layer)
+        spec['weights'] = []
+        for array in layer.get_weights():
+            array = np.ascontiguousarray(array, dtype=np.float32)
+            spec['weights'].append({'shape': list(array.shape), 'dtype': 'float32'})
+            tensors.append(array)
+        layers.append(spec)
+
+    header = {'version': 1, 'source': os.path.basename(model_path),
+              'input_shape': list(model.input_shape[1:]), 'layers': layers}
+    weight_entries = [w for spec in layers for w in spec['weights']]
+    # Header chứa offset của từng tensor: chừa sẵn 32 byte mỗi tensor cho khóa "offset" rồi mới tính vùng dữ liệu
+    reserved = len(MAGIC) + 8 + len(json.dumps(header).encode('utf-8')) + 32 * len(weight_entries)
+    offset = _align(reserved)
+    for entry, array in zip(weight_entries, tensors):
+        entry['offset'] = offset
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    if len(MAGIC) + 8 + len(header_bytes) > _align(reserved):
+        raise RuntimeError("Header larger than reserved space")
+
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for entry, array in zip(weight_entries, tensors):
+            f.seek(entry['offset'])
+            f.write(array.tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, output_path)
+    print(f"MMAP: Wrote {len(layers)} layers / {len(tensors)} tensors to {output_path} "
+          f"({os.path.getsize(output_path) / 1e6:.1f} MB)")
+    return output_path
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a mmap weights file")
+        (length,) = struct.unpack('<Q', f.read(8))
+        return json.loads(f.read(length).decode('utf-8'))
+
+
+class MmapModel:
+    """Model suy luận chạy thẳng trên trọng số mmap chỉ đọc; `predict(images)` giống `model.predict`.
+
+    Mảng numpy trỏ vào vùng mmap (đã căn trang) được chuyển thành tensor TensorFlow không sao chép,
+    nên trang trọng số thuộc page cache dùng chung thay vì bộ nhớ riêng của từng worker.
+    """
+
+    def __init__(self, path):
+        import tensorflow as tf
+        self.path = path
+        self.header = read_header(path)
+        self._mmap = np.memmap(path, dtype=np.uint8, mode='r')
+        self._layers = []
+        for spec in self.header['layers']:
+            weights = [
+                tf.convert_to_tensor(np.ndarray(tuple(w['shape']), dtype=w['dtype'], buffer=self._mmap, offset=w['offset']))
+                for w in spec['weights']
+            ]
+            self._layers.append((spec, weights))
+        input_shape = tuple(self.header['input_shape'])
+        self._serve = tf.function(self._forward, input_signature=[tf.TensorSpec((None,) + input_shape, tf.float32)])
+        report = memory_report(path)
+        print(f"MMAP: Loaded {path}; memory: {report}")
+
+    @staticmethod
+    def _activate(tf, x, name):
+        if name in (None, 'linear'):
+            return x
+        if name == 'relu':
+            return tf.nn.relu(x)
+        if name == 'softmax':
+            return tf.nn.softmax(x, axis=-1)
+        if name == 'sigmoid':
+            return tf.sigmoid(x)
+        if name == 'tanh':
+            return tf.tanh(x)
+        raise ValueError(f"Unsupported activation: {name}")
+
+    def _forward(self, x):
+        import tensorflow as tf
+        for spec, weights in self._layers:
+            kind = spec['type']
+            if kind in _SKIPPED_LAYERS:
+                continue
+            if kind == 'Conv2D':
+                x = tf.nn.conv2d(x, weights[0], strides=spec['strides'], padding=spec['padding'],
+                                 dilations=spec['dilation_rate'])
+                if spec['use_bias']:
+                    x = tf.nn.bias_add(x, weights[1])
+                x = self._activate(tf, x, spec['activation'])
+            elif kind == 'Dense':
+                x = tf.matmul(x, weights[0])
+                if spec['use_bias']:
+                    x = tf.nn.bias_add(x, weights[1])
+                x = self._activate(tf, x, spec['activation'])
+            elif kind == 'MaxPooling2D':
+                x = tf.nn.max_pool2d(x, spec['pool_size'], spec['strides'], spec['padding'])
+            elif kind == 'AveragePooling2D':
+                x = tf.nn.avg_pool2d(x, spec['pool_size'], spec['strides'], spec['padding'])
+            elif kind == 'GlobalAveragePooling2D':
+                x = tf.reduce_mean(x, axis=[1, 2])
+            elif kind == 'GlobalMaxPooling2D':
+                x = tf.reduce_max(x, axis=[1, 2])
+            elif kind == 'Flatten':
+                x = tf.reshape(x, [tf.shape(x)[0], -1])
+            elif kind == 'Activation':
+                x = self._activate(tf, x, spec['activation'])
+            elif kind == 'ReLU':
+                x = tf.nn.relu(x)
+            elif kind == 'BatchNormalization':
+                params = list(weights)
+                gamma = params.pop(0) if spec['scale'] else None
+                beta = params.pop(0) if spec['center'] else None
+                mean, variance = params
+                x = tf.nn.batch_normalization(x, mean, variance, beta, gamma, spec['epsilon'])
+        return x
+
+    def predict(self, images, verbose=0):
+        import tensorflow as tf
+        return self._serve(tf.convert_to_tensor(images, dtype=tf.float32)).numpy()
+
+
+def memory_report(mapped_path=None):
+    """RSS / bộ nhớ dùng chung / riêng của tiến trình (MB), kèm phần RSS thuộc file trọng số nếu có (Linux)."""
+    report = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+        kb = lambda key: int(fields.get(key, '0 kB').split()[0])
+        report['rss_mb'] = kb('Rss') / 1024
+        report['pss_mb'] = kb('Pss') / 1024
+        report['shared_mb'] = (kb('Shared_Clean') + kb('Shared_Dirty')) / 1024
+        report['private_mb'] = (kb('Private_Clean') + kb('Private_Dirty')) / 1024
+    except OSError:
+        return report # Không phải Linux: không có /proc
+    if mapped_path:
+        target = os.path.realpath(mapped_path)
+        mapped_kb, in_target = 0, False
+        with open('/proc/self/smaps') as f:
+            for line in f:
+                parts = line.split()
+                if parts and '-' in parts[0] and len(parts) >= 5: # Dòng mô tả vùng nhớ
+                    in_target = len(parts) >= 6 and parts[-1] == target
+                elif in_target and parts and parts[0] == 'Rss:':
+                    mapped_kb += int(parts[1])
+        report['weights_rss_mb'] = mapped_kb / 1024
+    for key, value in report.items():
+        metrics.set_gauge(f"memory.{key}", round(value, 1))
+    return {key: round(value, 1) for key, value in report.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert/check page-aligned mmap weights")
+    sub = parser.add_subparsers(dest='command', required=True)
+    convert_parser = sub.add_parser('convert', help="Ghi file trọng số phẳng từ model Keras")
+    convert_parser.add_argument('--model', default=MODEL_PATH)
+    convert_parser.add_argument('--output', default=MMAP_WEIGHTS_PATH)
+    check_parser = sub.add_parser('check', help="Nạp bằng mmap, so với Keras và in báo cáo bộ nhớ")
+    check_parser.add_argument('--weights', default=MMAP_WEIGHTS_PATH)
+    check_parser.add_argument('--model', default=MODEL_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert(args.model, args.output)
+        return
+
+    model = MmapModel(args.weights)
+    images = np.random.default_rng(0).uniform(-124, 152, size=(4,) + tuple(model.header['input_shape'])).astype(np.float32)
+    probabilities = model.predict(images)
+    print(f"MMAP: After first predict: {memory_report(args.weights)}")
+    if os.path.exists(args.model):
+        from tensorflow.keras.models import load_model
+        reference = load_model(args.model, compile=False).predict(images, verbose=0)
+        print(f"MMAP: Max |Δprob| vs Keras: {np.abs(reference - probabilities).max():.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# prediction_cache.py
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from disk_cache import SQLiteCache
+from metrics import metrics
+
+# Số byte đọc ở đầu và cuối file model để tạo dấu vân tay (tránh băm cả file ~500 MB)
+_FINGERPRINT_SAMPLE_BYTES = 1 << 20
+
+
+def image_hash(image_bytes):
+    """Băm nội dung ảnh tải lên (sha256, hex)."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def model_fingerprint(model_path):
+    """Dấu vân tay của file model: đường dẫn, kích thước, mtime và băm phần đầu/cuối file."""
+    stat = os.stat(model_path)
+    digest = hashlib.sha256(f"{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    with open(model_path, 'rb') as f:
+        digest.update(f.read(_FINGERPRINT_SAMPLE_BYTES))
+        if stat.st_size > _FINGERPRINT_SAMPLE_BYTES:
+            f.seek(max(_FINGERPRINT_SAMPLE_BYTES, stat.st_size - _FINGERPRINT_SAMPLE_BYTES))
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class PredictionCache:
+    """Cache LRU xác suất dự đoán, khóa theo băm ảnh + dấu vân tay model.
+
+    Tầng bộ nhớ giới hạn `max_entries` mục; tầng đĩa (SQLite) tùy chọn sống qua các lần khởi động
+    lại và dùng chung được giữa nhiều tiến trình. Khi file model đổi, cache tự vô hiệu.
+    `model_path` có thể là một tuple đường dẫn (cascade nhiều model); `variant` phân biệt các cấu hình
+    cho kết quả khác nhau trên cùng file model (ví dụ ngưỡng cascade).
+    """
+
+    def __init__(self, model_path, max_entries=1024, disk_path=None, variant=''):
+        self.model_path = model_path
+        self.model_paths = tuple(model_path) if isinstance(model_path, (tuple, list)) else (model_path,)
+        self.variant = variant
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = SQLiteCache(disk_path, table='predictions') if disk_path else None
+        self._stat_key = None
+        self._fingerprint = None
+
+    def _current_fingerprint(self):
+        # stat() rẻ nên kiểm tra mỗi lần; chỉ băm lại khi file model thay đổi
+        try:
+            stats = [os.stat(path) for path in self.model_paths]
+        except OSError:
+            return None
+        stat_key = tuple((os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+                         for path, stat in zip(self.model_paths, stats))
+        if stat_key != self._stat_key:
+            fingerprint = model_fingerprint(self.model_paths[0])
+            if len(self.model_paths) > 1 or self.variant:
+                parts = [model_fingerprint(path) for path in self.model_paths] + [self.variant]
+                fingerprint = hashlib.sha256('|'.join(parts).encode()).hexdigest()[:16]
+            with self._lock:
+                if self._fingerprint is not None and fingerprint != self._fingerprint:
+                    print(f"PREDICTION_CACHE: Model changed ({self._fingerprint} -> {fingerprint}), invalidating cache")
+                    self._entries.clear()
+                    metrics.incr('prediction_cache.invalidations')
+                    if self._disk is not None:
+                        self._disk.purge(keep_prefix=f"{fingerprint}:")
+                self._fingerprint = fingerprint
+                self._stat_key = stat_key
+        return self._fingerprint
+
+    def _key(self, image_bytes, digest=None):
+        fingerprint = self._current_fingerprint()
+        if fingerprint is None or self.max_entries <= 0:
+            return None
+        return f"{fingerprint}:{digest or image_hash(image_bytes)}"
+
+    def get(self, image_bytes, digest=None):
+        """Trả vector xác suất đã lưu, hoặc None nếu chưa có.
+
+        `digest`: băm `image_hash` của ảnh nếu đã có sẵn (ví dụ khóa trong upload spool), khỏi băm lại.
+        """
+        key = self._key(image_bytes, digest)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        probabilities = entry[0] if entry is not None else None
+        if probabilities is None and self._disk is not None:
+            raw = self._disk.get(key)
+            if raw is not None:
+                probabilities = np.frombuffer(raw, dtype=np.float32)
+                self._remember(key, probabilities)
+                metrics.incr('prediction_cache.disk_hits')
+        metrics.incr('prediction_cache.hits' if probabilities is not None else 'prediction_cache.misses')
+        return probabilities
+
+    def put(self, image_bytes, probabilities, embedding=None, digest=None):
+        key = self._key(image_bytes, digest)
+        if key is None:
+            return
+        probabilities = np.asarray(probabilities, dtype=np.float32).ravel()
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        self._remember(key, probabilities, embedding)
+        if self._disk is not None:
+            self._disk.set(key, probabilities.tobytes())
+            if embedding is not None:
+                # Trên đĩa embedding nằm dưới khóa riêng để `get` chỉ đọc xác suất
+                self._disk.set(f"{key}:embedding", embedding.tobytes())
+
+    def get_embedding(self, image_bytes, digest=None):
+        """Embedding lớp áp chót đã lưu cùng dự đoán, hoặc None."""
+        key = self._key(image_bytes, digest)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+        embedding = entry[1] if entry is not None else None
+        if embedding is None and self._disk is not None:
+            raw = self._disk.get(f"{key}:embedding")
+            if raw is not None:
+                embedding = np.frombuffer(raw, dtype=np.float32)
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None: # Gắn vào mục xác suất sẵn có, không chiếm thêm chỗ trong LRU
+                        self._entries[key] = (entry[0], embedding)
+        return embedding
+
+    def _remember(self, key, probabilities, embedding=None):
+        """Mỗi ảnh một mục (xác suất, embedding) trong LRU: hai phần luôn được giữ hoặc bỏ cùng nhau."""
+        with self._lock:
+            self._entries[key] = (probabilities, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            metrics.set_gauge('prediction_cache.size', len(self._entries))
+
+    def stats(self):
+        hits = metrics.counter('prediction_cache.hits')
+        misses = metrics.counter('prediction_cache.misses')
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else None,
+            'disk_hits': metrics.counter('prediction_cache.disk_hits'),
+            'entries': len(self._entries),
+        }
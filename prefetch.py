@@ -0,0 +1,120 @@
+# prefetch.py
+# Tải trước dữ liệu tham khảo (taxon id, URL ảnh quan sát, thumbnail) ngay sau khi model dự đoán,
+# cho các lớp dự đoán cao nhất và các loài phổ biến, để khi người dùng bấm "Sai rồi"/"Tìm loại cây khác"
+# thì dữ liệu thường đã sẵn sàng. Có giới hạn số việc chờ và hủy được theo từng phiên.
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+
+class Prefetcher:
+    """Hàng đợi tải trước có giới hạn, dùng chung giữa các phiên; mỗi phiên (owner) hủy được việc của mình."""
+
+    def __init__(self, client, thumbnail_cache=None, max_workers=2, max_pending=16, image_count=10, max_remembered=256,
+                 taxon_ttl=7 * 24 * 3600, image_url_ttl=24 * 3600):
+        self.client = client
+        self.thumbnail_cache = thumbnail_cache
+        self.max_pending = max_pending
+        self.image_count = image_count
+        self.max_remembered = max_remembered
+        self.taxon_ttl = taxon_ttl
+        self.image_url_ttl = image_url_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._jobs = {} # owner -> (sự kiện hủy, danh sách (tên khoa học, Future))
+        self._in_progress = set() # Tên khoa học đang được tải (tránh trùng giữa các phiên)
+        self._taxon_ids = OrderedDict() # tên khoa học -> (taxon id, thời điểm tải)
+        self._image_urls = OrderedDict() # taxon id -> (danh sách URL ảnh, thời điểm tải)
+
+    def prefetch(self, owner, scientific_names):
+        """Hủy việc cũ của `owner` rồi xếp lịch tải trước cho các tên chưa có dữ liệu."""
+        self.cancel(owner)
+        cancelled = threading.Event()
+        jobs = []
+        with self._lock:
+            for name in dict.fromkeys(n for n in scientific_names if n):
+                if self._fresh(self._taxon_ids, name, self.taxon_ttl) is not None or name in self._in_progress:
+                    continue
+                if self._pending >= self.max_pending:
+                    metrics.incr('prefetch.dropped')
+                    continue
+                self._pending += 1
+                self._in_progress.add(name)
+                jobs.append((name, self._executor.submit(self._run, name, cancelled)))
+            self._jobs[owner] = (cancelled, jobs)
+            metrics.set_gauge('prefetch.pending', self._pending)
+        if jobs:
+            metrics.incr('prefetch.scheduled', len(jobs))
+
+    def cancel(self, owner):
+        """Hủy các việc chưa chạy của `owner`; việc đang chạy dừng ở bước kế tiếp."""
+        with self._lock:
+            job = self._jobs.pop(owner, None)
+        if job is None:
+            return
+        cancelled, jobs = job
+        cancelled.set()
+        for name, future in jobs:
+            if future.cancel():
+                # Việc bị hủy trước khi chạy không vào `_run`, nên phải tự bỏ tên khỏi `_in_progress`
+                metrics.incr('prefetch.cancelled')
+                self._finish_pending(name)
+
+    def _finish_pending(self, scientific_name):
+        with self._lock:
+            self._in_progress.discard(scientific_name)
+            self._pending -= 1
+            metrics.set_gauge('prefetch.pending', self._pending)
+
+    def _remember(self, mapping, key, value):
+        with self._lock:
+            mapping[key] = (value, time.monotonic())
+            mapping.move_to_end(key)
+            while len(mapping) > self.max_remembered:
+                mapping.popitem(last=False)
+
+    def _run(self, scientific_name, cancelled):
+        try:
+            if cancelled.is_set():
+                return
+            taxon_id = self.client.get_taxon_id(scientific_name)
+            self._remember(self._taxon_ids, scientific_name, taxon_id)
+            if taxon_id is None or cancelled.is_set():
+                return
+            urls = self.client.get_observation_photo_urls(taxon_id, count=self.image_count)
+            self._remember(self._image_urls, taxon_id, urls)
+            if self.thumbnail_cache is not None and urls and not cancelled.is_set():
+                self.thumbnail_cache.get_thumbnails(urls)
+            metrics.incr('prefetch.completed')
+        except Exception as e:
+            print(f"PREFETCH: Failed for '{scientific_name}': {e}")
+            metrics.incr('prefetch.errors')
+        finally:
+            self._finish_pending(scientific_name)
+
+    @staticmethod
+    def _fresh(mapping, key, ttl):
+        """Mục (giá trị, thời điểm tải) của `key` nếu còn trong hạn `ttl` giây; mục quá hạn bị bỏ. Gọi khi giữ `_lock`."""
+        entry = mapping.get(key)
+        if entry is not None and time.monotonic() - entry[1] > ttl:
+            del mapping[key]
+            entry = None
+        return entry
+
+    def lookup_image_urls(self, taxon_id):
+        """URL ảnh đã tải trước cho `taxon_id` (None nếu chưa có hoặc đã quá hạn); ghi nhận hit/miss."""
+        with self._lock:
+            entry = self._fresh(self._image_urls, taxon_id, self.image_url_ttl)
+        urls = entry[0] if entry is not None else None
+        metrics.incr('prefetch.hits' if urls is not None else 'prefetch.misses')
+        return urls
+
+    def stats(self):
+        hits = metrics.counter('prefetch.hits')
+        misses = metrics.counter('prefetch.misses')
+        return {'pending': self._pending, 'hit_rate': hits / (hits + misses) if hits + misses else None}
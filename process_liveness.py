@@ -0,0 +1,27 @@
+# process_liveness.py
+# Kiểm tra một tiến trình còn sống theo pid, dùng để lấy lại file khóa / segment của tiến trình đã chết
+# (spool hàng đợi phản hồi, bộ gộp manifest). Không phụ thuộc module nào khác của app.
+
+import os
+
+
+def pid_alive(pid):
+    """Tiến trình `pid` còn chạy không (dùng để lấy lại file khóa của tiến trình đã chết)."""
+    if os.name == 'nt':
+        # Trên Windows os.kill(pid, 0) là gửi CTRL_C_EVENT, không phải phép kiểm tra
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259 # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
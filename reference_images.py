@@ -0,0 +1,172 @@
+# reference_images.py
+# Dịch vụ ảnh tham khảo: tải ảnh iNaturalist song song trên thread pool, thu nhỏ một lần thành
+# thumbnail WebP/JPEG, lưu vào cache đĩa LRU giới hạn dung lượng (khóa theo photo id).
+# Lưới ảnh trong app được phục vụ từ cache này thay vì mỗi trình duyệt tự tải ảnh 'medium' từ iNaturalist.
+
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import features
+
+from admission import check_upload
+from imaging import open_image
+from metrics import metrics
+
+_PHOTO_ID_RE = re.compile(r'/photos/(\d+)/')
+
+
+def photo_id_from_url(url):
+    """Photo id iNaturalist trong URL (.../photos/<id>/medium.jpg); nếu không có thì dùng băm của URL."""
+    match = _PHOTO_ID_RE.search(url)
+    return match.group(1) if match else hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+
+
+class ThumbnailCache:
+    """Cache thumbnail trên đĩa, LRU theo mtime (được 'chạm' mỗi lần dùng), tổng dung lượng <= `max_bytes`."""
+
+    def __init__(self, directory, max_bytes, thumb_size=200, image_format='WEBP', quality=80,
+                 fetch_workers=8, session=None, max_fetch_bytes=5 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_fetch_bytes = max_fetch_bytes
+        self.thumb_size = thumb_size
+        # Bản Pillow không có WebP thì dùng JPEG
+        self.image_format = image_format if image_format != 'WEBP' or features.check('webp') else 'JPEG'
+        self.extension = '.webp' if self.image_format == 'WEBP' else '.jpg'
+        self.quality = quality
+        self.session = session
+        self._executor = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='thumbnail')
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._scan())
+        metrics.set_gauge('thumbnails.cache_bytes', self._total_bytes)
+
+    def _path(self, photo_id):
+        return os.path.join(self.directory, photo_id[-2:], f"{photo_id}{self.extension}")
+
+    def _scan(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(self.extension):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue # Tiến trình khác vừa xóa
+                    yield path, stat.st_size, stat.st_mtime
+
+    def get(self, photo_id):
+        path = self._path(photo_id)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path) # Đánh dấu vừa dùng cho LRU
+            return data
+        except OSError:
+            return None
+
+    def put(self, photo_id, data):
+        path = self._path(photo_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._total_bytes += len(data)
+            needs_eviction = self._total_bytes > self.max_bytes
+        if needs_eviction:
+            self._evict()
+
+    def _evict(self):
+        """Xóa file cũ nhất đến khi còn 90% giới hạn (quét lại thư mục vì nhiều worker cùng ghi)."""
+        with self._lock:
+            entries = sorted(self._scan(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    metrics.incr('thumbnails.evictions')
+                except OSError:
+                    pass
+            self._total_bytes = total
+        metrics.set_gauge('thumbnails.cache_bytes', total)
+
+    def _make_thumbnail(self, image_bytes):
+        img = open_image(image_bytes, (self.thumb_size, self.thumb_size))
+        img.thumbnail((self.thumb_size, self.thumb_size))
+        out = io.BytesIO()
+        img.save(out, format=self.image_format, quality=self.quality)
+        return out.getvalue()
+
+    def _download(self, url, timeout):
+        """Tải ảnh gốc theo luồng, dừng ngay khi vượt `max_fetch_bytes` (không đọc cả phản hồi vào bộ nhớ)."""
+        if self.session is not None:
+            get = self.session.get
+        else:
+            import requests
+            get = requests.get
+        with get(url, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+            length = response.headers.get('Content-Length', '')
+            if length.isdigit() and int(length) > self.max_fetch_bytes:
+                raise ValueError(f"response too large ({length} bytes)")
+            chunks, size = [], 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > self.max_fetch_bytes:
+                    raise ValueError(f"response larger than {self.max_fetch_bytes} bytes")
+                chunks.append(chunk)
+        return b''.join(chunks)
+
+    def _fetch(self, url, photo_id, timeout):
+        started = time.perf_counter()
+        try:
+            # Cùng kiểm tra header như ảnh người dùng tải lên (định dạng, số pixel, số khung hình) trước khi giải mã
+            admission = check_upload(self._download(url, timeout))
+            if not admission.ok:
+                raise ValueError(f"rejected by admission check ({admission.reason})")
+            data = self._make_thumbnail(admission.image_bytes)
+            self.put(photo_id, data)
+            return data
+        except Exception as e:
+            print(f"THUMBNAILS: Failed to fetch {url}: {e}")
+            metrics.incr('thumbnails.fetch_errors')
+            return None
+        finally:
+            metrics.observe('thumbnails.fetch_ms', (time.perf_counter() - started) * 1000.0)
+
+    def get_thumbnails(self, urls, timeout=10):
+        """Thumbnail (bytes) theo đúng thứ tự `urls`; ảnh chưa có trong cache được tải song song. Lỗi -> None."""
+        results = [None] * len(urls)
+        pending = {}
+        for position, url in enumerate(urls):
+            photo_id = photo_id_from_url(url)
+            cached = self.get(photo_id)
+            if cached is not None:
+                metrics.incr('thumbnails.hits')
+                results[position] = cached
+            else:
+                metrics.incr('thumbnails.misses')
+                pending[position] = self._executor.submit(self._fetch, url, photo_id, timeout)
+        for position, future in pending.items():
+            results[position] = future.result()
+        return results
+
+    def stats(self):
+        hits = metrics.counter('thumbnails.hits')
+        misses = metrics.counter('thumbnails.misses')
+        return {
+            'cache_bytes': self._total_bytes,
+            'hit_rate': hits / (hits + misses) if hits + misses else None,
+            'fetch_ms': metrics.snapshot()['histograms'].get('thumbnails.fetch_ms'),
+        }
@@ -0,0 +1,284 @@
+# similarity_index.py
+# Chỉ mục láng giềng gần đúng trên embedding lớp áp chót của model cho các ảnh phản hồi đã được gán nhãn.
+# Ngay sau khi dự đoán, app tra chỉ mục (vài ms, không gọi mạng) để gợi ý các loài người dùng đã xác nhận
+# cho ảnh tương tự, kể cả loài nằm ngoài CLASS_NAMES.
+#
+# Vector được chuẩn hóa L2 rồi lượng tử hóa int8 (kèm hệ số tỉ lệ float32 cho mỗi vector). Khi đủ dữ liệu,
+# các vector được chia vào `n_lists` cụm (IVF, k-means); truy vấn chỉ quét `n_probe` cụm gần nhất.
+#
+# Bố cục thư mục:
+#   items.jsonl   mỗi dòng một ảnh: nhãn, doc id, đường dẫn, vector int8 (hex) và scale; chỉ ghi nối
+#                 (mỗi lô là một lần ghi O_APPEND nên nhiều tiến trình cùng ghi không xen lẫn nhau)
+#   centroids.npy tâm cụm IVF (dựng lại bằng: python similarity_index.py train)
+#
+# Dựng từ dữ liệu đã thu thập: python similarity_index.py build --source manifest --backend local
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from config import SIMILARITY_INDEX_DIR, SIMILARITY_N_LISTS, SIMILARITY_N_PROBE, MANIFEST_DIR, MODEL_PATH
+from metrics import metrics
+
+# Số vector tối thiểu (trên mỗi cụm) trước khi chia cụm; ít hơn thì quét toàn bộ (đã đủ nhanh)
+MIN_VECTORS_PER_LIST = 32
+
+
+def quantize(vectors):
+    """Chuẩn hóa L2 rồi lượng tử hóa int8 theo từng hàng: trả (int8 (N, dim), scale float32 (N,))."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def kmeans(data, k, iterations=20, seed=0):
+    """K-means (độ giống cosine) vector hóa bằng NumPy, dùng để chia cụm IVF."""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(data @ centroids.T, axis=1)
+        for cluster in range(k):
+            members = data[assignments == cluster]
+            if len(members):
+                centroid = members.mean(axis=0)
+                centroids[cluster] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids.astype(np.float32)
+
+
+class SimilarityIndex:
+    """Chỉ mục IVF + int8 trong bộ nhớ, bền vững qua các file chỉ ghi nối trong `directory`."""
+
+    def __init__(self, directory=SIMILARITY_INDEX_DIR, n_lists=SIMILARITY_N_LISTS, n_probe=SIMILARITY_N_PROBE):
+        self.directory = directory
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        os.makedirs(directory, exist_ok=True)
+        self._items_path = os.path.join(directory, 'items.jsonl')
+        self._centroids_path = os.path.join(directory, 'centroids.npy')
+        self._lock = threading.Lock()
+        self.dim = None
+        self._vectors = None # int8 (dung lượng, dim), chỉ `self._count` hàng đầu hợp lệ
+        self._scales = np.empty(0, dtype=np.float32)
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._count = 0
+        self.items = []
+        self._items_offset = 0
+        self._centroids = None
+        self._centroids_mtime = None
+        started = time.perf_counter()
+        with self._lock:
+            self._refresh()
+        print(f"SIMILARITY: Loaded {self._count} vectors in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def __len__(self):
+        return self._count
+
+    # --- Đọc phần mới ghi thêm ---
+    def _refresh(self):
+        """Nạp các hàng mới (của tiến trình này hoặc tiến trình khác) và tâm cụm mới nếu được dựng lại."""
+        try:
+            mtime = os.path.getmtime(self._centroids_path)
+        except OSError:
+            mtime = None
+        if mtime != self._centroids_mtime:
+            self._centroids = np.load(self._centroids_path) if mtime is not None else None
+            self._centroids_mtime = mtime
+            if self._centroids is not None and self._count:
+                # Lần nạp đầu (chưa có hàng nào) thì các hàng được gán cụm trong _append_rows
+                self._assignments = self._assign(self._dequantized(0, self._count))
+
+        try:
+            with open(self._items_path, 'rb') as f:
+                f.seek(self._items_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1 # Bỏ qua dòng cuối đang ghi dở
+        new_items = [json.loads(line) for line in data[:end].decode('utf-8').splitlines() if line]
+        self._items_offset += end
+        if not new_items:
+            return
+        if self.dim is None:
+            self.dim = len(new_items[0]['vector']) // 2
+        vectors = np.frombuffer(bytes.fromhex(''.join(item.pop('vector') for item in new_items)),
+                                dtype=np.int8).reshape(len(new_items), self.dim)
+        scales = np.array([item.pop('scale') for item in new_items], dtype=np.float32)
+        self._append_rows(vectors, scales)
+        self.items.extend(new_items)
+        metrics.set_gauge('similarity.index_size', self._count)
+
+    def _append_rows(self, vectors, scales):
+        first, count = self._count, len(vectors)
+        if self._vectors is None or first + count > len(self._vectors):
+            capacity = max(1024, 2 * (first + count))
+            grown = np.empty((capacity, self.dim), dtype=np.int8)
+            if self._vectors is not None:
+                grown[:first] = self._vectors[:first]
+            self._vectors = grown
+        self._vectors[first:first + count] = vectors
+        self._scales = np.concatenate([self._scales, scales])
+        self._count += count
+        if self._centroids is not None:
+            self._assignments = np.concatenate([self._assignments, self._assign(self._dequantized(first, self._count))])
+
+    def _dequantized(self, start, stop):
+        return self._vectors[start:stop].astype(np.float32) * self._scales[start:stop, None]
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+
+    # --- Ghi ---
+    def add(self, embeddings, items):
+        """Thêm vector (N, dim) cùng thông tin từng ảnh (dict: label, doc_id, storage_path)."""
+        quantized, scales = quantize(np.atleast_2d(embeddings))
+        with self._lock:
+            self._refresh()
+            if self.dim is None:
+                self.dim = quantized.shape[1]
+            elif quantized.shape[1] != self.dim:
+                raise ValueError(f"Embedding has {quantized.shape[1]} dims, index has {self.dim}")
+            lines = ''.join(
+                json.dumps(dict(item, vector=vector.tobytes().hex(), scale=float(scale)), ensure_ascii=False) + '\n'
+                for item, vector, scale in zip(items, quantized, scales))
+            fd = os.open(self._items_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, lines.encode('utf-8'))
+            finally:
+                os.close(fd)
+            self._refresh()
+            needs_training = self._centroids is None and self._count >= self.n_lists * MIN_VECTORS_PER_LIST
+        metrics.incr('similarity.added', len(items))
+        if needs_training:
+            self.train()
+
+    def train(self, iterations=20):
+        """Chia cụm IVF lại trên toàn bộ vector hiện có (tiến trình khác tự nạp tâm cụm mới)."""
+        with self._lock:
+            self._refresh()
+            if self._count < self.n_lists:
+                return
+            data = self._dequantized(0, self._count)
+        started = time.perf_counter()
+        centroids = kmeans(data, self.n_lists, iterations)
+        tmp_path = self._centroids_path + '.tmp.npy'
+        np.save(tmp_path, centroids)
+        os.replace(tmp_path, self._centroids_path)
+        with self._lock:
+            self._centroids_mtime = None # Buộc nạp lại và gán cụm lại
+            self._refresh()
+        print(f"SIMILARITY: Trained {self.n_lists} lists on {len(data)} vectors in {time.perf_counter() - started:.1f} s")
+
+    # --- Truy vấn ---
+    def search(self, embedding, k=10):
+        """k ảnh gần nhất: danh sách dict thông tin ảnh kèm 'similarity' (cosine), giống nhất trước."""
+        started = time.perf_counter()
+        with self._lock:
+            self._refresh()
+            if self._count == 0:
+                return []
+            query = np.asarray(embedding, dtype=np.float32).ravel()
+            query = query / max(np.linalg.norm(query), 1e-12)
+            if self._centroids is not None:
+                lists = np.argsort(self._centroids @ query)[::-1][:self.n_probe]
+                rows = np.flatnonzero(np.isin(self._assignments, lists))
+            else:
+                rows = np.arange(self._count)
+            # Tích vô hướng trên int8 đổi sang float32 rồi nhân scale của từng hàng
+            scores = (self._vectors[rows].astype(np.float32) @ query) * self._scales[rows]
+            top = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            results = [dict(self.items[rows[i]], similarity=float(scores[i])) for i in top]
+        metrics.observe('similarity.search_ms', (time.perf_counter() - started) * 1000.0,
+                        buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50))
+        return results
+
+    def suggest_species(self, embedding, k=20, min_similarity=0.5):
+        """Xếp hạng loài theo tổng độ giống của các láng giềng: [{'label', 'score', 'count', 'best'}]."""
+        species = {}
+        for neighbour in self.search(embedding, k):
+            if neighbour['similarity'] < min_similarity:
+                continue
+            entry = species.setdefault(neighbour['label'], {'label': neighbour['label'], 'score': 0.0, 'count': 0, 'best': 0.0})
+            entry['score'] += neighbour['similarity']
+            entry['count'] += 1
+            entry['best'] = max(entry['best'], neighbour['similarity'])
+        return sorted(species.values(), key=lambda entry: -entry['score'])
+
+
+def load_embedding_model(model_path=MODEL_PATH):
+    """Model Keras hai đầu ra: (xác suất, embedding lớp áp chót = đầu vào của lớp Dense cuối)."""
+    import tensorflow as tf
+    model = tf.keras.models.load_model(model_path, compile=False)
+    return tf.keras.Model(model.inputs, [model.output, model.layers[-1].input], name='embedding_model')
+
+
+def build(index, samples, fetch, model_path=MODEL_PATH, batch_size=32):
+    """Thêm embedding cho các mẫu (chưa có trong chỉ mục) từ manifest/Firestore/thư mục."""
+    from tensorflow.keras.applications.vgg16 import preprocess_input
+    from imaging import decode_into
+    from inference import INPUT_SHAPE
+    known = {item.get('doc_id') for item in index.items}
+    todo = [s for s in samples if s['doc_id'] not in known]
+    print(f"SIMILARITY: {len(index)} vectors indexed, {len(todo)} new sample(s)")
+    model = load_embedding_model(model_path)
+    buffer = np.empty((batch_size,) + INPUT_SHAPE, dtype=np.float32)
+    for start in range(0, len(todo), batch_size):
+        items = []
+        for sample in todo[start:start + batch_size]:
+            try:
+                decode_into(fetch(sample['storage_path']), buffer[len(items)], INPUT_SHAPE[1::-1])
+            except Exception as e:
+                print(f"SIMILARITY: Skipping {sample['storage_path']}: {e}")
+                continue
+            items.append({'label': sample['label'], 'doc_id': sample['doc_id'], 'storage_path': sample['storage_path']})
+        if items:
+            _, embeddings = model(preprocess_input(buffer[:len(items)].copy()), training=False)
+            index.add(embeddings.numpy(), items)
+    print(f"SIMILARITY: Index now has {len(index)} vectors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nearest-neighbour index over collected feedback embeddings")
+    parser.add_argument('--dir', default=SIMILARITY_INDEX_DIR)
+    sub = parser.add_subparsers(dest='command', required=True)
+    build_parser = sub.add_parser('build', help="Thêm embedding cho ảnh đã thu thập")
+    build_parser.add_argument('--source', choices=('manifest', 'firestore', 'directory'), default='manifest')
+    build_parser.add_argument('--backend', choices=('firebase', 'local'), default='firebase')
+    build_parser.add_argument('--local-dir', default='local_backend')
+    build_parser.add_argument('--manifest-dir', default=MANIFEST_DIR)
+    build_parser.add_argument('--input', help="Thư mục <nhãn>/<file> (với --source directory)")
+    build_parser.add_argument('--model', default=MODEL_PATH)
+    sub.add_parser('train', help="Chia cụm IVF lại trên toàn bộ vector")
+    args = parser.parse_args()
+
+    index = SimilarityIndex(args.dir)
+    if args.command == 'train':
+        index.train()
+        return
+
+    from export_dataset import samples_from_directory, samples_from_documents, samples_from_manifest, read_file
+    if args.source == 'directory':
+        if not args.input:
+            parser.error("--input is required with --source directory")
+        samples, fetch = samples_from_directory(args.input), read_file
+    else:
+        from feedback_backends import FirebaseBackend, LocalBackend
+        if args.backend == 'local':
+            backend = LocalBackend(args.local_dir)
+        else:
+            import firebase_admin
+            from config import FIREBASE_STORAGE_BUCKET
+            firebase_admin.initialize_app(options={'storageBucket': FIREBASE_STORAGE_BUCKET}) # Dùng GOOGLE_APPLICATION_CREDENTIALS
+            backend = FirebaseBackend()
+        samples = samples_from_manifest(args.manifest_dir) if args.source == 'manifest' else samples_from_documents(backend)
+        fetch = backend.download
+    build(index, list(samples), fetch, args.model)
+
+
+if __name__ == '__main__':
+    main()
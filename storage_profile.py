@@ -0,0 +1,105 @@
+# storage_profile.py
+# Định dạng lưu ảnh phản hồi: mỗi ảnh được mã hóa lại đúng một lần, giới hạn cạnh dài, JPEG/WebP
+# chỉnh chất lượng, bỏ EXIF (vị trí GPS, thông tin máy) và chỉ giữ khung hình đầu của ảnh động.
+# Thông tin mã hóa được ghi vào metadata Firestore (trường `encoding`).
+#
+# Báo cáo dung lượng tiết kiệm theo nhãn: python storage_profile.py report [--backend local]
+
+import argparse
+import io
+from collections import defaultdict
+
+from PIL import features
+
+from config import STORAGE_MAX_LONG_SIDE, STORAGE_FORMAT, STORAGE_QUALITY
+from imaging import open_image
+from metrics import metrics
+
+_CONTENT_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+class StorageProfile:
+    """Mã hóa ảnh để lưu trữ: cạnh dài <= `max_long_side`, định dạng `image_format`, chất lượng `quality`."""
+
+    def __init__(self, max_long_side=STORAGE_MAX_LONG_SIDE, image_format=STORAGE_FORMAT, quality=STORAGE_QUALITY):
+        self.max_long_side = max_long_side
+        # Bản Pillow không có WebP thì dùng JPEG
+        self.image_format = image_format if image_format != 'WEBP' or features.check('webp') else 'JPEG'
+        self.quality = quality
+        self.extension = _EXTENSIONS[self.image_format]
+        self.content_type = _CONTENT_TYPES[self.image_format]
+
+    def encode(self, image_bytes):
+        """Trả về (bytes đã mã hóa, dict mô tả mã hóa để lưu vào metadata)."""
+        bound = (self.max_long_side, self.max_long_side)
+        img = open_image(image_bytes, bound) # Xoay theo EXIF, RGB, khung đầu; JPEG lớn được giải mã thu nhỏ
+        source_size = img.size
+        img.thumbnail(bound) # Giữ tỉ lệ, không phóng to ảnh nhỏ
+        out = io.BytesIO()
+        if self.image_format == 'JPEG':
+            img.save(out, format='JPEG', quality=self.quality, optimize=True, progressive=True)
+        else:
+            img.save(out, format='WEBP', quality=self.quality, method=4)
+        data = out.getvalue() # Không truyền exif= nên EXIF/ICC không được ghi lại
+        metrics.incr('storage.original_bytes', len(image_bytes))
+        metrics.incr('storage.stored_bytes', len(data))
+        return data, {
+            u'format': self.image_format,
+            u'quality': self.quality,
+            u'max_long_side': self.max_long_side,
+            u'width': img.size[0],
+            u'height': img.size[1],
+            u'source_width': source_size[0],
+            u'source_height': source_size[1],
+            u'original_bytes': len(image_bytes),
+            u'stored_bytes': len(data),
+            u'exif_stripped': True,
+        }
+
+
+def bytes_saved_report(backend):
+    """Tổng dung lượng gốc / đã lưu theo nhãn, từ trường `encoding` trong metadata đã lưu."""
+    totals = defaultdict(lambda: [0, 0, 0]) # nhãn -> [số ảnh, bytes gốc, bytes lưu]
+    for _, data in backend.iter_documents():
+        encoding = data.get('encoding')
+        if not encoding or data.get('duplicate_of'):
+            continue
+        entry = totals[data.get('label', '?')]
+        entry[0] += 1
+        entry[1] += encoding.get('original_bytes', 0)
+        entry[2] += encoding.get('stored_bytes', 0)
+    return dict(totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage profile for collected feedback images")
+    sub = parser.add_subparsers(dest='command', required=True)
+    report_parser = sub.add_parser('report', help="Dung lượng tiết kiệm theo nhãn")
+    report_parser.add_argument('--backend', choices=('firebase', 'local'), default='firebase')
+    report_parser.add_argument('--local-dir', default='local_backend')
+    args = parser.parse_args()
+
+    from feedback_backends import FirebaseBackend, LocalBackend
+    if args.backend == 'local':
+        backend = LocalBackend(args.local_dir)
+    else:
+        import firebase_admin
+        firebase_admin.initialize_app() # Dùng GOOGLE_APPLICATION_CREDENTIALS
+        backend = FirebaseBackend()
+
+    totals = bytes_saved_report(backend)
+    print(f"{'label':40s} {'images':>7s} {'original MB':>12s} {'stored MB':>10s} {'saved':>7s}")
+    all_original = all_stored = all_count = 0
+    for label, (count, original, stored) in sorted(totals.items(), key=lambda item: -(item[1][1] - item[1][2])):
+        saved = 1 - stored / original if original else 0.0
+        print(f"{label[:40]:40s} {count:7d} {original / 1e6:12.2f} {stored / 1e6:10.2f} {saved:7.1%}")
+        all_count += count
+        all_original += original
+        all_stored += stored
+    saved = 1 - all_stored / all_original if all_original else 0.0
+    print(f"{'TOTAL':40s} {all_count:7d} {all_original / 1e6:12.2f} {all_stored / 1e6:10.2f} {saved:7.1%}")
+
+
+if __name__ == '__main__':
+    main()
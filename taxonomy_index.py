@@ -0,0 +1,220 @@
+# taxonomy_index.py
+# Chỉ mục phân loại cục bộ cho ô tìm loài: tra tiền tố và tra gần đúng (trigram) trong bộ nhớ,
+# không cần gọi mạng. Dữ liệu lấy từ file snapshot taxa + tên tiếng Việt trong SUGGESTED_SPECIES_VN.
+#
+# Làm mới snapshot: python taxonomy_index.py refresh [--max-taxa 5000]
+# Thử tra cứu:      python taxonomy_index.py search "trau ba"
+
+import argparse
+import json
+import os
+import re
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from config import TAXA_SNAPSHOT_PATH, SUGGESTED_SPECIES_VN
+from inat_client import make_suggestion
+from metrics import metrics
+
+# ID của giới Thực vật (Plantae) trên iNaturalist
+PLANTAE_TAXON_ID = 47126
+# Độ giống trigram tối thiểu để nhận một kết quả gần đúng
+FUZZY_MIN_SIMILARITY = 0.35
+
+
+def normalize(text):
+    """Chữ thường, bỏ dấu tiếng Việt, gộp ký tự không phải chữ/số thành một khoảng trắng."""
+    text = unicodedata.normalize('NFD', text.lower().replace('đ', 'd'))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r'[^a-z0-9]+', ' ', text).strip()
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TaxonomyIndex:
+    """Tra cứu tiền tố (bisect trên danh sách khóa đã sắp xếp) và gần đúng (chỉ mục trigram)."""
+
+    def __init__(self, taxa, vietnamese_names=None):
+        self.entries = [] # (id, tên khoa học, tên hiển thị, rank)
+        keys = []
+        by_scientific = {}
+        for taxon in taxa:
+            if not taxon.get('id') or not taxon.get('name'):
+                continue
+            index = len(self.entries)
+            display_name = taxon.get('preferred_common_name') or taxon['name']
+            self.entries.append((taxon['id'], taxon['name'], display_name, taxon.get('rank')))
+            by_scientific[normalize(taxon['name'])] = index
+            for name in (taxon['name'], taxon.get('preferred_common_name')):
+                keys.extend(self._keys_for(name, index))
+
+        # Tên tiếng Việt trỏ tới cùng taxon, nhưng hiển thị bằng tên tiếng Việt
+        for vn_name, scientific_name in (vietnamese_names or {}).items():
+            target = by_scientific.get(normalize(scientific_name))
+            if target is None:
+                continue
+            taxon_id, scientific, _, rank = self.entries[target]
+            index = len(self.entries)
+            self.entries.append((taxon_id, scientific, vn_name, rank))
+            keys.extend(self._keys_for(vn_name, index))
+
+        keys.sort()
+        self._keys = [k for k, _ in keys]
+        self._key_entries = [i for _, i in keys]
+        self._full_names = [normalize(display) + ' ' + normalize(scientific) for _, scientific, display, _ in self.entries]
+        self._trigram_index = defaultdict(list)
+        for index, name in enumerate(self._full_names):
+            for gram in _trigrams(name):
+                self._trigram_index[gram].append(index)
+
+    @staticmethod
+    def _keys_for(name, index):
+        """Khóa cho cả tên đầy đủ và từng hậu tố theo từ ("aureum", "ba vang"), để gõ giữa tên vẫn khớp."""
+        if not name:
+            return []
+        words = normalize(name).split()
+        return [(' '.join(words[i:]), index) for i in range(len(words))]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def prefix_search(self, query, limit=10):
+        q = normalize(query)
+        if not q:
+            return []
+        found = {}
+        position = bisect_left(self._keys, q)
+        while position < len(self._keys) and self._keys[position].startswith(q):
+            index = self._key_entries[position]
+            taxon_id, scientific, display, rank = self.entries[index]
+            # Ưu tiên: khớp từ đầu tên > khớp giữa tên, loài trước chi/họ, tên ngắn trước
+            starts_name = self._full_names[index].startswith(q) or normalize(scientific).startswith(q)
+            score = (0 if starts_name else 1, 0 if rank == 'species' else 1, len(display))
+            key = (taxon_id, display)
+            if key not in found or score < found[key][0]:
+                found[key] = (score, index)
+            position += 1
+        ranked = sorted(found.values())[:limit]
+        return [self._suggestion(index) for _, index in ranked]
+
+    def fuzzy_search(self, query, limit=10):
+        q = normalize(query)
+        if len(q) < 3:
+            return []
+        grams = _trigrams(q)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._trigram_index.get(gram, ()))
+        scored = []
+        for index, _ in counts.most_common(limit * 5):
+            # Độ giống (Dice) so với đoạn tên bắt đầu từ mỗi từ, dài bằng từ khóa (gõ tiền tố có lỗi chính tả)
+            name = self._full_names[index]
+            similarity = 0.0
+            for start in [0] + [m.end() for m in re.finditer(' ', name)]:
+                name_grams = _trigrams(name[start:start + len(q) + 1])
+                similarity = max(similarity, 2 * len(grams & name_grams) / (len(grams) + len(name_grams)))
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                scored.append((-similarity, len(self.entries[index][2]), index))
+        scored.sort()
+        seen, results = set(), []
+        for _, _, index in scored:
+            key = (self.entries[index][0], self.entries[index][2])
+            if key not in seen:
+                seen.add(key)
+                results.append(self._suggestion(index))
+            if len(results) >= limit:
+                break
+        return results
+
+    def search(self, query, limit=10):
+        """Tiền tố trước; nếu không có thì tra gần đúng. Trả danh sách dict gợi ý như iNaturalist autocomplete."""
+        started = time.perf_counter()
+        results = self.prefix_search(query, limit) or self.fuzzy_search(query, limit)
+        metrics.observe('taxonomy.search_ms', (time.perf_counter() - started) * 1000.0,
+                        buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+        return results
+
+    def _suggestion(self, index):
+        taxon_id, scientific, display, rank = self.entries[index]
+        return make_suggestion(taxon_id, scientific, display, rank)
+
+
+def load_index(snapshot_path=TAXA_SNAPSHOT_PATH):
+    """Đọc snapshot và tạo chỉ mục; trả None nếu chưa có snapshot (app sẽ chỉ dùng API)."""
+    if not os.path.exists(snapshot_path):
+        print(f"TAXONOMY: Snapshot '{snapshot_path}' not found, local autocomplete disabled")
+        return None
+    started = time.perf_counter()
+    with open(snapshot_path, encoding='utf-8') as f:
+        snapshot = json.load(f)
+    index = TaxonomyIndex(snapshot.get('taxa', []), SUGGESTED_SPECIES_VN)
+    print(f"TAXONOMY: Indexed {len(index)} names in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return index
+
+
+def refresh_snapshot(snapshot_path=TAXA_SNAPSHOT_PATH, max_taxa=5000, per_page=200):
+    """Tải danh sách taxa thực vật phổ biến nhất từ iNaturalist và ghi snapshot mới (ghi đè an toàn)."""
+    from inat_client import INatClient
+    client = INatClient(cache_path=None) # Luôn lấy dữ liệu mới
+    fields = ('id', 'name', 'preferred_common_name', 'rank')
+    taxa = {}
+    page = 1
+    while len(taxa) < max_taxa:
+        data = client.get_json('taxa', {
+            'taxon_id': PLANTAE_TAXON_ID, 'is_active': 'true', 'rank': 'species,genus,family',
+            'order_by': 'observations_count', 'order': 'desc', 'per_page': per_page, 'page': page,
+        }, timeout=30)
+        results = data.get('results') or []
+        for result in results:
+            taxa[result['id']] = {k: result.get(k) for k in fields}
+        print(f"TAXONOMY: Page {page}: {len(taxa)} taxa")
+        if len(results) < per_page:
+            break
+        page += 1
+    # Đảm bảo các loài gợi ý tiếng Việt luôn có trong snapshot
+    for scientific_name in SUGGESTED_SPECIES_VN.values():
+        data = client.get_json('taxa', {'q': scientific_name, 'is_active': 'true'}, timeout=30)
+        for result in (data.get('results') or [])[:1]:
+            taxa[result['id']] = {k: result.get(k) for k in fields}
+
+    directory = os.path.dirname(snapshot_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'taxa': list(taxa.values())}, f, ensure_ascii=False)
+    os.replace(tmp_path, snapshot_path)
+    print(f"TAXONOMY: Wrote {len(taxa)} taxa to {snapshot_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local taxonomy index for species autocomplete")
+    sub = parser.add_subparsers(dest='command', required=True)
+    refresh_parser = sub.add_parser('refresh', help="Tải lại snapshot taxa từ iNaturalist")
+    refresh_parser.add_argument('--output', default=TAXA_SNAPSHOT_PATH)
+    refresh_parser.add_argument('--max-taxa', type=int, default=5000)
+    search_parser = sub.add_parser('search', help="Tra thử một từ khóa")
+    search_parser.add_argument('query')
+    args = parser.parse_args()
+
+    if args.command == 'refresh':
+        refresh_snapshot(args.output, args.max_taxa)
+        return
+    index = load_index()
+    if index is not None:
+        started = time.perf_counter()
+        results = index.search(args.query)
+        elapsed = (time.perf_counter() - started) * 1000
+        for suggestion in results:
+            print(suggestion['formatted_display'])
+        print(f"{len(results)} results in {elapsed:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
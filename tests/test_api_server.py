@@ -0,0 +1,93 @@
+# tests/test_api_server.py
+
+import http.client
+import io
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import api_server
+from config import CLASS_NAMES
+
+
+class StubClassifier:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def predict(self, images):
+        time.sleep(self.delay)
+        probabilities = np.zeros((len(images), len(CLASS_NAMES)), dtype=np.float32)
+        probabilities[:, 0] = 1.0
+        return probabilities
+
+
+class ReadyLoader:
+    ready, failed, error, load_ms = True, False, None, 0.0
+
+    def __init__(self, classifier):
+        self.result = classifier
+
+
+def _jpeg():
+    out = io.BytesIO()
+    Image.new('RGB', (64, 64), 'green').save(out, format='JPEG')
+    return out.getvalue()
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(classifier, workers=2, max_pending=0):
+        server = api_server.BoundedThreadingHTTPServer(('127.0.0.1', 0), api_server.PredictionHandler,
+                                                       ReadyLoader(classifier), workers=workers, max_pending=max_pending)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server.server_address[1]
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _post(port, body, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    connection.request('POST', '/predict', body=body, headers=headers or {'Content-Type': 'image/jpeg'})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def test_idle_keepalive_connections_do_not_block_others(serve):
+    port = serve(StubClassifier(), workers=2)
+    idle = []
+    for _ in range(3): # Nhiều kết nối keep-alive rảnh hơn số worker
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        connection.request('GET', '/healthz')
+        connection.getresponse().read()
+        idle.append(connection)
+    started = time.perf_counter()
+    assert _post(port, _jpeg()) == 200
+    assert time.perf_counter() - started < 2.0
+    for connection in idle:
+        connection.close()
+
+
+def test_busy_when_inference_slots_are_full(serve):
+    port = serve(StubClassifier(delay=0.5), workers=1, max_pending=0)
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(_post(port, _jpeg()))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(statuses) == [200, 503, 503]
+
+
+def test_malformed_content_length_is_bad_request(serve):
+    port = serve(StubClassifier())
+    assert _post(port, b'', {'Content-Length': 'abc'}) == 400
@@ -0,0 +1,61 @@
+# tests/test_cascade.py
+
+import numpy as np
+
+from cascade import Cascade
+from config import CLASS_NAMES
+
+
+class StubStage:
+    """Tầng giả: độ tin cậy của ảnh i lấy từ `confidences[pixel đầu của ảnh]`; embedding = giá trị pixel đó."""
+
+    def __init__(self, confidences, with_embeddings=True):
+        self.confidences = confidences
+        self.with_embeddings = with_embeddings
+        self.seen = []
+
+    def predict_with_embeddings(self, images, timeout=None):
+        ids = [int(image[0, 0, 0]) for image in images]
+        self.seen.extend(ids)
+        probabilities = np.zeros((len(images), len(CLASS_NAMES)), dtype=np.float32)
+        probabilities[:, 0] = [self.confidences[i] for i in ids]
+        embeddings = np.array([[float(i)] * 4 for i in ids], dtype=np.float32) if self.with_embeddings else None
+        return probabilities, embeddings
+
+    def predict(self, images, timeout=None):
+        return self.predict_with_embeddings(images, timeout=timeout)[0]
+
+    def embed(self, images, timeout=None):
+        return self.predict_with_embeddings(images, timeout=timeout)[1]
+
+
+def _images(n):
+    images = np.zeros((n, 4, 4, 3), dtype=np.float32)
+    images[:, 0, 0, 0] = np.arange(n)
+    return images
+
+
+def test_embeddings_are_returned_per_row():
+    small = StubStage({0: 0.99, 1: 0.5, 2: 0.99, 3: 0.6})
+    large = StubStage({1: 0.8, 3: 0.7})
+    probabilities, embeddings = Cascade(small, large, threshold=95.0).predict_with_embeddings(_images(4))
+
+    assert large.seen == [1, 3] # Chỉ ảnh chưa đủ chắc mới lên tầng lớn
+    np.testing.assert_allclose(probabilities[:, 0], [0.99, 0.8, 0.99, 0.7])
+    assert embeddings[0] is None and embeddings[2] is None
+    np.testing.assert_array_equal(embeddings[1], [1.0] * 4)
+    np.testing.assert_array_equal(embeddings[3], [3.0] * 4)
+
+
+def test_embed_uses_large_stage_for_confident_rows():
+    small = StubStage({0: 0.99})
+    large = StubStage({0: 0.8})
+    cascade = Cascade(small, large, threshold=95.0)
+    assert cascade.predict_with_embeddings(_images(1))[1] == [None]
+    np.testing.assert_array_equal(cascade.embed(_images(1))[0], [0.0] * 4)
+
+
+def test_no_embeddings_when_large_stage_has_none():
+    small = StubStage({0: 0.5, 1: 0.99})
+    large = StubStage({0: 0.8}, with_embeddings=False)
+    assert Cascade(small, large, threshold=95.0).predict_with_embeddings(_images(2))[1] is None
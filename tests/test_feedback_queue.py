@@ -0,0 +1,71 @@
+# tests/test_feedback_queue.py
+
+import os
+import subprocess
+import sys
+
+from feedback_backends import MemoryBackend
+from feedback_queue import FeedbackUploadQueue
+from metrics import metrics
+
+
+class FailingBackend(MemoryBackend):
+    def upload(self, storage_path, data, content_type):
+        raise ConnectionError('offline')
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_jobs_are_uploaded_and_removed_from_spool(tmp_path):
+    backend = MemoryBackend()
+    feedback_queue = FeedbackUploadQueue(str(tmp_path / 'spool'), backend, flush_interval=0.05)
+    feedback_queue.enqueue(b'image-1', 'a/1.jpg', 'image/jpeg', 'doc-1', {'label': 'a'})
+    feedback_queue.enqueue(b'original', 'originals/a/1.jpg', 'image/jpeg')
+    assert feedback_queue.wait_idle(10)
+    feedback_queue.stop(5)
+
+    assert backend.blobs == {'a/1.jpg': b'image-1', 'originals/a/1.jpg': b'original'}
+    assert list(backend.collections['plant_feedback']) == ['doc-1']
+    assert [name for name in os.listdir(tmp_path / 'spool') if name != 'dead_letter'] == []
+
+
+def test_pending_jobs_survive_restart(tmp_path):
+    spool = str(tmp_path / 'spool')
+    first = FeedbackUploadQueue(spool, FailingBackend(), flush_interval=0.05)
+    first.stop(5) # Worker đã dừng: việc chỉ còn nằm trong spool
+    first.enqueue(b'image-1', 'a/1.jpg', 'image/jpeg', 'doc-1', {'label': 'a'})
+    first.enqueue_document('doc-2', {'label': 'b'})
+    for name in os.listdir(spool): # Tiến trình cũ "chết" khi đang giữ khóa
+        if name.endswith('.lock'):
+            with open(os.path.join(spool, name), 'w') as f:
+                f.write(str(_dead_pid()))
+
+    backend = MemoryBackend()
+    second = FeedbackUploadQueue(spool, backend, flush_interval=0.05)
+    assert second.wait_idle(10)
+    second.stop(5)
+    assert backend.blobs == {'a/1.jpg': b'image-1'}
+    assert sorted(backend.collections['plant_feedback']) == ['doc-1', 'doc-2']
+
+
+def test_failed_jobs_move_to_dead_letter(tmp_path):
+    spool = str(tmp_path / 'spool')
+    before = metrics.counter('feedback.dead_lettered')
+    feedback_queue = FeedbackUploadQueue(spool, FailingBackend(), max_retries=1, backoff=0.0, flush_interval=0.05)
+    job_id = feedback_queue.enqueue(b'image-1', 'a/1.jpg', 'image/jpeg', 'doc-1', {'label': 'a'})
+    assert feedback_queue.wait_idle(10)
+    feedback_queue.stop(5)
+
+    assert metrics.counter('feedback.dead_lettered') == before + 1
+    assert sorted(os.listdir(feedback_queue.dead_letter_dir)) == [f"{job_id}.bin", f"{job_id}.json"]
+    assert [name for name in os.listdir(spool) if name != 'dead_letter'] == []
+
+
+def test_stop_ends_idle_workers(tmp_path):
+    feedback_queue = FeedbackUploadQueue(str(tmp_path / 'spool'), MemoryBackend(), upload_workers=3)
+    feedback_queue.stop(5)
+    assert not any(thread.is_alive() for thread in feedback_queue._threads)
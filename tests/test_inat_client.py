@@ -0,0 +1,55 @@
+# tests/test_inat_client.py
+
+import threading
+
+import pytest
+import requests
+
+from inat_client import INatClient
+from inat_stub import INatStubServer
+
+
+def test_retries_transient_failures():
+    with INatStubServer(fail_first=2) as server:
+        client = INatClient(base_url=server.base_url, cache_path=None, backoff=0.0)
+        assert client.get_taxon_id('Monstera deliciosa') == 47128
+        assert server.request_count == 3
+
+
+def test_gives_up_after_max_retries():
+    with INatStubServer(fail_first=10, fail_status=503) as server:
+        client = INatClient(base_url=server.base_url, cache_path=None, max_retries=2, backoff=0.0)
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.get_taxon_id('Monstera deliciosa')
+        assert server.request_count == 3
+
+
+def test_client_errors_are_not_retried():
+    with INatStubServer(fail_first=1, fail_status=404) as server:
+        client = INatClient(base_url=server.base_url, cache_path=None, backoff=0.0)
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.get_taxon_id('Monstera deliciosa')
+        assert server.request_count == 1
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    with INatStubServer(delay=0.3) as server:
+        client = INatClient(base_url=server.base_url, cache_path=None)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.get_taxon_id('Ficus lyrata')))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [47131] * 5
+        assert server.request_count == 1
+
+
+def test_disk_cache_serves_repeat_requests(tmp_path):
+    with INatStubServer() as server:
+        client = INatClient(base_url=server.base_url, cache_path=str(tmp_path / 'inat.db'))
+        first = client.get_observation_photo_urls(47127, count=3)
+        assert INatClient(base_url=server.base_url, cache_path=str(tmp_path / 'inat.db')) \
+            .get_observation_photo_urls(47127, count=3) == first
+        assert len(first) == 3 and server.request_count == 1
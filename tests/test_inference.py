@@ -0,0 +1,56 @@
+# tests/test_inference.py
+
+import numpy as np
+import pytest
+
+from inference import BatchingScheduler
+
+
+class RecordingModel:
+    """predict_fn giả: ghi lại cỡ từng lô; xác suất = pixel đầu của ảnh, embedding = pixel đó nhân 2."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, images):
+        self.batch_sizes.append(len(images))
+        return images[:, 0, 0, :1].copy(), images[:, 0, 0, :] * 2
+
+
+def _images(start, count):
+    images = np.zeros((count, 2, 2, 3), dtype=np.float32)
+    images[:, 0, 0, :] = np.arange(start, start + count, dtype=np.float32)[:, None]
+    return images
+
+
+def test_large_request_is_split_and_joined_in_order():
+    model = RecordingModel()
+    scheduler = BatchingScheduler(model, max_batch_size=4, max_wait_ms=0)
+    probabilities, embeddings = scheduler.predict_with_embeddings(_images(0, 10), timeout=5)
+    assert max(model.batch_sizes) <= 4 and sum(model.batch_sizes) == 10
+    np.testing.assert_array_equal(probabilities[:, 0], np.arange(10))
+    np.testing.assert_array_equal(embeddings[:, 0], np.arange(10) * 2)
+
+
+def test_requests_that_do_not_fit_are_held_for_next_batch():
+    model = RecordingModel()
+    scheduler = BatchingScheduler(model, max_batch_size=4, max_wait_ms=500)
+    futures = [scheduler.submit(_images(0, 1))] + [scheduler.submit(_images(10 * n, 3)) for n in range(1, 4)]
+    assert futures[0].result(5)[0][0, 0] == 0
+    for n, future in enumerate(futures[1:], start=1):
+        np.testing.assert_array_equal(future.result(5)[0][:, 0], np.arange(10 * n, 10 * n + 3))
+    assert model.batch_sizes == [4, 3, 3] # 1 + 3 vừa một lô; 3 + 3 > 4 nên yêu cầu sau chờ lô kế tiếp
+
+
+def test_split_request_reports_part_failure():
+    calls = []
+
+    def flaky(images):
+        calls.append(len(images))
+        if len(calls) == 2:
+            raise RuntimeError('out of memory')
+        return images[:, 0, 0, :1]
+
+    scheduler = BatchingScheduler(flaky, max_batch_size=2, max_wait_ms=0)
+    with pytest.raises(RuntimeError, match='out of memory'):
+        scheduler.predict(_images(0, 5), timeout=5)
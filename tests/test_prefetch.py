@@ -0,0 +1,75 @@
+# tests/test_prefetch.py
+
+import threading
+
+from prefetch import Prefetcher
+
+
+class BlockingClient:
+    """Client giả: get_taxon_id chờ `release` để các việc sau còn nằm trong hàng đợi của executor."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get_taxon_id(self, scientific_name):
+        with self._lock:
+            self.calls.append(scientific_name)
+        self.started.set()
+        self.release.wait(5)
+        return None
+
+
+def test_cancelled_queued_names_can_be_prefetched_again():
+    client = BlockingClient()
+    prefetcher = Prefetcher(client, max_workers=1)
+    prefetcher.prefetch('session-a', ['s1', 's2', 's3'])
+    assert client.started.wait(5) # s1 đang chạy, s2/s3 còn chờ trong hàng đợi
+
+    prefetcher.cancel('session-a')
+    with prefetcher._lock:
+        assert prefetcher._in_progress == {'s1'}
+        assert prefetcher._pending == 1
+    client.release.set()
+
+    prefetcher.prefetch('session-b', ['s2', 's3'])
+    prefetcher._executor.shutdown(wait=True)
+    assert client.calls == ['s1', 's2', 's3']
+    assert prefetcher._in_progress == set()
+    assert prefetcher._pending == 0
+
+
+class InstantClient:
+    def __init__(self):
+        self.calls = []
+
+    def get_taxon_id(self, scientific_name):
+        self.calls.append(scientific_name)
+        return 47127
+
+    def get_observation_photo_urls(self, taxon_id, count=10):
+        return [f"https://example.org/{taxon_id}/{n}.jpg" for n in range(count)]
+
+
+def test_prefetched_data_expires_after_ttl(monkeypatch):
+    import prefetch
+    now = [1000.0]
+    monkeypatch.setattr(prefetch.time, 'monotonic', lambda: now[0])
+    client = InstantClient()
+    prefetcher = Prefetcher(client, max_workers=1, image_count=2, taxon_ttl=60, image_url_ttl=30)
+    prefetcher.prefetch('session-a', ['s1'])
+    prefetcher._executor.shutdown(wait=True)
+    assert prefetcher.lookup_image_urls(47127) == ['https://example.org/47127/0.jpg', 'https://example.org/47127/1.jpg']
+
+    now[0] += 31 # URL ảnh quá hạn, taxon id còn hạn
+    assert prefetcher.lookup_image_urls(47127) is None
+    prefetcher._executor = prefetch.ThreadPoolExecutor(max_workers=1)
+    prefetcher.prefetch('session-a', ['s1'])
+    assert client.calls == ['s1']
+
+    now[0] += 30 # Taxon id cũng quá hạn: tải lại
+    prefetcher.prefetch('session-a', ['s1'])
+    prefetcher._executor.shutdown(wait=True)
+    assert client.calls == ['s1', 's1']
@@ -0,0 +1,58 @@
+# tests/test_reference_images.py
+
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from reference_images import ThumbnailCache
+
+
+def _jpeg(size=(400, 300)):
+    out = io.BytesIO()
+    Image.new('RGB', size, 'green').save(out, format='JPEG')
+    return out.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    bodies = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body, chunked = self.bodies[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        if chunked: # Không có Content-Length: chỉ biết kích thước khi đọc
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def photo_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_limits_and_admission(tmp_path, photo_server):
+    _Handler.bodies = {
+        '/photos/1/medium.jpg': (_jpeg(), False),
+        '/photos/2/medium.jpg': (b'\xff' * 50_000, False), # Content-Length vượt giới hạn
+        '/photos/3/medium.jpg': (b'\xff' * 50_000, True), # Vượt giới hạn khi đang đọc
+        '/photos/4/medium.jpg': (b'not an image', False), # Bị kiểm tra header từ chối
+    }
+    cache = ThumbnailCache(str(tmp_path), 1 << 20, thumb_size=64, image_format='JPEG', max_fetch_bytes=20_000)
+    thumbnails = cache.get_thumbnails([f"{photo_server}/photos/{n}/medium.jpg" for n in range(1, 5)])
+
+    assert max(Image.open(io.BytesIO(thumbnails[0])).size) == 64
+    assert thumbnails[1:] == [None, None, None]
+    assert cache.get('1') == thumbnails[0]
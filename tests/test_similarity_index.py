@@ -0,0 +1,32 @@
+# tests/test_similarity_index.py
+
+import numpy as np
+
+from similarity_index import MIN_VECTORS_PER_LIST, SimilarityIndex
+
+
+def _add_random(index, count, dim=16, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+    index.add(vectors, [{'label': f"label_{i % 3}", 'doc_id': str(i), 'storage_path': f"p/{i}.jpg"}
+                        for i in range(count)])
+    return vectors
+
+
+def test_reload_after_training(tmp_path):
+    index = SimilarityIndex(str(tmp_path), n_lists=2, n_probe=2)
+    vectors = _add_random(index, 2 * MIN_VECTORS_PER_LIST + 6)
+    assert (tmp_path / 'centroids.npy').exists() # Đủ vector nên đã tự chia cụm
+
+    reloaded = SimilarityIndex(str(tmp_path), n_lists=2, n_probe=2)
+    assert len(reloaded) == len(vectors)
+    assert len(reloaded._assignments) == len(vectors)
+    nearest = reloaded.search(vectors[5], k=1)
+    assert nearest[0]['doc_id'] == '5'
+
+
+def test_other_process_rows_are_picked_up(tmp_path):
+    reader = SimilarityIndex(str(tmp_path), n_lists=2)
+    writer = SimilarityIndex(str(tmp_path), n_lists=2)
+    vectors = _add_random(writer, 10)
+    assert reader.search(vectors[3], k=1)[0]['doc_id'] == '3'
+    assert len(reader) == 10
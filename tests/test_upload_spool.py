@@ -0,0 +1,62 @@
+# tests/test_upload_spool.py
+
+import os
+
+import upload_spool
+from prediction_cache import image_hash
+from upload_spool import UploadSpool
+
+
+def _age(spool, digest, seconds):
+    """Lùi mtime của ảnh `seconds` giây (giả lập lâu không dùng)."""
+    path = spool._path(digest)
+    mtime = os.stat(path).st_mtime - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_put_is_content_addressed(tmp_path):
+    spool = UploadSpool(str(tmp_path), max_bytes=1 << 20, ttl_seconds=3600)
+    digest = spool.put(b'photo')
+    assert digest == image_hash(b'photo')
+    assert spool.put(b'photo') == digest
+    assert spool.read(digest) == b'photo'
+    assert len(list(spool._scan())) == 1
+
+
+def test_least_recently_used_is_evicted_over_max_bytes(tmp_path):
+    spool = UploadSpool(str(tmp_path), max_bytes=250, ttl_seconds=3600)
+    old, recent = spool.put(b'a' * 100), spool.put(b'b' * 100)
+    _age(spool, old, 30)
+    _age(spool, recent, 20)
+    spool.open(old).close() # Đọc lại "chạm" mtime: ảnh cũ thành ảnh vừa dùng
+    newest = spool.put(b'c' * 100) # 300 > 250 byte: dọn đến <= 90% giới hạn
+    assert spool.open(recent) is None
+    assert spool.read(old) == b'a' * 100
+    assert spool.read(newest) == b'c' * 100
+    assert spool._total_bytes == 200
+
+
+def test_expired_uploads_are_swept(tmp_path, monkeypatch):
+    spool = UploadSpool(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60)
+    stale = spool.put(b'stale')
+    _age(spool, stale, 120)
+    monkeypatch.setattr(upload_spool, 'SWEEP_INTERVAL', 0.0)
+    fresh = spool.put(b'fresh')
+    assert spool.open(stale) is None
+    assert spool.read(fresh) == b'fresh'
+
+
+def test_put_rewrites_file_evicted_concurrently(tmp_path, monkeypatch):
+    spool = UploadSpool(str(tmp_path), max_bytes=1 << 20, ttl_seconds=3600)
+    digest = spool.put(b'photo')
+    real_utime = os.utime
+
+    def evicted_first(path, *args, **kwargs):
+        # Tiến trình khác xóa file ngay trước khi ta "chạm" nó
+        monkeypatch.setattr(upload_spool.os, 'utime', real_utime)
+        os.remove(path)
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(upload_spool.os, 'utime', evicted_first)
+    assert spool.put(b'photo') == digest
+    assert spool.read(digest) == b'photo'
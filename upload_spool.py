@@ -0,0 +1,126 @@
+# upload_spool.py
+# Spool ảnh tải lên theo nội dung (sha256) trên đĩa cục bộ, dùng chung giữa mọi phiên và worker.
+# Mỗi ảnh được ghi đúng một lần; phiên Streamlit chỉ giữ băm + thumbnail hiển thị nhỏ, các bước sau
+# (dự đoán, lưu phản hồi) đọc lại từ spool qua memory map (các phiên/worker dùng chung page cache,
+# không phiên nào giữ bản sao riêng nhiều MB trong RAM).
+# Dọn dẹp: file không được dùng quá `ttl_seconds` bị xóa; tổng dung lượng vượt `max_bytes` thì xóa
+# file lâu không dùng nhất trước (LRU theo mtime, được "chạm" mỗi lần đọc).
+
+import io
+import mmap
+import os
+import threading
+import time
+
+from imaging import open_image
+from metrics import metrics
+from prediction_cache import image_hash
+
+# Khoảng thời gian tối thiểu giữa hai lần quét dọn theo TTL (giây)
+SWEEP_INTERVAL = 60.0
+
+
+def display_thumbnail(image_bytes, long_side=640, quality=85):
+    """Thumbnail JPEG để hiển thị (xoay theo EXIF, cạnh dài <= `long_side`), tạo một lần mỗi ảnh tải lên."""
+    img = open_image(image_bytes, (long_side, long_side))
+    img.thumbnail((long_side, long_side))
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=quality)
+    return out.getvalue()
+
+
+class UploadSpool:
+    """Lưu ảnh theo băm nội dung trong `directory`; `open` trả memory map chỉ đọc, None nếu đã bị dọn."""
+
+    def __init__(self, directory, max_bytes, ttl_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._scan())
+        metrics.set_gauge('upload_spool.bytes', self._total_bytes)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _scan(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue # Tiến trình khác vừa xóa
+                yield path, stat.st_size, stat.st_mtime
+
+    def put(self, data):
+        """Ghi ảnh (nếu chưa có) và trả băm sha256 dùng làm khóa."""
+        digest = image_hash(data)
+        path = self._path(digest)
+        try:
+            os.utime(path) # Cùng nội dung đã có (phiên khác vừa tải lên): chỉ đánh dấu vừa dùng
+            metrics.incr('upload_spool.dedup_hits')
+        except FileNotFoundError: # Chưa có, hoặc vừa bị tiến trình khác dọn: ghi mới
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path) # Cùng khóa luôn cùng nội dung nên ghi đè đồng thời vẫn đúng
+            with self._lock:
+                self._total_bytes += len(data)
+            metrics.incr('upload_spool.writes')
+        with self._lock:
+            now = time.time()
+            needs_eviction = self._total_bytes > self.max_bytes or now - self._last_sweep > SWEEP_INTERVAL
+            if needs_eviction:
+                self._last_sweep = now
+        if needs_eviction:
+            self._evict()
+        return digest
+
+    def open(self, digest):
+        """Memory map chỉ đọc của ảnh (dùng như bytes: len, cắt lát, buffer; hoặc như file: read/seek)."""
+        if not digest:
+            return None
+        path = self._path(digest)
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path) # Đánh dấu vừa dùng cho LRU
+        except (OSError, ValueError):
+            metrics.incr('upload_spool.misses')
+            return None
+        return mapped
+
+    def read(self, digest):
+        """Bản sao bytes của ảnh, cho nơi cần đúng kiểu bytes (tải lên Storage, hàng đợi phản hồi)."""
+        mapped = self.open(digest)
+        if mapped is None:
+            return None
+        try:
+            return mapped[:]
+        finally:
+            mapped.close()
+
+    def _evict(self):
+        """Xóa file quá TTL, rồi file cũ nhất đến khi còn 90% giới hạn (quét lại vì nhiều worker cùng ghi)."""
+        with self._lock:
+            entries = sorted(self._scan(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            expires_before = time.time() - self.ttl_seconds
+            target = self.max_bytes * 0.9
+            for path, size, mtime in entries:
+                if mtime >= expires_before and total <= target:
+                    break
+                try:
+                    os.remove(path) # Memory map đang mở vẫn đọc được (POSIX); trên Windows file đang map thì bỏ qua
+                    total -= size
+                    metrics.incr('upload_spool.evictions')
+                except OSError:
+                    pass
+            self._total_bytes = total
+        metrics.set_gauge('upload_spool.bytes', total)
@@ -1,32 +1,51 @@
 # utils.py
 
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import streamlit as st
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-from tensorflow.keras.applications.vgg16 import preprocess_input
 import numpy as np
-from PIL import Image
-import io
-import requests
 import os
 from datetime import datetime
 import re # Thêm thư viện regular expression để làm sạch tên file/thư mục
 
-import firebase_admin
-from firebase_admin import credentials, storage, firestore
-
 import json
+import functools
+
+# TensorFlow, firebase_admin và requests được import trễ bên trong các hàm dùng đến chúng
+# để trang đầu tiên hiển thị ngay mà không chờ các thư viện nặng này.
 
 # Import base URL từ config
-from config import INAT_API_BASE_URL, COLLECTED_DATA_DIR
+from config import (COLLECTED_DATA_DIR, INFERENCE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS,
+                    INFERENCE_USE_XLA, INFERENCE_BACKEND, TFLITE_MODEL_PATH, ONNX_MODEL_PATH, MMAP_WEIGHTS_PATH,
+                    INFERENCE_NUM_THREADS, PREDICTION_CACHE_SIZE, PREDICTION_CACHE_DB, REFERENCE_THUMB_DIR,
+                    REFERENCE_THUMB_MAX_BYTES, REFERENCE_THUMB_SIZE, REFERENCE_THUMB_FORMAT, REFERENCE_FETCH_WORKERS,
+                    CLASS_NAMES, CLASS_TO_SCIENTIFIC, SUGGESTED_SPECIES_VN, PREFETCH_ENABLED, PREFETCH_TOP_K,
+                    PREFETCH_COMMON_SPECIES, PREFETCH_THUMBNAILS, PREFETCH_WORKERS, PREFETCH_MAX_PENDING, INAT_CACHE_TTLS,
+                    FEEDBACK_BACKEND, FEEDBACK_LOCAL_DIR, FEEDBACK_ASYNC_UPLOAD, FEEDBACK_SPOOL_DIR,
+                    FEEDBACK_UPLOAD_WORKERS, FEEDBACK_MAX_RETRIES, FEEDBACK_BATCH_SIZE, FEEDBACK_FLUSH_INTERVAL,
+                    FEEDBACK_DEAD_LETTER_DIR, DEDUP_ENABLED, DEDUP_INDEX_PATH, DEDUP_MAX_DISTANCE, STORAGE_PROFILE_ENABLED,
+                    STORAGE_MAX_LONG_SIDE, STORAGE_FORMAT, STORAGE_QUALITY, STORAGE_KEEP_ORIGINAL, STORAGE_ORIGINALS_DIR,
+                    MANIFEST_ENABLED, MANIFEST_DIR, FIREBASE_STORAGE_BUCKET, SIMILARITY_ENABLED, SIMILARITY_INDEX_DIR,
+                    SIMILARITY_N_LISTS, SIMILARITY_N_PROBE, SIMILARITY_TOP_K, SIMILARITY_MIN_SCORE,
+                    CASCADE_ENABLED, CASCADE_MODEL_PATH, CASCADE_THRESHOLD, UPLOAD_SPOOL_DIR, UPLOAD_SPOOL_MAX_BYTES,
+                    UPLOAD_SPOOL_TTL, REFERENCE_FETCH_MAX_BYTES)
+from inference import INPUT_SHAPE, BatchingScheduler, BackgroundLoader, build_compiled_predict_fn, warm_up
+from metrics import metrics
+from backends import load_backend_model
+from prediction_cache import PredictionCache
+from imaging import decode_into
+from cascade import Cascade, Stage, load_small_stage
 
 # --- Firebase Initialization ---
 SERVICE_ACCOUNT_KEY_PATH = 'plantidentify-ca6f7-firebase-adminsdk-fbsvc-25fb51dcb6.json'
-CORRECT_BUCKET_NAME = "plantidentify-ca6f7.firebasestorage.app"
+CORRECT_BUCKET_NAME = FIREBASE_STORAGE_BUCKET
 
 @st.cache_resource
 def initialize_firebase():
     """Khởi tạo Firebase Admin SDK một cách an toàn."""
+    import firebase_admin
+    from firebase_admin import credentials
     if firebase_admin._apps:
         print("Firebase app already initialized (checked at start).")
         return True
@@ -115,35 +134,149 @@ def initialize_firebase():
         st.info(f"Đảm bảo Secret 'FIREBASE_SERVICE_ACCOUNT' có giá trị JSON đúng hoặc file key '{SERVICE_ACCOUNT_KEY_FILENAME}' tồn tại khi chạy local.")
         return False
 
-# Gọi hàm khởi tạo ngay khi load utils.py (nhờ cache nên chỉ chạy 1 lần)
-firebase_initialized = initialize_firebase()
-print(f"UTILS: Firebase initialized status after attempt: {firebase_initialized}")
-
 # --- Model Loading ---
+def resolve_model_path(model_path):
+    """Đường dẫn file model thực sự được dùng với backend đang chọn trong config."""
+    if INFERENCE_BACKEND == 'tflite':
+        return TFLITE_MODEL_PATH
+    if INFERENCE_BACKEND == 'onnx':
+        return ONNX_MODEL_PATH
+    if INFERENCE_BACKEND == 'mmap':
+        return MMAP_WEIGHTS_PATH
+    return model_path
+
+def load_model_for_backend(model_path):
+    """Tải model cho backend đang chọn (không dùng Streamlit, lỗi được ném ra cho nơi gọi xử lý)."""
+    model_path = resolve_model_path(model_path)
+    if INFERENCE_BACKEND == 'keras':
+        from tensorflow.keras.models import load_model
+        model = load_model(model_path, compile=False)
+    else:
+        model = load_backend_model(INFERENCE_BACKEND, model_path, num_threads=INFERENCE_NUM_THREADS)
+    print(f"Model loaded successfully! (backend: {INFERENCE_BACKEND})")
+    return model
+
+def build_classifier(model, max_batch_size=INFERENCE_MAX_BATCH_SIZE):
+    """Tạo hàm suy luận (đã biên dịch nếu là Keras), làm nóng và bọc trong bộ gom lô.
+
+    Trả một tầng VGG16 (tự chuẩn hóa ảnh đã giải mã), hoặc cascade model nhỏ -> VGG16 nếu bật CASCADE_ENABLED.
+    `max_batch_size`: số ảnh tối đa mỗi lần chạy model (CLI hàng loạt dùng lô lớn hơn app).
+    """
+    if INFERENCE_BACKEND == 'keras':
+        # Trả kèm embedding lớp áp chót cho chỉ mục ảnh tương tự (cùng một lần chạy model)
+        predict_fn = build_compiled_predict_fn(model, jit_compile=INFERENCE_USE_XLA, with_embeddings=SIMILARITY_ENABLED)
+        # XLA biên dịch riêng cho từng kích thước lô nên làm nóng cả lô lớn nhất
+        warm_up(predict_fn, (1, max_batch_size) if INFERENCE_USE_XLA else (1,))
+    else:
+        predict_fn = model.predict
+        warm_up(predict_fn)
+    print(f"UTILS: Starting batching scheduler (max_batch={max_batch_size}, max_wait={INFERENCE_MAX_WAIT_MS}ms)")
+    scheduler = BatchingScheduler(
+        predict_fn,
+        max_batch_size=max_batch_size,
+        max_wait_ms=INFERENCE_MAX_WAIT_MS,
+    )
+    stage = Stage(scheduler, 'vgg16')
+    if CASCADE_ENABLED:
+        try:
+            small = load_small_stage(max_batch_size=max_batch_size)
+        except Exception as e:
+            print(f"UTILS: Cascade model unavailable, using VGG16 only: {e}")
+            return stage
+        print(f"UTILS: Cascade enabled (small model first, VGG16 below {CASCADE_THRESHOLD:.0f}% confidence)")
+        return Cascade(small, stage, CASCADE_THRESHOLD)
+    return stage
+
 @st.cache_resource
 def load_keras_model(model_path):
-    """Tải mô hình Keras từ đường dẫn."""
+    """Tải mô hình Keras từ đường dẫn, hoặc model tflite/onnx tương ứng nếu chọn backend khác trong config."""
     try:
-        model = load_model(model_path, compile=False)
-        print("Model loaded successfully!")
-        return model
+        return load_model_for_backend(model_path)
     except Exception as e:
         st.error(f"Lỗi nghiêm trọng khi tải mô hình tại đường dẫn '{model_path}': {e}")
         print(f"Error loading model from {model_path}: {e}")
         return None
 
+@st.cache_resource
+def get_inference_scheduler(model_path):
+    """Bộ gom lô suy luận dùng chung cho mọi phiên, bọc quanh model từ `load_keras_model`."""
+    model = load_keras_model(model_path)
+    if model is None:
+        return None
+    return build_classifier(model)
+
+@st.cache_resource
+def start_model_loading(model_path):
+    """Bắt đầu tải + làm nóng model trên luồng nền (một lần mỗi tiến trình); `.result` là bộ gom lô khi sẵn sàng."""
+    def load():
+        scheduler = build_classifier(load_model_for_backend(model_path))
+        metrics.set_gauge('startup.model_ready_since_import_ms', (time.perf_counter() - _IMPORT_STARTED) * 1000.0)
+        return scheduler
+    return BackgroundLoader(load, name='model').start()
+
+_first_prediction_logged = False
+
+def record_first_prediction():
+    """Ghi lại (một lần mỗi tiến trình) thời gian từ lúc import utils đến dự đoán đầu tiên."""
+    global _first_prediction_logged
+    if not _first_prediction_logged:
+        _first_prediction_logged = True
+        elapsed_ms = (time.perf_counter() - _IMPORT_STARTED) * 1000.0
+        metrics.set_gauge('startup.first_prediction_ms', elapsed_ms)
+        print(f"UTILS: Time to first prediction: {elapsed_ms:.0f} ms")
+
+@st.cache_resource
+def get_prediction_cache(model_path):
+    """Cache dự đoán dùng chung cho mọi phiên; tự vô hiệu khi file model (hoặc model nhỏ / ngưỡng cascade) thay đổi."""
+    if CASCADE_ENABLED:
+        return PredictionCache((resolve_model_path(model_path), CASCADE_MODEL_PATH), max_entries=PREDICTION_CACHE_SIZE,
+                               disk_path=PREDICTION_CACHE_DB, variant=f"cascade@{CASCADE_THRESHOLD}")
+    return PredictionCache(resolve_model_path(model_path), max_entries=PREDICTION_CACHE_SIZE,
+                           disk_path=PREDICTION_CACHE_DB)
+
+# --- Similar Collected Photos ---
+@st.cache_resource
+def get_similarity_index():
+    """Chỉ mục láng giềng gần của ảnh phản hồi đã gán nhãn (None nếu tắt)."""
+    if not SIMILARITY_ENABLED:
+        return None
+    from similarity_index import SimilarityIndex
+    return SimilarityIndex(SIMILARITY_INDEX_DIR, SIMILARITY_N_LISTS, SIMILARITY_N_PROBE)
+
+def suggest_similar_species(embedding):
+    """Các loài người dùng đã xác nhận cho ảnh giống ảnh này nhất (không gọi mạng); [] nếu không có."""
+    if embedding is None:
+        return []
+    try:
+        index = get_similarity_index() # Lỗi khi dựng chỉ mục không được cache nên lần sau thử lại
+        if index is None:
+            return []
+        return index.suggest_species(embedding, k=SIMILARITY_TOP_K, min_similarity=SIMILARITY_MIN_SCORE)
+    except Exception as e:
+        print(f"UTILS: Similarity search failed: {e}")
+        return []
+
 # --- Image Processing ---
+@st.cache_resource
+def get_upload_spool():
+    """Spool ảnh tải lên dùng chung cho mọi phiên (phiên chỉ giữ băm)."""
+    from upload_spool import UploadSpool
+    return UploadSpool(UPLOAD_SPOOL_DIR, UPLOAD_SPOOL_MAX_BYTES, UPLOAD_SPOOL_TTL)
+
+def decode_image(image_data):
+    """Giải mã ảnh thành tensor (1, 224, 224, 3) RGB 0..255 (không dùng Streamlit, lỗi được ném ra).
+
+    Chuẩn hóa theo từng model (VGG16, model nhỏ của cascade) do tầng phân loại tự làm.
+    """
+    # Ghi thẳng vào bộ đệm float32 đã cấp phát
+    buffer = np.empty((1,) + INPUT_SHAPE, dtype=np.float32)
+    decode_into(image_data, buffer[0], INPUT_SHAPE[1::-1])
+    return buffer
+
 def preprocess_image(image_data):
-    # ... (Giữ nguyên hàm này như trước) ...
+    """Như `decode_image`, nhưng báo lỗi lên giao diện và trả None."""
     try:
-        img = Image.open(io.BytesIO(image_data))
-        if img.format == 'GIF':
-             img = img.convert('RGB')
-        img = img.convert('RGB')
-        img = img.resize((224, 224))
-        img_array = np.array(img)
-        img_array_expanded = np.expand_dims(img_array, axis=0)
-        return preprocess_input(img_array_expanded)
+        return decode_image(image_data)
     except Exception as e:
         print(f"Error preprocessing image: {e}")
         st.error(f"Không thể xử lý ảnh này. Vui lòng thử ảnh khác. Lỗi: {e}")
@@ -151,26 +284,27 @@ def preprocess_image(image_data):
 
 
 # --- iNaturalist API Interaction ---
+@st.cache_resource
+def get_inat_client():
+    """Client iNaturalist dùng chung (pool kết nối, thử lại, cache SQLite chung giữa các worker)."""
+    from inat_client import INatClient
+    return INatClient()
+
+@st.cache_resource
+def get_taxonomy_index():
+    """Chỉ mục phân loại cục bộ từ snapshot (None nếu chưa có snapshot)."""
+    from taxonomy_index import load_index
+    return load_index()
+
 @st.cache_data(ttl=3600)
 def get_taxon_id(scientific_name):
+    import requests
     print(f"UTILS: Attempting to get Taxon ID for: '{scientific_name}'") # DEBUG
     if not scientific_name: return None
     try:
-        api_url = f"{INAT_API_BASE_URL}/taxa"
-        params = {'q': scientific_name, 'is_active': 'true', 'rank': 'species'}
-        print(f"UTILS: Calling Taxa API: {api_url} with params: {params}") # DEBUG
-        response = requests.get(api_url, params=params, timeout=10)
-        print(f"UTILS: Taxa API status code: {response.status_code}") # DEBUG
-        response.raise_for_status()
-        data = response.json()
-        # print(f"UTILS: Taxa API response data: {data}") # DEBUG - có thể rất dài
-        if data.get('results') and data['total_results'] > 0:
-            taxon_id = data['results'][0]['id']
-            print(f"UTILS: Found Taxon ID: {taxon_id}") # DEBUG
-            return taxon_id
-        else:
-            print(f"UTILS: No Taxon ID found for: {scientific_name}") # DEBUG
-            return None
+        taxon_id = get_inat_client().get_taxon_id(scientific_name)
+        print(f"UTILS: Taxon ID for {scientific_name}: {taxon_id}") # DEBUG
+        return taxon_id
     except requests.exceptions.RequestException as e:
         print(f"UTILS: API Error finding Taxon ID for {scientific_name}: {e}") # DEBUG
         st.warning(f"Không thể kết nối đến iNaturalist để tìm ID cho {scientific_name}.")
@@ -182,36 +316,16 @@ def get_taxon_id(scientific_name):
 
 @st.cache_data(ttl=3600)
 def get_inat_image_urls(taxon_id, count=10):
+    import requests
     print(f"UTILS: Attempting to get image URLs for Taxon ID: {taxon_id}") # DEBUG
     if not taxon_id: return []
-    image_urls = []
+    # Dữ liệu thường đã được tải trước ngay sau khi dự đoán
+    prefetched = get_prefetcher().lookup_image_urls(taxon_id) if count == 10 else None
+    if prefetched is not None:
+        print(f"UTILS: Using {len(prefetched)} prefetched image URLs.") # DEBUG
+        return prefetched
     try:
-        api_url = f"{INAT_API_BASE_URL}/observations"
-        params = {
-            'taxon_id': taxon_id, 'photos': 'true', 'quality_grade': 'research',
-            'per_page': count, 'order': 'desc', 'order_by': 'votes'
-        }
-        print(f"UTILS: Calling Observations API: {api_url} with params: {params}") # DEBUG
-        response = requests.get(api_url, params=params, timeout=15) # Tăng nhẹ timeout nếu cần
-        print(f"UTILS: Observations API status code: {response.status_code}") # DEBUG
-        response.raise_for_status()
-        data = response.json()
-        # print(f"UTILS: Observations API response data: {data}") # DEBUG - có thể rất dài
-
-        if data.get('results') and data['total_results'] > 0:
-            print(f"UTILS: Found {len(data['results'])} observations with photos.") # DEBUG
-            for obs in data['results']:
-                if obs.get('photos'):
-                    photo_url = obs['photos'][0].get('url')
-                    if photo_url:
-                        medium_url = photo_url.replace('square', 'medium')
-                        print(f"UTILS: Adding image URL: {medium_url}") # DEBUG
-                        image_urls.append(medium_url)
-                    if len(image_urls) >= count:
-                        break
-        else:
-             print(f"UTILS: No 'results' or 'total_results' > 0 in API response for taxon_id: {taxon_id}") # DEBUG
-
+        image_urls = get_inat_client().get_observation_photo_urls(taxon_id, count=count)
         print(f"UTILS: Returning {len(image_urls)} image URLs.") # DEBUG
         return image_urls
     except requests.exceptions.RequestException as e:
@@ -222,35 +336,64 @@ def get_inat_image_urls(taxon_id, count=10):
         print(f"UTILS: Unknown error getting observation photos for taxon_id {taxon_id}: {e}") # DEBUG
         return []
 
+@st.cache_resource
+def get_thumbnail_cache():
+    """Cache thumbnail ảnh tham khảo trên đĩa, dùng chung kết nối keep-alive của client iNaturalist."""
+    from reference_images import ThumbnailCache
+    return ThumbnailCache(REFERENCE_THUMB_DIR, REFERENCE_THUMB_MAX_BYTES, thumb_size=REFERENCE_THUMB_SIZE,
+                          image_format=REFERENCE_THUMB_FORMAT, fetch_workers=REFERENCE_FETCH_WORKERS,
+                          session=get_inat_client().session, max_fetch_bytes=REFERENCE_FETCH_MAX_BYTES)
+
+def get_reference_thumbnails(image_urls):
+    """Thumbnail nhỏ cho các URL ảnh tham khảo (tải song song, phục vụ từ cache đĩa). Ảnh lỗi -> None."""
+    if not image_urls:
+        return []
+    return get_thumbnail_cache().get_thumbnails(image_urls)
+
+@st.cache_resource
+def get_prefetcher():
+    """Bộ tải trước dữ liệu tham khảo dùng chung (giới hạn số luồng và số việc chờ)."""
+    from prefetch import Prefetcher
+    return Prefetcher(get_inat_client(), get_thumbnail_cache() if PREFETCH_THUMBNAILS else None,
+                      max_workers=PREFETCH_WORKERS, max_pending=PREFETCH_MAX_PENDING, image_count=10,
+                      taxon_ttl=INAT_CACHE_TTLS['taxa'], image_url_ttl=INAT_CACHE_TTLS['observations'])
+
+def prefetch_reference_data(owner, probabilities):
+    """Bắt đầu tải trước dữ liệu iNaturalist cho top-k lớp dự đoán (qua CLASS_TO_SCIENTIFIC) và các loài phổ biến."""
+    if not PREFETCH_ENABLED:
+        return
+    names = []
+    for index in np.argsort(probabilities)[::-1][:PREFETCH_TOP_K]:
+        if index < len(CLASS_NAMES):
+            scientific = CLASS_TO_SCIENTIFIC.get(CLASS_NAMES[index])
+            if scientific:
+                names.append(scientific.replace('_', ' '))
+    if PREFETCH_COMMON_SPECIES:
+        names.extend(SUGGESTED_SPECIES_VN.values())
+    get_prefetcher().prefetch(owner, names)
+
+def cancel_prefetch(owner):
+    """Hủy việc tải trước của một phiên (ảnh mới, gỡ ảnh, hoặc sau khi đã lưu phản hồi)."""
+    if PREFETCH_ENABLED and owner:
+        get_prefetcher().cancel(owner)
+
 # *** HÀM MỚI CHO AUTOCOMPLETE ***
 @st.cache_data(ttl=600) # Cache ngắn hơn cho autocomplete (10 phút)
 def search_taxa_autocomplete(query):
     """Tìm kiếm gợi ý loài trên iNaturalist."""
+    import requests
     if not query or len(query) < 3: # Chỉ tìm khi có ít nhất 3 ký tự
         return []
-    suggestions = []
+    # Tra chỉ mục cục bộ trước (dưới 1 ms); chỉ gọi API khi không tìm thấy
+    index = get_taxonomy_index()
+    if index is not None:
+        suggestions = index.search(query)
+        if suggestions:
+            metrics.incr('taxonomy.local_hits')
+            return suggestions
+        metrics.incr('taxonomy.local_misses')
     try:
-        api_url = f"{INAT_API_BASE_URL}/taxa/autocomplete"
-        params = {'q': query, 'is_active': 'true', 'rank': 'species,genus,family'} # Mở rộng rank
-        response = requests.get(api_url, params=params, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        if data.get('results') and data['total_results'] > 0:
-            for result in data['results']:
-                taxon_id = result.get('id')
-                scientific_name = result.get('name') # Tên khoa học
-                display_name = result.get('preferred_common_name') or scientific_name # Ưu tiên tên thường gọi
-                rank = result.get('rank')
-                # Tạo một chuỗi hiển thị rõ ràng
-                suggestion_display = f"{display_name} ({scientific_name}) - Rank: {rank}"
-                suggestions.append({
-                    "id": taxon_id,
-                    "scientific_name": scientific_name,
-                    "display_name": display_name,
-                    "rank": rank,
-                    "formatted_display": suggestion_display # Chuỗi để hiển thị trong selectbox/radio
-                })
-        return suggestions
+        return get_inat_client().autocomplete(query)
     except requests.exceptions.RequestException as e:
         print(f"API Error during taxa autocomplete for query '{query}': {e}")
         # Không hiện lỗi trực tiếp lên UI để tránh làm phiền
@@ -259,14 +402,162 @@ def search_taxa_autocomplete(query):
         print(f"Unknown error during taxa autocomplete for query '{query}': {e}")
         return []
 
+# --- Per-Run Cost Measurement ---
+# Mốc histogram cho số byte media hiển thị mỗi lần chạy
+MEDIA_BYTES_BUCKETS = (1_000, 5_000, 20_000, 100_000, 500_000, 2_000_000, 10_000_000)
+
+# Chỉ đếm byte media app tự hiển thị (ảnh tải lên, thumbnail tham khảo) qua `note_media_bytes`, không phải
+# tổng byte gửi về trình duyệt: Streamlit không có hook công khai cho các delta gửi qua websocket.
+def _record_run(name, started, media_bytes):
+    elapsed_ms = (time.perf_counter() - started) * 1000.0
+    metrics.observe(f"app.run.{name}.script_ms", elapsed_ms)
+    metrics.observe(f"app.run.{name}.media_bytes", media_bytes, MEDIA_BYTES_BUCKETS)
+    print(f"UTILS: Run '{name}' took {elapsed_ms:.0f} ms, rendered {media_bytes / 1024:.1f} KB of media")
+
+def begin_run(name='script'):
+    """Bắt đầu đo cả lần chạy script; lần chạy trước bị st.rerun() cắt ngang được ghi lại tại đây."""
+    end_run()
+    st.session_state['_run_measure'] = {'name': name, 'started': time.perf_counter(), 'media_bytes': 0}
+
+def note_media_bytes(size):
+    """Cộng byte của ảnh app vừa hiển thị vào lần chạy hiện tại (cả trang và/hoặc fragment đang chạy)."""
+    for key in ('_run_measure', '_fragment_measure'):
+        measure = st.session_state.get(key)
+        if measure is not None:
+            measure['media_bytes'] += size
+
+def end_run():
+    measure = st.session_state.pop('_run_measure', None)
+    if measure is not None:
+        _record_run(measure['name'], measure['started'], measure['media_bytes'])
+
+def rerun_fragment():
+    """Chạy lại riêng fragment đang chạy; nếu fragment đang chạy trong lần chạy cả trang thì chạy lại cả trang."""
+    from streamlit.errors import StreamlitAPIException
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def measured(name):
+    """Decorator đo thời gian chạy và byte media hiển thị của một fragment (kể cả khi nó chạy lại riêng)."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            measure = {'media_bytes': 0}
+            st.session_state['_fragment_measure'] = measure
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                st.session_state.pop('_fragment_measure', None)
+                _record_run(name, started, measure['media_bytes'])
+        return wrapper
+    return decorate
+
+
 # --- File Saving for Feedback ---
-def save_feedback_image(image_bytes, original_filename, label, base_dir=COLLECTED_DATA_DIR): # base_dir giờ là tiền tố trên Storage
-    """Lưu ảnh phản hồi (dạng bytes) lên Firebase Cloud Storage."""
-    print(f"SAVE_FEEDBACK: Called. Firebase initialized status: {firebase_initialized}")
-    if not firebase_initialized:
+@st.cache_resource
+def get_feedback_backend():
+    """Nơi lưu phản hồi theo config: Firebase (Storage + Firestore) hoặc bản giả lập cục bộ."""
+    from feedback_backends import FirebaseBackend, LocalBackend
+    if FEEDBACK_BACKEND == 'local':
+        return LocalBackend(FEEDBACK_LOCAL_DIR)
+    firebase_initialized = initialize_firebase() # Khởi tạo trễ ở lần lưu đầu tiên (cache nên chỉ chạy 1 lần)
+    print(f"SAVE_FEEDBACK: Firebase initialized status: {firebase_initialized}")
+    return FirebaseBackend() if firebase_initialized else None
+
+@st.cache_resource
+def get_feedback_queue():
+    """Hàng đợi tải phản hồi lên nền (spool trên đĩa), dùng chung cho mọi phiên trong tiến trình."""
+    from feedback_queue import FeedbackUploadQueue
+    backend = get_feedback_backend()
+    if backend is None:
+        return None
+    return FeedbackUploadQueue(FEEDBACK_SPOOL_DIR, backend, upload_workers=FEEDBACK_UPLOAD_WORKERS,
+                               max_retries=FEEDBACK_MAX_RETRIES, batch_size=FEEDBACK_BATCH_SIZE,
+                               flush_interval=FEEDBACK_FLUSH_INTERVAL, dead_letter_dir=FEEDBACK_DEAD_LETTER_DIR)
+
+@st.cache_resource
+def get_dedup_index():
+    """Chỉ mục băm cảm nhận của ảnh đã thu thập (nạp một lần, dùng chung giữa các phiên)."""
+    from dedup import HashIndex
+    return HashIndex(DEDUP_INDEX_PATH, DEDUP_MAX_DISTANCE)
+
+@st.cache_resource
+def get_storage_profile():
+    """Cấu hình mã hóa ảnh phản hồi trước khi lưu (None nếu tắt: lưu nguyên ảnh gốc)."""
+    if not STORAGE_PROFILE_ENABLED:
+        return None
+    from storage_profile import StorageProfile
+    return StorageProfile(STORAGE_MAX_LONG_SIDE, STORAGE_FORMAT, STORAGE_QUALITY)
+
+@st.cache_resource
+def get_manifest():
+    """Manifest ghi nối của dữ liệu phản hồi (None nếu tắt)."""
+    if not MANIFEST_ENABLED:
+        return None
+    from manifest import Manifest
+    return Manifest(MANIFEST_DIR)
+
+def _record_in_manifest(doc_id, metadata, size):
+    """Ghi mẫu vừa lưu vào manifest; lỗi manifest không làm hỏng việc lưu ảnh."""
+    manifest = get_manifest()
+    if manifest is None:
+        return
+    try:
+        manifest.append({
+            'doc_id': doc_id,
+            'label': metadata[u'label'],
+            'storage_path': metadata[u'storage_path'],
+            'image_hash': metadata.get(u'image_hash'),
+            'bytes': size,
+            'prediction': metadata.get(u'prediction'),
+            'duplicate_of': metadata.get(u'duplicate_of'),
+        })
+    except Exception as e:
+        print(f"UTILS: Error appending to manifest: {e}")
+
+def _add_to_similarity_index(embedding, doc_id, metadata, image_bytes=None, classifier=None):
+    """Thêm ảnh vừa lưu vào chỉ mục ảnh tương tự; lỗi chỉ mục không làm hỏng việc lưu ảnh (đã xếp hàng tải lên).
+
+    Thiếu `embedding` (ảnh do model nhỏ của cascade tự phân loại) thì tính bù bằng `classifier.embed`.
+    """
+    if embedding is None and classifier is None:
+        return
+    try:
+        index = get_similarity_index()
+        if index is None:
+            return
+        if embedding is None:
+            embeddings = classifier.embed(decode_image(image_bytes))
+            embedding = embeddings[0] if embeddings is not None else None
+            if embedding is None:
+                return
+        index.add(np.asarray(embedding, dtype=np.float32)[None, :],
+                  [{'label': metadata[u'label'], 'doc_id': doc_id, 'storage_path': metadata[u'storage_path']}])
+    except Exception as e:
+        print(f"UTILS: Error adding to similarity index: {e}")
+
+def save_feedback_image(image_bytes, original_filename, label, base_dir=COLLECTED_DATA_DIR, prediction=None,
+                        embedding=None, classifier=None): # base_dir giờ là tiền tố trên Storage
+    """Lưu ảnh phản hồi (dạng bytes) lên Cloud Storage; mặc định chỉ xếp vào hàng đợi nền rồi trả về ngay.
+
+    `prediction`: dict {'class', 'confidence'} của model cho ảnh này, lưu kèm metadata và manifest.
+    `embedding`: embedding lớp áp chót của ảnh, thêm vào chỉ mục ảnh tương tự.
+    `classifier`: tầng phân loại dùng để tính embedding khi `embedding` là None (cascade).
+    """
+    backend = get_feedback_backend()
+    print(f"SAVE_FEEDBACK: Called. Backend: {backend.name if backend else None}")
+    if backend is None:
         st.error("Firebase chưa được khởi tạo, không thể lưu ảnh.")
         print("SAVE_FEEDBACK: Firebase not initialized, aborting save.")
         return False, None
+    if image_bytes is None:
+        # Ảnh đã bị dọn khỏi spool (phiên để quá lâu)
+        st.error("Ảnh đã hết hạn trên máy chủ, không thể lưu. Vui lòng tải lại ảnh.")
+        print("SAVE_FEEDBACK: Image no longer in upload spool, aborting save.")
+        return False, None
 
     try:
         # Làm sạch tên label để tạo đường dẫn trên Storage
@@ -284,16 +575,6 @@ def save_feedback_image(image_bytes, original_filename, label, base_dir=COLLECTE
                  if ext: file_extension = ext.lower()
              except Exception: pass # Bỏ qua nếu lỗi lấy đuôi file
 
-        # Tạo đường dẫn đầy đủ trên Firebase Storage
-        # Ví dụ: collected_data/Epipremnum_aureum/20230407_193005123456.jpg
-        destination_blob_name = f"{base_dir}/{safe_label}/{timestamp}{file_extension}"
-
-        # Lấy bucket từ Firebase Storage
-        bucket = storage.bucket() # Lấy bucket mặc định đã cấu hình khi initialize
-
-        # Tạo blob (đối tượng file) trên Storage
-        blob = bucket.blob(destination_blob_name)
-
         # Xác định content type dựa trên đuôi file (quan trọng để trình duyệt hiển thị đúng)
         content_type = 'image/jpeg' # Mặc định
         if file_extension == '.png':
@@ -301,27 +582,90 @@ def save_feedback_image(image_bytes, original_filename, label, base_dir=COLLECTE
         elif file_extension == '.gif':
             content_type = 'image/gif'
         # Thêm các loại khác nếu cần
+        original_extension, original_content_type = file_extension, content_type
 
-        # Upload dữ liệu ảnh (dạng bytes)
-        print(f"UTILS: Uploading to Firebase Storage: {destination_blob_name} (Content-Type: {content_type})")
-        blob.upload_from_string(
-            image_bytes,
-            content_type=content_type
-        )
+        storage_profile = get_storage_profile()
+        if storage_profile is not None:
+            # Ảnh được mã hóa lại nên đuôi file/content type theo định dạng lưu, không theo tên gốc
+            file_extension, content_type = storage_profile.extension, storage_profile.content_type
+
+        # Tạo đường dẫn đầy đủ trên Firebase Storage
+        # Ví dụ: collected_data/Epipremnum_aureum/20230407_193005123456.jpg
+        destination_blob_name = f"{base_dir}/{safe_label}/{timestamp}{file_extension}"
+
+        # Metadata lưu vào Firestore (trường timestamp do backend tự thêm)
+        metadata = {
+            u'label': label, # Lưu cả nhãn gốc người dùng nhập/chọn
+            u'storage_path': destination_blob_name,
+            u'original_filename': original_filename,
+            # Thêm các trường khác nếu muốn (ví dụ: dự đoán ban đầu, confidence...)
+        }
+        if prediction is not None:
+            metadata[u'prediction'] = prediction
+
+        feedback_queue = get_feedback_queue() if FEEDBACK_ASYNC_UPLOAD else None
+
+        # --- Chống trùng: ảnh gần giống ảnh đã lưu thì chỉ ghi document liên kết tới ảnh cũ ---
+        value_hash = None
+        if DEDUP_ENABLED:
+            from dedup import image_hash
+            try:
+                value_hash = image_hash(image_bytes)
+                match = get_dedup_index().find(value_hash)
+            except Exception as dedup_e:
+                print(f"UTILS: Perceptual hash failed, saving without de-duplication: {dedup_e}")
+                value_hash, match = None, None
+            if match is not None:
+                duplicate_doc_id, duplicate_path, distance = match
+                link = dict(metadata, storage_path=duplicate_path, duplicate_of=duplicate_doc_id,
+                            duplicate_distance=distance)
+                if feedback_queue is not None:
+                    feedback_queue.enqueue_document(timestamp, link)
+                else:
+                    backend.write_documents([(timestamp, link)])
+                metrics.incr('dedup.duplicates')
+                _record_in_manifest(timestamp, link, 0)
+                print(f"UTILS: Near-duplicate of {duplicate_doc_id} (distance {distance}), linked instead of uploading")
+                return True, safe_label
+            if value_hash is not None:
+                metadata[u'image_hash'] = f"{value_hash:016x}"
+
+        # --- Định dạng lưu: mã hóa lại một lần, ghi cách mã hóa vào metadata ---
+        upload_bytes = image_bytes
+        original_path = None
+        if storage_profile is not None:
+            upload_bytes, metadata[u'encoding'] = storage_profile.encode(image_bytes)
+            print(f"UTILS: Re-encoded {len(image_bytes)} -> {len(upload_bytes)} bytes ({storage_profile.image_format})")
+            if STORAGE_KEEP_ORIGINAL:
+                original_path = f"{STORAGE_ORIGINALS_DIR}/{safe_label}/{timestamp}{original_extension}"
+                metadata[u'original_path'] = original_path
+
+        if feedback_queue is not None:
+            # Ghi vào spool trên đĩa rồi trả về ngay; worker nền tải ảnh và gom metadata thành batch write
+            if original_path is not None:
+                feedback_queue.enqueue(image_bytes, original_path, original_content_type)
+            feedback_queue.enqueue(upload_bytes, destination_blob_name, content_type, timestamp, metadata)
+            if value_hash is not None:
+                get_dedup_index().add(value_hash, timestamp, destination_blob_name)
+            _record_in_manifest(timestamp, metadata, len(upload_bytes))
+            _add_to_similarity_index(embedding, timestamp, metadata, image_bytes, classifier)
+            print(f"UTILS: Queued {destination_blob_name} for background upload")
+            return True, safe_label
 
+        # Upload dữ liệu ảnh (dạng bytes)
+        print(f"UTILS: Uploading to Storage: {destination_blob_name} (Content-Type: {content_type})")
+        backend.upload(destination_blob_name, upload_bytes, content_type)
+        if original_path is not None:
+            backend.upload(original_path, image_bytes, original_content_type)
         print(f"UTILS: Successfully uploaded to {destination_blob_name}")
+        if value_hash is not None:
+            get_dedup_index().add(value_hash, timestamp, destination_blob_name)
+        _record_in_manifest(timestamp, metadata, len(upload_bytes))
+        _add_to_similarity_index(embedding, timestamp, metadata, image_bytes, classifier)
 
         # --- (TÙY CHỌN) Lưu metadata vào Firestore ---
         try:
-            db = firestore.client()
-            doc_ref = db.collection(u'plant_feedback').document(f'{timestamp}') # Dùng timestamp làm ID document
-            doc_ref.set({
-                u'label': label, # Lưu cả nhãn gốc người dùng nhập/chọn
-                u'storage_path': destination_blob_name,
-                u'original_filename': original_filename,
-                u'timestamp': firestore.SERVER_TIMESTAMP # Tự động lấy giờ server
-                # Thêm các trường khác nếu muốn (ví dụ: dự đoán ban đầu, confidence...)
-            })
+            backend.write_documents([(timestamp, metadata)]) # Dùng timestamp làm ID document
             print(f"UTILS: Metadata saved to Firestore collection 'plant_feedback', doc ID: {timestamp}")
         except Exception as fs_e:
             print(f"UTILS: Error saving metadata to Firestore: {fs_e}")
@@ -331,6 +675,11 @@ def save_feedback_image(image_bytes, original_filename, label, base_dir=COLLECTE
         return True, safe_label # Trả về thành công và tên thư mục (label) đã dùng
 
     except Exception as e:
-        print(f"Error uploading image to Firebase Storage for label '{label}' (safe: '{safe_label}'): {e}")
+        print(f"Error uploading image to Storage for label '{label}': {e}")
         st.error(f"Lỗi khi tải ảnh lên bộ nhớ Cloud: {e}")
-        return False, None
\ No newline at end of file
+        return False, None
+
+
+_import_ms = (time.perf_counter() - _IMPORT_STARTED) * 1000.0
+metrics.set_gauge('startup.utils_import_ms', _import_ms)
+print(f"UTILS: Imported in {_import_ms:.0f} ms")